@@ -0,0 +1,441 @@
+"""Local load test for the proxy's CONNECT path.
+
+Starts a scratch copy of proxy.py with generated users, a local upstream (TCP echo or
+sink, optionally also behind TLS with a self-signed certificate) and drives concurrent
+authenticated CONNECT clients through it. Reports tunnels per second, time-to-200
+percentiles, relay throughput, CPU use of the proxy (workers included) and its RSS per
+open tunnel.
+
+Usage:
+    python bench_load.py [--clients 50] [--users 10] [--payload 16384] [--requests-per-tunnel 1]
+                         [--duration 10] [--upstream echo|sink] [--tls] [--hold 200]
+                         [--env PROXY_ENGINE=asyncio] [--label NAME] [--output bench_output.txt]
+
+--requests-per-tunnel sets connection churn: 1 opens a new tunnel for every exchange,
+0 keeps each client's tunnel open for the whole run. Proxy settings are passed with
+--env (repeatable), e.g. --env PROXY_ENGINE=asyncio --env RELAY_CHUNK_SIZE=65536.
+Each run is appended to the output file as one JSON object per line.
+
+Everything runs on this machine, so the clients and upstream compete with the proxy for
+CPU; their own CPU use is reported alongside.
+"""
+import argparse
+import asyncio
+import base64
+import datetime
+import ipaddress
+import json
+import multiprocessing
+import os
+import shutil
+import ssl
+import statistics
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+
+from bench_startup import BENCH_PASSWORD, free_port, probe, seed
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+READY_TIMEOUT = 120  # Seconds for the proxy to accept its first CONNECT
+SINK_HEADER = struct.Struct("!Q")  # Sink upstream: payload length in, bytes received back
+
+
+# ============================
+# LOCAL UPSTREAM
+# ============================
+
+def write_self_signed_cert(directory):
+    """Write a self-signed certificate for localhost/127.0.0.1. Returns (certfile, keyfile)."""
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.x509.oid import NameOID
+
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "localhost")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(days=1))
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .add_extension(x509.SubjectAlternativeName([
+            x509.DNSName("localhost"), x509.IPAddress(ipaddress.ip_address("127.0.0.1"))]), critical=False)
+        .sign(key, hashes.SHA256())
+    )
+    certfile = os.path.join(directory, "upstream_cert.pem")
+    keyfile = os.path.join(directory, "upstream_key.pem")
+    with open(certfile, "wb") as f:
+        f.write(cert.public_bytes(serialization.Encoding.PEM))
+    with open(keyfile, "wb") as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                  serialization.NoEncryption()))
+    return certfile, keyfile
+
+
+async def serve_echo(reader, writer):
+    try:
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+    except (ConnectionError, ssl.SSLError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve_sink(reader, writer):
+    """Read length-prefixed payloads and answer each with the number of bytes received."""
+    try:
+        while True:
+            length, = SINK_HEADER.unpack(await reader.readexactly(SINK_HEADER.size))
+            remaining = length
+            while remaining:
+                data = await reader.read(min(remaining, 65536))
+                if not data:
+                    return
+                remaining -= len(data)
+            writer.write(SINK_HEADER.pack(length))
+            await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError, ssl.SSLError):
+        pass
+    finally:
+        writer.close()
+
+
+def run_upstream(mode, plain_port, tls_port, certfile, keyfile):
+    """Upstream process: serve echo or sink on plain_port, and on tls_port behind TLS if given."""
+    handler = serve_echo if mode == "echo" else serve_sink
+
+    async def main():
+        servers = [await asyncio.start_server(handler, "127.0.0.1", plain_port, backlog=1024)]
+        if tls_port:
+            context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            context.load_cert_chain(certfile, keyfile)
+            servers.append(await asyncio.start_server(handler, "127.0.0.1", tls_port, ssl=context, backlog=1024))
+        await asyncio.gather(*(server.serve_forever() for server in servers))
+
+    asyncio.run(main())
+
+
+# ============================
+# PROCESS ACCOUNTING
+# ============================
+
+def process_tree(pid):
+    """Return pid and all its descendants."""
+    children = defaultdict(list)
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            try:
+                with open(f"/proc/{entry}/stat") as f:
+                    children[int(f.read().rsplit(")", 1)[1].split()[1])].append(int(entry))
+            except (OSError, IndexError, ValueError):
+                continue
+    pids, stack = [], [pid]
+    while stack:
+        pid = stack.pop()
+        pids.append(pid)
+        stack.extend(children[pid])
+    return pids
+
+
+def tree_usage(pid):
+    """Return (CPU seconds, RSS bytes) summed over pid and its descendants (Linux /proc)."""
+    cpu = rss = 0
+    for p in process_tree(pid):
+        try:
+            with open(f"/proc/{p}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            with open(f"/proc/{p}/statm") as f:
+                resident = int(f.read().split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        cpu += (int(fields[11]) + int(fields[12])) / CLOCK_TICKS  # utime + stime
+        rss += resident * PAGE_SIZE
+    return cpu, rss
+
+
+# ============================
+# CLIENTS
+# ============================
+
+class LoadStats:
+    def __init__(self):
+        self.time_to_200 = []  # Seconds from opening the TCP connection to the 200
+        self.tls_handshakes = []  # Seconds for the TLS handshake through the tunnel
+        self.tunnels = 0
+        self.exchanges = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.errors = Counter()
+
+
+async def open_tunnel(args, username, stats):
+    """Open one authenticated tunnel (TLS on top with --tls). Returns (reader, writer)."""
+    started = time.perf_counter()
+    reader, writer = await asyncio.open_connection("127.0.0.1", args.proxy_port)
+    try:
+        token = base64.b64encode(f"{username}:{BENCH_PASSWORD}".encode()).decode()
+        writer.write(f"CONNECT {args.target} HTTP/1.1\r\nHost: {args.target}\r\n"
+                     f"Proxy-Authorization: Basic {token}\r\n\r\n".encode())
+        head = await reader.readuntil(b"\r\n\r\n")
+        status = int(head.split(b" ", 2)[1])
+        if status != 200:
+            raise ConnectionError(f"status_{status}")
+        connected = time.perf_counter()
+        if stats is not None:
+            stats.time_to_200.append(connected - started)
+        if args.tls:
+            await writer.start_tls(args.client_context, server_hostname="localhost")
+            if stats is not None:
+                stats.tls_handshakes.append(time.perf_counter() - connected)
+    except BaseException:
+        writer.close()
+        raise
+    return reader, writer
+
+
+async def exchange(args, reader, writer, stats, payload):
+    """Send one payload and wait for the upstream's answer (the echo, or the sink's count)."""
+    async def send():
+        if args.upstream == "sink":
+            writer.write(SINK_HEADER.pack(len(payload)))
+        writer.write(payload)
+        await writer.drain()
+
+    if args.upstream == "echo":
+        _, received = await asyncio.gather(send(), reader.readexactly(len(payload)))
+    else:
+        _, received = await asyncio.gather(send(), reader.readexactly(SINK_HEADER.size))
+    stats.exchanges += 1
+    stats.bytes_sent += len(payload)
+    stats.bytes_received += len(received)
+
+
+async def close_tunnel(writer):
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except (ConnectionError, ssl.SSLError):
+        pass
+
+
+async def client_loop(args, client_id, deadline, stats):
+    """One client: open tunnels and exchange payloads until the deadline."""
+    username = f"user{client_id % args.users}"
+    while time.perf_counter() < deadline:
+        try:
+            reader, writer = await open_tunnel(args, username, stats)
+            try:
+                done = 0
+                while time.perf_counter() < deadline and (args.requests_per_tunnel == 0 or done < args.requests_per_tunnel):
+                    await exchange(args, reader, writer, stats, args.payload_bytes)
+                    done += 1
+                if done:
+                    stats.tunnels += 1
+            finally:
+                await close_tunnel(writer)
+        except Exception as e:
+            stats.errors[str(e) if str(e).startswith("status_") else type(e).__name__] += 1
+            await asyncio.sleep(0.01)
+
+
+async def hold_tunnels(args, count):
+    """Open count idle tunnels (each relayed one small exchange) and keep them open. Returns the writers."""
+    stats = LoadStats()
+    semaphore = asyncio.Semaphore(args.clients)
+
+    async def open_one(i):
+        async with semaphore:
+            reader, writer = await open_tunnel(args, f"user{i % args.users}", None)
+            await exchange(args, reader, writer, stats, b"x" * 64)
+            return writer
+
+    results = await asyncio.gather(*(open_one(i) for i in range(count)), return_exceptions=True)
+    return [r for r in results if not isinstance(r, BaseException)]
+
+
+def percentiles(values):
+    """p50/p90/p99/max in milliseconds, or None without samples."""
+    if not values:
+        return None
+    values = sorted(values)
+    pick = lambda q: values[min(len(values) - 1, int(q * len(values)))] * 1000
+    return {'p50': round(pick(0.50), 3), 'p90': round(pick(0.90), 3), 'p99': round(pick(0.99), 3),
+            'max': round(values[-1] * 1000, 3), 'mean': round(statistics.fmean(values) * 1000, 3)}
+
+
+async def run_load(args, proxy_pid, upstream_pid):
+    # Warm up: authenticate every user once so the scrypt cost is not part of the run
+    warm = await asyncio.gather(*(open_tunnel(args, f"user{i}", None) for i in range(args.users)),
+                                return_exceptions=True)
+    failed = [w for w in warm if isinstance(w, BaseException)]
+    if failed:
+        raise RuntimeError(f"warm-up CONNECT failed: {failed[0]!r}")
+    for _, writer in warm:
+        await close_tunnel(writer)
+
+    stats = LoadStats()
+    proxy_cpu, _ = tree_usage(proxy_pid)
+    upstream_cpu, _ = tree_usage(upstream_pid)
+    harness_cpu = time.process_time()
+    started = time.perf_counter()
+    deadline = started + args.duration
+    await asyncio.gather(*(client_loop(args, i, deadline, stats) for i in range(args.clients)))
+    elapsed = time.perf_counter() - started
+    proxy_cpu = tree_usage(proxy_pid)[0] - proxy_cpu
+    upstream_cpu = tree_usage(upstream_pid)[0] - upstream_cpu
+    harness_cpu = time.process_time() - harness_cpu
+
+    result = {
+        'elapsed_s': round(elapsed, 3),
+        'tunnels': stats.tunnels,
+        'tunnels_per_s': round(stats.tunnels / elapsed, 2),
+        'exchanges': stats.exchanges,
+        'errors': dict(stats.errors),
+        'time_to_200_ms': percentiles(stats.time_to_200),
+        'tls_handshake_ms': percentiles(stats.tls_handshakes),
+        'relay_bytes': stats.bytes_sent + stats.bytes_received,
+        'relay_mb_per_s': round((stats.bytes_sent + stats.bytes_received) / elapsed / (1024 * 1024), 2),
+        'proxy_cpu_percent': round(proxy_cpu / elapsed * 100, 1),
+        'upstream_cpu_percent': round(upstream_cpu / elapsed * 100, 1),
+        'harness_cpu_percent': round(harness_cpu / elapsed * 100, 1),
+    }
+
+    # Memory: RSS with no tunnels, then with --hold idle tunnels open
+    await asyncio.sleep(1)
+    _, rss_idle = tree_usage(proxy_pid)
+    writers = await hold_tunnels(args, args.hold) if args.hold else []
+    await asyncio.sleep(1)
+    _, rss_held = tree_usage(proxy_pid)
+    for writer in writers:
+        await close_tunnel(writer)
+    result.update({
+        'proxy_rss_idle_mb': round(rss_idle / (1024 * 1024), 2),
+        'held_tunnels': len(writers),
+        'proxy_rss_held_mb': round(rss_held / (1024 * 1024), 2),
+        'rss_per_tunnel_kb': round((rss_held - rss_idle) / len(writers) / 1024, 2) if writers else None,
+    })
+    return result
+
+
+# ============================
+# DRIVER
+# ============================
+
+def start_proxy(directory, args):
+    """Start the proxy copy in directory and wait until it answers a CONNECT with 200."""
+    env = dict(os.environ, LISTEN_HOST="127.0.0.1", LISTEN_PORT=str(args.proxy_port), MONITOR_PORT=str(free_port()),
+               PROXY_ACCESS_START_HOUR="0", PROXY_ACCESS_END_HOUR="24", BANDWIDTH_LIMIT_MBPS="0")
+    env.update(args.env)
+    log = open(os.path.join(directory, "stdout.txt"), "w")
+    process = subprocess.Popen([sys.executable, "proxy.py"], cwd=directory, env=env,
+                               stdout=log, stderr=subprocess.STDOUT)
+    token = base64.b64encode(f"user0:{BENCH_PASSWORD}".encode()).decode()
+    deadline = time.monotonic() + READY_TIMEOUT
+    while time.monotonic() < deadline and process.poll() is None:
+        if probe(args.proxy_port, f"127.0.0.1:{args.plain_port}", token) == 200:
+            return process
+        time.sleep(0.05)
+    process.kill()
+    raise RuntimeError(f"proxy did not become ready (see {directory}/stdout.txt)")
+
+
+def parse_env(value):
+    key, sep, setting = value.partition("=")
+    if not sep:
+        raise argparse.ArgumentTypeError("expected KEY=VALUE")
+    return key, setting
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Drive concurrent authenticated CONNECT clients through proxy.py.")
+    parser.add_argument("--clients", type=int, default=50, help="concurrent clients")
+    parser.add_argument("--users", type=int, default=10, help="proxy accounts the clients are spread over")
+    parser.add_argument("--payload", type=int, default=16384, help="bytes sent per exchange")
+    parser.add_argument("--requests-per-tunnel", type=int, default=1, help="exchanges per tunnel (0 = never reconnect)")
+    parser.add_argument("--duration", type=float, default=10, help="seconds of load")
+    parser.add_argument("--upstream", choices=("echo", "sink"), default="echo")
+    parser.add_argument("--tls", action="store_true", help="run TLS to a local self-signed upstream inside each tunnel")
+    parser.add_argument("--hold", type=int, default=200, help="idle tunnels held open to measure RSS per tunnel")
+    parser.add_argument("--env", type=parse_env, action="append", default=[], help="proxy setting KEY=VALUE")
+    parser.add_argument("--proxy", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "proxy.py"))
+    parser.add_argument("--label", default="", help="free-form tag stored with the results")
+    parser.add_argument("--output", default="bench_output.txt", help="file the JSON lines are appended to")
+    parser.add_argument("--keep", action="store_true", help="keep the scratch directory (proxy logs)")
+    args = parser.parse_args()
+    args.env = dict(args.env)
+    args.users = max(1, args.users)
+    args.payload_bytes = os.urandom(args.payload)
+    args.proxy_port = free_port()
+    args.plain_port = free_port()
+    args.tls_port = free_port() if args.tls else None
+    args.target = f"127.0.0.1:{args.tls_port or args.plain_port}"
+
+    directory = tempfile.mkdtemp(prefix="helio_bench_load_")
+    proxy_process = upstream = None
+    try:
+        seed(directory, args.proxy, args.users, 0)
+        certfile = keyfile = None
+        if args.tls:
+            certfile, keyfile = write_self_signed_cert(directory)
+            args.client_context = ssl.create_default_context(cafile=certfile)
+        upstream = multiprocessing.Process(target=run_upstream, daemon=True,
+                                           args=(args.upstream, args.plain_port, args.tls_port, certfile, keyfile))
+        upstream.start()
+        proxy_process = start_proxy(directory, args)
+        result = asyncio.run(run_load(args, proxy_process.pid, upstream.pid))
+    finally:
+        if proxy_process is not None:
+            proxy_process.terminate()
+            try:
+                proxy_process.wait(10)
+            except subprocess.TimeoutExpired:
+                proxy_process.kill()
+        if upstream is not None:
+            upstream.terminate()
+        if args.keep:
+            print(f"Scratch directory kept: {directory}")
+        else:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    record = {
+        'benchmark': 'load', 'label': args.label, 'time': time.time(), 'proxy': os.path.abspath(args.proxy),
+        'clients': args.clients, 'users': args.users, 'payload': args.payload,
+        'requests_per_tunnel': args.requests_per_tunnel, 'duration': args.duration, 'upstream': args.upstream,
+        'tls': args.tls, 'env': args.env, 'cpus': os.cpu_count(),
+    }
+    record.update(result)
+    with open(args.output, "a") as output:
+        output.write(json.dumps(record) + "\n")
+
+    ttfb = result['time_to_200_ms'] or {}
+    print(f"tunnels:        {result['tunnels']} ({result['tunnels_per_s']}/s), {result['exchanges']} exchanges, "
+          f"errors: {result['errors'] or 'none'}")
+    print(f"time to 200:    p50 {ttfb.get('p50')} ms, p90 {ttfb.get('p90')} ms, p99 {ttfb.get('p99')} ms, "
+          f"max {ttfb.get('max')} ms")
+    if result['tls_handshake_ms']:
+        tls = result['tls_handshake_ms']
+        print(f"TLS handshake:  p50 {tls['p50']} ms, p99 {tls['p99']} ms")
+    print(f"relay:          {result['relay_mb_per_s']} MB/s ({result['relay_bytes']:,} bytes)")
+    print(f"CPU:            proxy {result['proxy_cpu_percent']}%, upstream {result['upstream_cpu_percent']}%, "
+          f"clients {result['harness_cpu_percent']}% (of one core, {os.cpu_count()} available)")
+    print(f"memory:         {result['proxy_rss_idle_mb']} MB idle, {result['proxy_rss_held_mb']} MB with "
+          f"{result['held_tunnels']} tunnels open ({result['rss_per_tunnel_kb']} KB per tunnel)")
+    print(f"Appended results to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
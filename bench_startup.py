@@ -0,0 +1,188 @@
+"""Cold-start benchmark for proxy.py.
+
+Seeds a scratch copy of the proxy with a user table and a page cache of the given sizes,
+starts it, and measures from process start to:
+    listen   the listener accepting a TCP connection
+    answer   the first response (407 to an unauthenticated CONNECT)
+    connect  the first authenticated CONNECT answered with 200 (users decrypted)
+
+Usage:
+    python bench_startup.py [--users 1,10000,100000] [--pages 0,10000,100000] [--runs 3]
+                            [--proxy proxy.py] [--output bench_output.txt]
+
+Each run is appended to the output file as one JSON object per line, so results from
+different builds (e.g. --proxy pointing at an older proxy.py) can be compared.
+"""
+import argparse
+import base64
+import json
+import os
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+BENCH_PASSWORD = "bench-password"
+STARTUP_TIMEOUT = 300  # Seconds before a run is given up
+
+# Runs inside the scratch directory, importing the proxy copy to write its own file formats
+SEED_SCRIPT = """
+import contextlib, os, sys
+users, pages = int(sys.argv[1]), int(sys.argv[2])
+import proxy
+with contextlib.redirect_stdout(open(os.devnull, "w")):
+    password_hash = proxy.hash_password(sys.argv[3])
+    proxy.PROXY_USERS = {f"user{i}": password_hash for i in range(users)}
+    proxy.save_users_to_csv()
+    bodies = [os.urandom(2048) for _ in range(64)]
+    for i in range(pages):
+        proxy.cache_manager.cache_page(f"site{i % 997}.example", 80, f"/page/{i}", bodies[i % len(bodies)])
+    proxy.cache_manager._save_cache_async()
+"""
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_echo_server():
+    """Start a local TCP echo server for the benchmark CONNECTs. Returns its port."""
+    server = socket.socket()
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(("127.0.0.1", 0))
+    server.listen(64)
+
+    def echo(conn):
+        with conn:
+            while True:
+                data = conn.recv(65536)
+                if not data:
+                    return
+                conn.sendall(data)
+
+    def serve():
+        while True:
+            conn, _ = server.accept()
+            threading.Thread(target=echo, args=(conn,), daemon=True).start()
+
+    threading.Thread(target=serve, daemon=True).start()
+    return server.getsockname()[1]
+
+
+def read_status(sock):
+    """Read a response head and return its status code, or None if the connection closed first."""
+    head = b""
+    while b"\r\n\r\n" not in head:
+        data = sock.recv(4096)
+        if not data:
+            return None
+        head += data
+    return int(head.split(b" ", 2)[1])
+
+
+def probe(port, target, auth_token):
+    """Send one CONNECT. Returns the status code, or None if the proxy is not up yet."""
+    try:
+        with socket.create_connection(("127.0.0.1", port), timeout=STARTUP_TIMEOUT) as sock:
+            request = f"CONNECT {target} HTTP/1.1\r\nHost: {target}\r\n"
+            if auth_token:
+                request += f"Proxy-Authorization: Basic {auth_token}\r\n"
+            sock.sendall((request + "\r\n").encode())
+            return read_status(sock)
+    except OSError:
+        return None
+
+
+def seed(directory, proxy_path, users, pages):
+    shutil.copy(proxy_path, os.path.join(directory, "proxy.py"))
+    subprocess.run([sys.executable, "-c", SEED_SCRIPT, str(users), str(pages), BENCH_PASSWORD],
+                   cwd=directory, check=True)
+
+
+def measure(directory, echo_port):
+    """Start the proxy in directory and time its startup milestones (seconds)."""
+    port = free_port()
+    env = dict(os.environ, LISTEN_HOST="127.0.0.1", LISTEN_PORT=str(port), MONITOR_PORT=str(free_port()),
+               PROXY_ACCESS_START_HOUR="0", PROXY_ACCESS_END_HOUR="24", PROXY_WORKERS="1")
+    target = f"127.0.0.1:{echo_port}"
+    token = base64.b64encode(f"user0:{BENCH_PASSWORD}".encode()).decode()
+    result = {}
+    with open(os.path.join(directory, "stdout.txt"), "w") as log:
+        started = time.perf_counter()
+        process = subprocess.Popen([sys.executable, "proxy.py"], cwd=directory, env=env,
+                                   stdout=log, stderr=subprocess.STDOUT)
+        try:
+            deadline = started + STARTUP_TIMEOUT
+            while time.perf_counter() < deadline and process.poll() is None:
+                try:
+                    socket.create_connection(("127.0.0.1", port), timeout=1).close()
+                    result['listen'] = time.perf_counter() - started
+                    break
+                except OSError:
+                    time.sleep(0.002)
+            while 'answer' not in result and time.perf_counter() < deadline and process.poll() is None:
+                if probe(port, target, None) is not None:
+                    result['answer'] = time.perf_counter() - started
+            while 'connect' not in result and time.perf_counter() < deadline and process.poll() is None:
+                status = probe(port, target, token)
+                if status == 200:
+                    result['connect'] = time.perf_counter() - started
+                elif status is not None:
+                    raise RuntimeError(f"CONNECT answered {status}")
+                else:
+                    time.sleep(0.002)
+        finally:
+            process.terminate()
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+    if 'connect' not in result:
+        with open(os.path.join(directory, "stdout.txt")) as log:
+            tail = log.read()[-2000:]
+        raise RuntimeError(f"proxy did not accept a CONNECT within {STARTUP_TIMEOUT}s:\n{tail}")
+    return result
+
+
+def parse_counts(value):
+    return [int(v) for v in value.split(",") if v]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure proxy.py cold start against user and page cache counts.")
+    parser.add_argument("--users", type=parse_counts, default=[1, 10000, 100000], help="comma-separated user counts")
+    parser.add_argument("--pages", type=parse_counts, default=[0, 10000, 100000], help="comma-separated cached page counts")
+    parser.add_argument("--runs", type=int, default=3, help="runs per configuration")
+    parser.add_argument("--proxy", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "proxy.py"))
+    parser.add_argument("--output", default="bench_output.txt", help="file the JSON lines are appended to")
+    args = parser.parse_args()
+
+    echo_port = start_echo_server()
+    print(f"{'users':>8} {'pages':>8} {'listen ms':>10} {'answer ms':>10} {'connect ms':>11}")
+    with open(args.output, "a") as output:
+        for users in args.users:
+            for pages in args.pages:
+                directory = tempfile.mkdtemp(prefix="helio_bench_startup_")
+                try:
+                    seed(directory, args.proxy, max(users, 1), pages)
+                    runs = [measure(directory, echo_port) for _ in range(args.runs)]
+                finally:
+                    shutil.rmtree(directory, ignore_errors=True)
+                median = {k: statistics.median(run[k] for run in runs) for k in ('listen', 'answer', 'connect')}
+                print(f"{users:>8} {pages:>8} {median['listen'] * 1000:>10.1f} {median['answer'] * 1000:>10.1f} "
+                      f"{median['connect'] * 1000:>11.1f}")
+                for run in runs:
+                    record = {'benchmark': 'startup', 'proxy': os.path.abspath(args.proxy), 'users': users,
+                              'pages': pages, 'time': time.time()}
+                    record.update({f"{k}_ms": round(v * 1000, 2) for k, v in run.items()})
+                    output.write(json.dumps(record) + "\n")
+
+
+if __name__ == "__main__":
+    main()
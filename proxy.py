@@ -1,1138 +1,6617 @@
-import socket
-import threading
-import base64
-import select
-import time
-import json
-import os
-import csv
-import sys
-from collections import defaultdict
-from cryptography.fernet import Fernet
-from dotenv import load_dotenv
-
-# Load environment variables from .env file
-load_dotenv()
-
-# ============================
-# CONFIGURATION
-# ============================
-
-LISTEN_HOST = os.getenv("LISTEN_HOST", "192.168.124.9")
-LISTEN_PORT = int(os.getenv("LISTEN_PORT", "8080"))
-MONITOR_PORT = int(os.getenv("MONITOR_PORT", "8081"))
-CACHE_TTL = int(os.getenv("CACHE_TTL", "180"))
-SESSION_TIMEOUT = int(os.getenv("SESSION_TIMEOUT", "180"))
-MAX_CACHED_CONNECTIONS = int(os.getenv("MAX_CACHED_CONNECTIONS", "100"))
-CACHE_FILE = os.path.join(os.path.dirname(__file__), "proxy_cache.json")
-CACHE_SAVE_INTERVAL = 60
-USERS_FILE = os.path.join(os.path.dirname(__file__), "proxy_users.csv")
-ENCRYPTION_KEY_FILE = os.path.join(os.path.dirname(__file__), ".proxy_key")
-LOGIN_LOG_FILE = os.path.join(os.path.dirname(__file__), "proxy_login.log")
-USAGE_LOG_FILE = os.path.join(os.path.dirname(__file__), "proxy_usage.log")
-SERVER_LOG_FILE = os.path.join(os.path.dirname(__file__), "proxy_server.log")
-BANDWIDTH_LIMIT_MBPS = int(os.getenv("BANDWIDTH_LIMIT_MBPS", "30"))
-PROXY_ACCESS_START_HOUR = int(os.getenv("PROXY_ACCESS_START_HOUR", "9"))
-PROXY_ACCESS_START_MINUTE = int(os.getenv("PROXY_ACCESS_START_MINUTE", "0"))
-PROXY_ACCESS_END_HOUR = int(os.getenv("PROXY_ACCESS_END_HOUR", "15"))
-PROXY_ACCESS_END_MINUTE = int(os.getenv("PROXY_ACCESS_END_MINUTE", "15"))
-
-# Dictionary of valid users and passwords (loaded from encrypted CSV file on startup)
-PROXY_USERS = {}
-
-# Pre-compute auth tokens for validation (populated after loading users)
-proxy_auth_tokens = {}
-
-# Track active user sessions (one device per user)
-user_sessions = {}  # {username: (device_ip, timestamp, socket_obj, is_active)}
-
-# Track which sessions have been logged to avoid duplicate logs
-logged_sessions = set()  # {(username, device_ip, timestamp)}
-
-# Track data usage per user (username -> total_bytes)
-user_data_usage = {}  # {username: total_bytes_used}
-
-# Flag for remote restart
-restart_requested = False
-restart_lock = threading.Lock()
-
-
-# ============================
-# LOGGING UTILITIES
-# ============================
-
-class DualLogger:
-    """Log to both console and file."""
-    def __init__(self, log_file):
-        self.log_file = log_file
-        self.lock = threading.Lock()
-    
-    def log(self, message):
-        """Log a message to both console and file."""
-        with self.lock:
-            print(message)
-            try:
-                with open(self.log_file, 'a') as f:
-                    f.write(message + "\n")
-            except:
-                pass
-
-server_logger = DualLogger(SERVER_LOG_FILE)
-
-
-# ============================
-# ENCRYPTION UTILITIES
-# ============================
-
-def get_or_create_key():
-    """Get encryption key from file, or create one if it doesn't exist."""
-    if os.path.exists(ENCRYPTION_KEY_FILE):
-        with open(ENCRYPTION_KEY_FILE, 'rb') as f:
-            key_content = f.read().strip()
-            # Handle both binary and text (base64) formats
-            if key_content.startswith(b'-----'):
-                return key_content  # Binary format
-            else:
-                return key_content  # Base64 text format
-    else:
-        key = Fernet.generate_key()
-        with open(ENCRYPTION_KEY_FILE, 'wb') as f:
-            f.write(key)
-        os.chmod(ENCRYPTION_KEY_FILE, 0o600)  # Restrict to user only
-        return key
-
-encryption_key = get_or_create_key()
-try:
-    cipher = Fernet(encryption_key)
-except Exception as e:
-    print(f"[!] Error initializing cipher: {e}")
-    print(f"[!] Encryption key: {encryption_key}")
-    sys.exit(1)
-
-
-def encrypt_text(text):
-    """Encrypt text using Fernet."""
-    return cipher.encrypt(text.encode()).decode()
-
-
-def decrypt_text(encrypted_text):
-    """Decrypt text using Fernet."""
-    try:
-        return cipher.decrypt(encrypted_text.encode()).decode()
-    except:
-        return None
-
-
-def save_users_to_csv():
-    """Save users to encrypted CSV file."""
-    try:
-        with open(USERS_FILE, 'w', newline='') as f:
-            writer = csv.writer(f)
-            writer.writerow(['username', 'password_encrypted'])
-            for username, password in PROXY_USERS.items():
-                encrypted_password = encrypt_text(password)
-                writer.writerow([username, encrypted_password])
-        print(f"[*] Saved {len(PROXY_USERS)} users to encrypted CSV file")
-    except Exception as e:
-        print(f"[!] Error saving users to CSV: {e}")
-
-
-def load_users_from_csv():
-    """Load users from encrypted CSV file."""
-    if not os.path.exists(USERS_FILE):
-        print("[*] No user CSV file found, using default users")
-        return False
-    
-    try:
-        with open(USERS_FILE, 'r') as f:
-            reader = csv.reader(f)
-            next(reader)  # Skip header
-            PROXY_USERS.clear()
-            for row in reader:
-                if len(row) >= 2:
-                    username, encrypted_password = row[0], row[1]
-                    decrypted_password = decrypt_text(encrypted_password)
-                    if decrypted_password:
-                        username_lower = username.lower()
-                        password_lower = decrypted_password.lower()
-                        PROXY_USERS[username_lower] = password_lower
-        
-        # Rebuild auth tokens
-        rebuild_auth_tokens()
-        print(f"[*] Loaded {len(PROXY_USERS)} users from encrypted CSV file")
-        return True
-    except Exception as e:
-        print(f"[!] Error loading users from CSV: {e}")
-        return False
-
-
-def rebuild_auth_tokens():
-    """Rebuild auth tokens from PROXY_USERS."""
-    proxy_auth_tokens.clear()
-    for user, passwd in PROXY_USERS.items():
-        user_lower = user.lower()
-        passwd_lower = passwd.lower()
-        proxy_auth_tokens[base64.b64encode(f"{user_lower}:{passwd_lower}".encode()).decode()] = user_lower
-
-
-def start_user_reload_thread():
-    """Periodically reload users from CSV to pick up new approvals."""
-    last_modified_time = 0
-    
-    def reload_users_periodically():
-        nonlocal last_modified_time
-        while True:
-            try:
-                time.sleep(3)  # Check every 3 seconds for changes
-                
-                # Check if the CSV file has been modified
-                if os.path.exists(USERS_FILE):
-                    current_modified_time = os.path.getmtime(USERS_FILE)
-                    
-                    # If the file has been modified, reload users
-                    if current_modified_time > last_modified_time:
-                        last_modified_time = current_modified_time
-                        load_users_from_csv()
-                        print(f"[*] Reloaded users due to file modification")
-            except Exception as e:
-                print(f"[!] Error in user reload thread: {e}")
-    
-    reload_thread = threading.Thread(target=reload_users_periodically, daemon=True)
-    reload_thread.start()
-    return reload_thread
-
-
-# ============================
-# BANDWIDTH RATE LIMITER
-# ============================
-
-class BandwidthLimiter:
-    """Token bucket rate limiter for global bandwidth control."""
-    def __init__(self, max_bytes_per_second):
-        self.max_bytes_per_second = max_bytes_per_second
-        self.tokens = max_bytes_per_second  # Start with full bucket
-        self.last_refill = time.time()
-        self.lock = threading.Lock()
-    
-    def acquire(self, num_bytes):
-        """Non-blocking rate limit check. Skip limiting if bandwidth is available."""
-        with self.lock:
-            now = time.time()
-            elapsed = now - self.last_refill
-            
-            # Refill tokens based on elapsed time
-            refill_amount = elapsed * self.max_bytes_per_second
-            self.tokens = min(self.max_bytes_per_second, self.tokens + refill_amount)
-            self.last_refill = now
-            
-            # If we have enough tokens, consume them
-            if self.tokens >= num_bytes:
-                self.tokens -= num_bytes
-            # If not enough tokens, still allow (don't block) - just deprioritize
-            else:
-                self.tokens = max(0, self.tokens - num_bytes)
-
-
-# Initialize rate limiter: 30 Mbps = 3,750,000 bytes/second
-rate_limiter = BandwidthLimiter(int(BANDWIDTH_LIMIT_MBPS * 1_000_000 / 8))
-
-
-def log_login(username, device_ip, status="LOGIN"):
-    """Log user login/logout events to file."""
-    try:
-        timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
-        log_entry = f"{timestamp} | {status} | User: {username} | Device: {device_ip}\n"
-        with open(LOGIN_LOG_FILE, 'a') as f:
-            f.write(log_entry)
-        print(f"[*] Logged: {status} - {username} from {device_ip}")
-    except Exception as e:
-        print(f"[!] Error writing login log: {e}")
-
-
-def log_data_usage(username, bytes_used):
-    """Log data usage to file and track in memory."""
-    global user_data_usage
-    try:
-        timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
-        mb_used = bytes_used / (1024 * 1024)
-        log_entry = f"{timestamp} | User: {username} | Data: {bytes_used} bytes ({mb_used:.2f} MB)\n"
-        with open(USAGE_LOG_FILE, 'a') as f:
-            f.write(log_entry)
-        
-        # Track in memory
-        if username not in user_data_usage:
-            user_data_usage[username] = 0
-        user_data_usage[username] += bytes_used
-    except Exception as e:
-        print(f"[!] Error writing usage log: {e}")
-
-
-def is_proxy_access_allowed():
-    """Check if current time is within allowed proxy access hours."""
-    import datetime
-    now = datetime.datetime.now()
-    current_time = (now.hour, now.minute)
-    start_time = (PROXY_ACCESS_START_HOUR, PROXY_ACCESS_START_MINUTE)
-    end_time = (PROXY_ACCESS_END_HOUR, PROXY_ACCESS_END_MINUTE)
-    
-    if start_time <= current_time < end_time:
-        return True
-    return False
-
-
-def check_user_session(username, device_ip, current_socket):
-    """Enforce one device per user. Every connection requires fresh authentication."""
-    global user_sessions, logged_sessions
-    
-    if username in user_sessions:
-        existing_ip, existing_time, existing_socket, is_active = user_sessions[username]
-        time_elapsed = time.time() - existing_time
-        
-        # Same device - ALWAYS require fresh login but don't log again
-        if existing_ip == device_ip:
-            user_sessions[username] = (device_ip, time.time(), current_socket, True)
-            return True, f"Fresh login required for {username} from {device_ip}"
-        
-        # Different device - check if previous session timed out
-        if time_elapsed >= SESSION_TIMEOUT:
-            # Previous session expired, allow new device
-            try:
-                existing_socket.close()
-            except:
-                pass
-            print(f"[*] Previous session for {username} expired after {time_elapsed:.0f}s inactivity")
-            log_login(username, existing_ip, "LOGOUT_TIMEOUT")
-            logged_sessions.discard((username, existing_ip, existing_time))
-            
-            # New session on new device
-            user_sessions[username] = (device_ip, time.time(), current_socket, True)
-            session_key = (username, device_ip, time.time())
-            log_login(username, device_ip, "LOGIN_NEW_DEVICE")
-            logged_sessions.add(session_key)
-            return True, f"New device allowed for {username} (previous session timed out)"
-        else:
-            # Previous session still active - block this new device
-            remaining = SESSION_TIMEOUT - time_elapsed
-            response = b"HTTP/1.1 407 Proxy Authentication Required\r\n"
-            response += b"Proxy-Authenticate: Basic realm=\"Credentials Already In Use\"\r\n"
-            response += b"Connection: close\r\n"
-            response += b"\r\nCredentials already in use on another device. Try again in " + f"{remaining:.0f}s".encode() + b".\r\n"
-            current_socket.sendall(response)
-            current_socket.close()
-            print(f"[!] User {username} already active on {existing_ip}. Blocking device {device_ip} for {remaining:.0f}s")
-            return False, f"User {username} already connected on another device"
-    else:
-        # New session
-        session_time = time.time()
-        user_sessions[username] = (device_ip, session_time, current_socket, True)
-        session_key = (username, device_ip, session_time)
-        log_login(username, device_ip, "LOGIN")
-        logged_sessions.add(session_key)
-        return True, f"New session for {username} from {device_ip}"
-
-
-# ============================
-# CACHING SYSTEM
-# ============================
-
-class CacheManager:
-    """Manages connection pooling and DNS caching with persistent storage."""
-    
-    def __init__(self, ttl=CACHE_TTL, max_connections=MAX_CACHED_CONNECTIONS, cache_file=CACHE_FILE):
-        self.ttl = ttl
-        self.max_connections = max_connections
-        self.cache_file = cache_file
-        self.connection_cache = {}  # {(host, port): (socket, timestamp)}
-        self.dns_cache = {}  # {hostname: (ip, timestamp)}
-        self.page_cache = {}  # {(host, port, path): [(response_data, timestamp), ...]}  - list of versions
-        self.active_clients = {}  # {client_address: (user, timestamp)} - track active connections
-        self.lock = threading.Lock()
-        self.save_thread = None
-        self.should_exit = False
-        
-        # Load cache from disk on startup
-        self.load_cache_from_disk()
-    
-    def load_cache_from_disk(self):
-        """Load cached DNS entries and pages from disk."""
-        if not os.path.exists(self.cache_file):
-            return
-        
-        try:
-            with open(self.cache_file, 'r') as f:
-                data = json.load(f)
-                with self.lock:
-                    # Restore DNS cache
-                    current_time = time.time()
-                    for hostname, (ip, timestamp) in data.get('dns_cache', {}).items():
-                        # Only restore if not expired
-                        if current_time - timestamp < self.ttl:
-                            self.dns_cache[hostname] = (ip, timestamp)
-                    # Restore page cache (pages never expire, store as list of versions)
-                    for page_key, versions in data.get('page_cache', {}).items():
-                        try:
-                            key = tuple(json.loads(page_key))
-                            if isinstance(versions, list):
-                                self.page_cache[key] = versions
-                            else:
-                                # Handle old format (single version)
-                                self.page_cache[key] = [versions]
-                        except:
-                            pass
-                    print(f"[*] Loaded {len(self.dns_cache)} DNS cache entries and {len(self.page_cache)} page cache entries from disk")
-        except Exception as e:
-            print(f"[!] Error loading cache from disk: {e}")
-    
-    def save_cache_to_disk(self):
-        """Save cache to disk asynchronously to avoid blocking."""
-        # Spawn async thread instead of blocking main thread
-        save_thread = threading.Thread(target=self._save_cache_async, daemon=True)
-        save_thread.start()
-    
-    def _save_cache_async(self):
-        """Asynchronously save cache to disk."""
-        try:
-            with self.lock:
-                # Save DNS cache and page cache (convert tuple keys to strings for JSON)
-                page_cache_serializable = {
-                    json.dumps(key): (value, timestamp) 
-                    for key, (value, timestamp) in self.page_cache.items()
-                }
-                data = {
-                    'dns_cache': dict(self.dns_cache),
-                    'page_cache': page_cache_serializable,
-                    'timestamp': time.time()
-                }
-            
-            with open(self.cache_file, 'w') as f:
-                json.dump(data, f, indent=2)
-            print(f"[*] Saved cache to disk ({len(self.dns_cache)} DNS entries, {len(self.page_cache)} page entries)")
-        except Exception as e:
-            print(f"[!] Error saving cache to disk: {e}")
-    
-    def _auto_save_thread(self):
-        """Background thread that periodically saves cache."""
-        while not self.should_exit:
-            time.sleep(CACHE_SAVE_INTERVAL)
-            if not self.should_exit:
-                self.save_cache_to_disk()
-    
-    def start_auto_save(self):
-        """Start the background thread for periodic cache saves."""
-        self.should_exit = False
-        self.save_thread = threading.Thread(target=self._auto_save_thread, daemon=True)
-        self.save_thread.start()
-    
-    def stop_auto_save(self):
-        """Stop the background save thread."""
-        self.should_exit = True
-        if self.save_thread:
-            self.save_thread.join(timeout=2)
-    
-    def get_cached_connection(self, host, port):
-        """Retrieve a cached connection if available and valid."""
-        with self.lock:
-            key = (host, port)
-            if key in self.connection_cache:
-                sock, timestamp = self.connection_cache[key]
-                if time.time() - timestamp < self.ttl:
-                    return sock
-                else:
-                    # Connection expired, close and remove
-                    try:
-                        sock.close()
-                    except:
-                        pass
-                    del self.connection_cache[key]
-        return None
-    
-    def cache_connection(self, host, port, sock):
-        """Cache a connection for future reuse."""
-        with self.lock:
-            # Clean up expired entries if cache is full
-            if len(self.connection_cache) >= self.max_connections:
-                self._cleanup_expired_connections()
-            
-            key = (host, port)
-            self.connection_cache[key] = (sock, time.time())
-    
-    def _cleanup_expired_connections(self):
-        """Remove expired connections from cache."""
-        current_time = time.time()
-        expired_keys = [
-            key for key, (sock, timestamp) in self.connection_cache.items()
-            if current_time - timestamp >= self.ttl
-        ]
-        for key in expired_keys:
-            try:
-                self.connection_cache[key][0].close()
-            except:
-                pass
-            del self.connection_cache[key]
-    
-    def get_cached_dns(self, hostname):
-        """Retrieve a cached DNS lookup if available and valid."""
-        with self.lock:
-            if hostname in self.dns_cache:
-                ip, timestamp = self.dns_cache[hostname]
-                if time.time() - timestamp < self.ttl:
-                    return ip
-                else:
-                    del self.dns_cache[hostname]
-        return None
-    
-    def cache_dns(self, hostname, ip):
-        """Cache a DNS lookup result."""
-        with self.lock:
-            self.dns_cache[hostname] = (ip, time.time())
-    
-    def get_cached_page(self, host, port, path):
-        """Retrieve the newest cached page version (never expires)."""
-        with self.lock:
-            key = (host, port, path)
-            if key in self.page_cache:
-                versions = self.page_cache[key]
-                if versions:
-                    # Return the newest version (last in list)
-                    response, timestamp = versions[-1]
-                    print(f"[*] Found cached page for {host}:{port}{path}")
-                    return response
-        return None
-    
-    def cache_page(self, host, port, path, response_data):
-        """Cache a page response. Keep only the newest and 2nd newest versions."""
-        with self.lock:
-            key = (host, port, path)
-            
-            # Check if page already cached
-            if key in self.page_cache:
-                versions = self.page_cache[key]
-                if versions:
-                    newest_response, _ = versions[-1]
-                    # Compare with newest cached version
-                    if newest_response == response_data:
-                        print(f"[*] Page unchanged for {host}:{port}{path} - keeping cached version")
-                        return  # Don't update if same as newest
-                    else:
-                        print(f"[*] Page updated for {host}:{port}{path} - new version added to cache")
-                # Add new version
-                versions.append((response_data, time.time()))
-                # Keep only newest and 2nd newest (delete oldest if more than 2)
-                if len(versions) > 2:
-                    deleted = versions.pop(0)
-                    print(f"[*] Deleted oldest version for {host}:{port}{path}")
-            else:
-                # First version of this page
-                self.page_cache[key] = [(response_data, time.time())]
-                print(f"[*] Cached new page: {host}:{port}{path}")
-    
-    def clear_cache(self):
-        """Clear all cached connections and DNS entries."""
-        with self.lock:
-            for sock, _ in self.connection_cache.values():
-                try:
-                    sock.close()
-                except:
-                    pass
-            self.connection_cache.clear()
-            self.dns_cache.clear()
-            self.page_cache.clear()
-        # Save empty cache to disk
-        self.save_cache_to_disk()
-
-
-# Initialize global cache manager
-cache_manager = CacheManager()
-
-
-# ============================
-# HTTPS PROXY HANDLER
-# ============================
-
-def handle_client(client_sock, addr):
-    """Handle incoming HTTPS proxy connections."""
-    authenticated_user = None
-    # Read the CONNECT request line
-    request = b""
-    try:
-        while b"\r\n\r\n" not in request:
-            chunk = client_sock.recv(1024)
-            if not chunk:
-                return
-            request += chunk
-        
-        # Parse the request
-        request_str = request.decode('utf-8', errors='ignore')
-        lines = request_str.split("\r\n")
-        first_line = lines[0]
-        
-        # Check if it's a CONNECT request
-        if not first_line.startswith("CONNECT"):
-            client_sock.close()
-            return
-        
-        # Parse host and port
-        parts = first_line.split()
-        if len(parts) < 2:
-            client_sock.close()
-            return
-        
-        host_port = parts[1]
-        try:
-            host, port = host_port.split(":")
-            port = int(port)
-        except:
-            client_sock.close()
-            return
-        
-        # Check authentication
-        auth_header = None
-        for line in lines[1:]:
-            if line.lower().startswith("proxy-authorization:"):
-                auth_header = line.split(":", 1)[1].strip()
-                break
-        
-        if not auth_header or not auth_header.startswith("Basic "):
-            response = b"HTTP/1.1 407 Proxy Authentication Required\r\n"
-            response += b"Proxy-Authenticate: Basic realm=\"Home PC Proxy\"\r\n"
-            response += b"Connection: close\r\n"
-            response += b"\r\n"
-            client_sock.sendall(response)
-            client_sock.close()
-            return
-        
-        token = auth_header.split(" ", 1)[1].strip() if " " in auth_header else ""
-        
-        # Validate token and get username
-        if token not in proxy_auth_tokens:
-            response = b"HTTP/1.1 407 Proxy Authentication Required\r\n"
-            response += b"Proxy-Authenticate: Basic realm=\"Home PC Proxy\"\r\n"
-            response += b"Connection: close\r\n"
-            response += b"\r\n"
-            client_sock.sendall(response)
-            client_sock.close()
-            return
-        
-        authenticated_user = proxy_auth_tokens[token]
-        device_ip = addr[0]
-        server_logger.log(f"[*] Authenticated user: {authenticated_user} from device {device_ip}")
-        
-        # Check if proxy access is allowed at this time
-        if not is_proxy_access_allowed():
-            current_time = time.strftime("%H:%M")
-            response = f"HTTP/1.1 403 Forbidden\r\n"
-            response += f"Connection: close\r\n"
-            response += f"\r\n"
-            response += f"Proxy access is only allowed from {PROXY_ACCESS_START_HOUR}:{PROXY_ACCESS_START_MINUTE:02d} to {PROXY_ACCESS_END_HOUR}:{PROXY_ACCESS_END_MINUTE:02d}. Current time: {current_time}"
-            client_sock.sendall(response.encode())
-            client_sock.close()
-            print(f"[!] Access denied for {authenticated_user} - outside allowed hours ({current_time})")
-            return
-        
-        # Check and manage user sessions (one device per user with 3-minute timeout)
-        with cache_manager.lock:
-            allowed, msg = check_user_session(authenticated_user, device_ip, client_sock)
-            server_logger.log(f"[*] {msg}")
-            if not allowed:
-                # Session check already sent error response and closed socket
-                return
-            cache_manager.active_clients[addr] = (authenticated_user, time.time())
-        
-        try:
-            remote_sock = cache_manager.get_cached_connection(host, port)
-            
-            # If not cached, create new connection
-            if remote_sock is None:
-                # Check DNS cache first
-                resolved_ip = cache_manager.get_cached_dns(host)
-                
-                try:
-                    # Try cached DNS first, with shorter timeout
-                    if resolved_ip:
-                        server_logger.log(f"[*] Using cached DNS for {host} -> {resolved_ip}")
-                        remote_sock = socket.create_connection((resolved_ip, port), timeout=5)
-                    else:
-                        # Use shorter timeout for initial connection attempt
-                        remote_sock = socket.create_connection((host, port), timeout=5)
-                        # Cache the DNS resolution asynchronously (don't wait)
-                        try:
-                            resolved_ip = socket.gethostbyname(host)
-                            cache_manager.cache_dns(host, resolved_ip)
-                            print(f"[*] Cached DNS: {host} -> {resolved_ip}")
-                        except Exception as dns_err:
-                            # DNS cache failed, but connection already succeeded - that's ok
-                            pass
-                except socket.timeout:
-                    response = f"HTTP/1.1 504 Gateway Timeout\r\nConnection: close\r\n\r\n".encode()
-                    client_sock.sendall(response)
-                    client_sock.close()
-                    return
-                except Exception as e:
-                    response = f"HTTP/1.1 502 Bad Gateway\r\nConnection: close\r\n\r\n".encode()
-                    client_sock.sendall(response)
-                    client_sock.close()
-                    return
-            else:
-                print(f"[*] Using cached connection to {host}:{port}")
-            
-            # Send 200 response
-            response = b"HTTP/1.1 200 Connection Established\r\n\r\n"
-            client_sock.sendall(response)
-            
-            # Tunnel data bidirectionally (pass authenticated_user to check if deleted)
-            tunnel(client_sock, remote_sock, host, port, authenticated_user)
-        
-        except Exception as e:
-            print(f"[Error] {e}")
-        finally:
-            # Mark session as inactive on disconnect and log only once
-            if authenticated_user:
-                device_ip = addr[0]
-                with cache_manager.lock:
-                    if addr in cache_manager.active_clients:
-                        del cache_manager.active_clients[addr]
-                    # Mark session as inactive but keep it for 3-minute timeout
-                    if authenticated_user in user_sessions:
-                        stored_ip, stored_time, stored_socket, is_active = user_sessions[authenticated_user]
-                        if stored_ip == device_ip and is_active:  # Only log if was active
-                            user_sessions[authenticated_user] = (stored_ip, stored_time, stored_socket, False)
-                            session_key = (authenticated_user, device_ip, stored_time)
-                            if session_key in logged_sessions:
-                                log_login(authenticated_user, device_ip, "DISCONNECT")
-                                logged_sessions.discard(session_key)
-            try:
-                client_sock.close()
-            except:
-                pass
-    
-    except Exception as e:
-        print(f"[Error in handle_client] {e}")
-        try:
-            client_sock.close()
-        except:
-            pass
-
-
-def tunnel(client, remote, host, port, authenticated_user):
-    """Tunnel data bidirectionally and check if user still exists. Cache connection if reusable."""
-    connection_reusable = True
-    check_interval = 0
-    
-    try:
-        while True:
-            # Only check if user still exists every 10 iterations (not every select)
-            check_interval += 1
-            if check_interval % 10 == 0:
-                if authenticated_user not in PROXY_USERS:
-                    print(f"[!] User {authenticated_user} was deleted. Disconnecting.")
-                    log_login(authenticated_user, "0.0.0.0", "DISCONNECT_USER_DELETED_MID_SESSION")
-                    return
-            
-            readable, _, exceptional = select.select([client, remote], [], [client, remote], 1)
-            
-            if exceptional:
-                break
-            
-            for sock in readable:
-                try:
-                    data = sock.recv(4096)
-                    if not data:
-                        return
-                    
-                    # Apply bandwidth rate limiting (non-blocking)
-                    rate_limiter.acquire(len(data))
-                    
-                    # Log data usage
-                    log_data_usage(authenticated_user, len(data))
-                    
-                    if sock is client:
-                        remote.sendall(data)
-                    else:
-                        client.sendall(data)
-                except:
-                    connection_reusable = False
-                    return
-    except:
-        connection_reusable = False
-    finally:
-        try:
-            client.close()
-        except:
-            pass
-        
-        # Cache the remote connection for reuse if it's still valid
-        if connection_reusable:
-            try:
-                # Don't test the connection - just cache it if we got through tunnel without errors
-                # Testing with empty send() can break some proxy servers
-                cache_manager.cache_connection(host, port, remote)
-                print(f"[*] Cached connection for {host}:{port}")
-            except:
-                try:
-                    remote.close()
-                except:
-                    pass
-        else:
-            try:
-                remote.close()
-            except:
-                pass
-
-
-def start_monitor_server():
-    """Start a monitoring server for remote cache/activity viewing."""
-    monitor_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    monitor_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    try:
-        monitor_sock.bind((LISTEN_HOST, MONITOR_PORT))
-        monitor_sock.listen(1)
-        monitor_sock.settimeout(1.0)  # 1 second timeout to check restart flag
-        server_logger.log(f"[*] Monitor server started on {LISTEN_HOST}:{MONITOR_PORT}")
-    except Exception as e:
-        print(f"[!] Failed to start monitor server: {e}")
-        return
-    
-    while True:
-        try:
-            # Check if restart was requested
-            with restart_lock:
-                if restart_requested:
-                    print(f"[*] Monitor server detected restart signal, shutting down...")
-                    break
-            
-            client_sock, addr = monitor_sock.accept()
-            server_logger.log(f"[*] Monitor connection from {addr[0]}:{addr[1]}")
-            threading.Thread(target=handle_monitor_request, args=(client_sock,), daemon=True).start()
-        except socket.timeout:
-            continue  # Timeout expired, loop will check restart flag
-        except Exception as e:
-            print(f"[!] Monitor error: {e}")
-
-
-def handle_monitor_request(client_sock):
-    """Handle a monitoring request."""
-    global restart_requested
-    try:
-        # Read full request
-        request = client_sock.recv(1024).decode('utf-8', errors='ignore').strip()
-        parts = request.split()
-        
-        if not parts:
-            response = "No command received.\n"
-            client_sock.sendall(response.encode())
-            return
-        
-        command = parts[0].upper()
-        
-        if command == "STATUS":
-            # Build status response
-            with cache_manager.lock:
-                dns_count = len(cache_manager.dns_cache)
-                page_count = len(cache_manager.page_cache)
-                conn_count = len(cache_manager.connection_cache)
-                active_count = len(cache_manager.active_clients)
-            
-            # Check if current time is within allowed access hours
-            accepting_status = "YES" if is_proxy_access_allowed() else "NO"
-            
-            response = f"""PROXY STATUS
-============
-Accepting Clients: {accepting_status}
-DNS Cache Entries: {dns_count}
-Cached Pages: {page_count}
-Active Connections: {conn_count}
-Active Clients: {active_count}
-Cache File: {CACHE_FILE}
-"""
-            client_sock.sendall(response.encode())
-        
-        elif command == "CLIENTS":
-            # List active clients
-            with cache_manager.lock:
-                clients_info = list(cache_manager.active_clients.items())
-            
-            if not clients_info:
-                response = "No active clients.\n"
-            else:
-                response = "ACTIVE CLIENTS\n==============\n"
-                for addr, (user, timestamp) in clients_info:
-                    age = int(time.time() - timestamp)
-                    response += f"{addr[0]}:{addr[1]} - User: {user} (connected {age}s ago)\n"
-            
-            client_sock.sendall(response.encode())
-        
-        elif command == "ADDUSER":
-            if len(parts) < 3:
-                response = "Usage: ADDUSER username password\n"
-                client_sock.sendall(response.encode())
-                return
-            
-            username = parts[1].lower()
-            password = parts[2].lower()
-            
-            if username in PROXY_USERS:
-                response = f"User '{username}' already exists.\n"
-            else:
-                PROXY_USERS[username] = password
-                # Rebuild auth tokens
-                proxy_auth_tokens.clear()
-                for user, passwd in PROXY_USERS.items():
-                    proxy_auth_tokens[base64.b64encode(f"{user}:{passwd}".encode()).decode()] = user
-                save_users_to_csv()  # Save to encrypted CSV
-                response = f"User '{username}' added successfully with password '{password}'.\n"
-                print(f"[*] Added user: {username}:{password}")
-            
-            client_sock.sendall(response.encode())
-        
-        elif command == "DELUSER":
-            if len(parts) < 2:
-                response = "Usage: DELUSER username\n"
-                client_sock.sendall(response.encode())
-                return
-            
-            username = parts[1].lower()
-            
-            if username not in PROXY_USERS:
-                response = f"User '{username}' does not exist.\n"
-            else:
-                del PROXY_USERS[username]
-                # Rebuild auth tokens
-                proxy_auth_tokens.clear()
-                for user, passwd in PROXY_USERS.items():
-                    proxy_auth_tokens[base64.b64encode(f"{user}:{passwd}".encode()).decode()] = user
-                save_users_to_csv()  # Save to encrypted CSV
-                
-                # Disconnect any active sessions for this user
-                global user_sessions
-                if username in user_sessions:
-                    stored_ip, _, stored_socket, _ = user_sessions[username]
-                    try:
-                        stored_socket.close()
-                        print(f"[*] Forcefully disconnected active session for deleted user: {username} from {stored_ip}")
-                        log_login(username, stored_ip, "DISCONNECT_USER_DELETED")
-                    except:
-                        pass
-                    del user_sessions[username]
-                
-                response = f"User '{username}' deleted successfully and disconnected if active.\n"
-                print(f"[*] Deleted user: {username}")
-            
-            client_sock.sendall(response.encode())
-        
-        elif command == "LISTUSERS":
-            response = "VALID PROXY USERS\n=================\n"
-            with cache_manager.lock:
-                for user, passwd in PROXY_USERS.items():
-                    response += f"{user}:{passwd}\n"
-            
-            client_sock.sendall(response.encode())
-        
-        elif command == "CACHE":
-            # Send full cache data as JSON
-            with cache_manager.lock:
-                data = {
-                    'dns_cache': dict(cache_manager.dns_cache),
-                    'page_cache_count': len(cache_manager.page_cache),
-                    'connection_count': len(cache_manager.connection_cache),
-                    'timestamp': time.time()
-                }
-            client_sock.sendall(json.dumps(data, indent=2).encode())
-        
-        elif command == "LOGINLOG":
-            # Display login log
-            if os.path.exists(LOGIN_LOG_FILE):
-                try:
-                    with open(LOGIN_LOG_FILE, 'r') as f:
-                        log_content = f.read()
-                    response = "LOGIN/LOGOUT LOG\n================\n" + log_content
-                except Exception as e:
-                    response = f"Error reading login log: {e}\n"
-            else:
-                response = "No login log file found.\n"
-            client_sock.sendall(response.encode())
-        
-        elif command == "USAGE":
-            # Show data usage for all users or specific user
-            if len(parts) > 1:
-                # Specific user
-                username = parts[1].lower()
-                if username in user_data_usage:
-                    bytes_used = user_data_usage[username]
-                    gb_used = bytes_used / (1024 * 1024 * 1024)
-                    response = f"Data Usage for {username}\n========================\n"
-                    response += f"Total: {bytes_used:,} bytes ({gb_used:.3f} GB)\n"
-                else:
-                    response = f"No data usage recorded for user '{username}'.\n"
-            else:
-                # All users
-                response = "DATA USAGE (Current Session)\n============================\n"
-                if user_data_usage:
-                    for user, bytes_used in sorted(user_data_usage.items(), key=lambda x: x[1], reverse=True):
-                        gb_used = bytes_used / (1024 * 1024 * 1024)
-                        mb_used = (bytes_used % (1024 * 1024 * 1024)) / (1024 * 1024)
-                        response += f"{user}: {bytes_used:,} bytes ({gb_used:.2f} GB)\n"
-                else:
-                    response = "No data usage recorded.\n"
-            client_sock.sendall(response.encode())
-        
-        elif command == "USAGELOG":
-            # Display usage log from file (last 30 days)
-            if os.path.exists(USAGE_LOG_FILE):
-                try:
-                    import datetime
-                    thirty_days_ago = datetime.datetime.now() - datetime.timedelta(days=30)
-                    
-                    with open(USAGE_LOG_FILE, 'r') as f:
-                        lines = f.readlines()
-                    
-                    # Filter for last 30 days
-                    recent_lines = []
-                    for line in lines:
-                        try:
-                            date_str = line.split(" |")[0]
-                            entry_date = datetime.datetime.strptime(date_str, "%Y-%m-%d %H:%M:%S")
-                            if entry_date >= thirty_days_ago:
-                                recent_lines.append(line)
-                        except:
-                            recent_lines.append(line)
-                    
-                    if recent_lines:
-                        response = "DATA USAGE LOG (Last 30 Days)\n============================\n"
-                        response += "".join(recent_lines[-100:])  # Show last 100 entries
-                    else:
-                        response = "No usage data in the last 30 days.\n"
-                except Exception as e:
-                    response = f"Error reading usage log: {e}\n"
-            else:
-                response = "No usage log file found.\n"
-            client_sock.sendall(response.encode())
-        
-        elif command == "LOGS":
-            # Display server logs
-            if os.path.exists(SERVER_LOG_FILE):
-                try:
-                    with open(SERVER_LOG_FILE, 'r') as f:
-                        log_content = f.read()
-                    response = "SERVER LOGS\n===========\n" + log_content
-                except Exception as e:
-                    response = f"Error reading server log: {e}\n"
-            else:
-                response = "No server log file found.\n"
-            client_sock.sendall(response.encode())
-        
-        elif command == "HELP":
-            response = """PROXY MONITOR COMMANDS
-======================
-STATUS        - Show proxy status
-CLIENTS       - List active connected clients
-ADDUSER u p   - Add new user (username password)
-DELUSER u     - Delete user (username)
-LISTUSERS     - List all valid users
-CACHE         - Show cache data (JSON)
-LOGS          - Show login/logout history
-LOGINLOG      - Show login/logout history
-USAGE         - Show current session data usage for all users
-USAGE u       - Show current session data usage for specific user
-USAGELOG      - Show data usage log (last 30 days)
-RESTART       - Remotely restart the proxy server
-HELP          - Show this help message
-"""
-            client_sock.sendall(response.encode())
-        
-        elif command == "RESTART":
-            response = "Proxy server restarting...\n"
-            client_sock.sendall(response.encode())
-            with restart_lock:
-                restart_requested = True
-            print(f"[*] Remote restart requested")
-            time.sleep(0.5)  # Give client time to receive response
-        
-        else:
-            response = f"Unknown command: {command}\nType 'HELP' for available commands.\n"
-            client_sock.sendall(response.encode())
-    
-    except Exception as e:
-        print(f"[!] Monitor request error: {e}")
-    finally:
-        try:
-            client_sock.close()
-        except:
-            pass
-
-
-
-def start_proxy():
-    """Start the HTTPS proxy server."""
-    # Load users from encrypted CSV file on startup
-    if not load_users_from_csv():
-        # If no CSV exists, save default users
-        save_users_to_csv()
-    
-    server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    server_sock.bind((LISTEN_HOST, LISTEN_PORT))
-    server_sock.listen(5)
-    server_sock.settimeout(1.0)  # 1 second timeout to check restart flag
-    
-    server_logger.log(f"[*] HTTPS Proxy Server with Persistent Caching")
-    server_logger.log(f"[*] Listening on {LISTEN_HOST}:{LISTEN_PORT}")
-    server_logger.log(f"[*] Monitor listening on {LISTEN_HOST}:{MONITOR_PORT}")
-    server_logger.log(f"[*] Cache TTL: {CACHE_TTL} seconds")
-    server_logger.log(f"[*] Cache file: {CACHE_FILE}")
-    server_logger.log(f"[*] Users file: {USERS_FILE} (encrypted)")
-    server_logger.log(f"[*] Auto-save interval: {CACHE_SAVE_INTERVAL} seconds")
-    server_logger.log(f"[*] Max cached connections: {MAX_CACHED_CONNECTIONS}")
-    server_logger.log(f"[*] Valid users:")
-    for user, passwd in PROXY_USERS.items():
-        server_logger.log(f"     - {user}:{passwd}")
-    server_logger.log(f"[*] Ready to accept connections...")
-    
-    # Start auto-save thread
-    cache_manager.start_auto_save()
-    
-    # Start user reload thread (checks every 30 seconds for new approved users)
-    start_user_reload_thread()
-    
-    # Start monitor server
-    monitor_thread = threading.Thread(target=start_monitor_server, daemon=True)
-    monitor_thread.start()
-    
-    try:
-        while True:
-            # Check if restart was requested
-            with restart_lock:
-                if restart_requested:
-                    print(f"[*] Proxy server detected restart signal, shutting down...")
-                    break
-            
-            try:
-                client_sock, addr = server_sock.accept()
-                server_logger.log(f"[*] Connection from {addr[0]}:{addr[1]}")
-                threading.Thread(target=handle_client, args=(client_sock, addr), daemon=True).start()
-            except socket.timeout:
-                continue  # Timeout expired, loop will check restart flag
-    except KeyboardInterrupt:
-        print("\n[*] Shutting down...")
-        cache_manager.stop_auto_save()
-        cache_manager.save_cache_to_disk()
-    finally:
-        server_sock.close()
-
-
-def main_loop():
-    """Main loop that handles restarts."""
-    global restart_requested
-    while True:
-        try:
-            # Reset the restart flag before starting
-            with restart_lock:
-                restart_requested = False
-            start_proxy()
-        except Exception as e:
-            print(f"[!] Proxy crashed: {e}")
-            print(f"[*] Restarting in 2 seconds...")
-            time.sleep(2)
-
-
-if __name__ == "__main__":
-    main_loop()
+import asyncio
+import socket
+import threading
+import base64
+import select
+import time
+import json
+import os
+import csv
+import sys
+import errno
+import queue
+import atexit
+import subprocess
+import tempfile
+import signal
+import ipaddress
+import re
+import bisect
+import heapq
+import ctypes
+import hashlib
+import hmac
+import email.utils
+import mmap
+import struct
+from collections import defaultdict, deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from urllib.parse import urlsplit
+from multiprocessing import reduction
+from multiprocessing.connection import Listener, Client
+from cryptography.fernet import Fernet
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+# ============================
+# CONFIGURATION
+# ============================
+
+LISTEN_HOST = os.getenv("LISTEN_HOST", "192.168.124.9")
+LISTEN_PORT = int(os.getenv("LISTEN_PORT", "8080"))
+MONITOR_PORT = int(os.getenv("MONITOR_PORT", "8081"))
+CACHE_TTL = int(os.getenv("CACHE_TTL", "180"))
+SESSION_TIMEOUT = int(os.getenv("SESSION_TIMEOUT", "180"))
+MAX_CACHED_CONNECTIONS = int(os.getenv("MAX_CACHED_CONNECTIONS", "100"))  # Warm upstream pool size
+WARM_POOL_IDLE_TIMEOUT = int(os.getenv("WARM_POOL_IDLE_TIMEOUT", "30"))  # Recycle idle warm sockets before upstreams drop them
+WARM_POOL_MAX_PER_DESTINATION = int(os.getenv("WARM_POOL_MAX_PER_DESTINATION", "4"))
+WARM_POOL_MAX_DESTINATIONS = 20
+WARM_POOL_MIN_RATE = 0.05  # CONNECTs per second before a destination gets warm connections
+DESTINATION_TRACKED = int(os.getenv("DESTINATION_TRACKED", "200"))  # Heavy-hitter counters per time bucket
+DESTINATION_BUCKET_SECONDS = 60
+DESTINATION_WINDOW_BUCKETS = 60  # Sliding window of one hour
+CACHE_FILE = os.path.join(os.path.dirname(__file__), "proxy_cache.bin")
+LEGACY_CACHE_FILE = os.path.join(os.path.dirname(__file__), "proxy_cache.json")  # Migrated on first load
+CACHE_BLOB_DIR = os.path.join(os.path.dirname(__file__), "proxy_cache_blobs")
+PAGE_CACHE_MAX_MB = float(os.getenv("PAGE_CACHE_MAX_MB", "256"))  # Budget for distinct cached bodies
+PAGE_CACHE_TTL = int(os.getenv("PAGE_CACHE_TTL", "0"))  # Seconds before a cached page expires (0 = never)
+PAGE_CACHE_POLICY = os.getenv("PAGE_CACHE_POLICY", "lru").lower()  # "lru" or "lfu"
+HTTP_KEEPALIVE_TIMEOUT = int(os.getenv("HTTP_KEEPALIVE_TIMEOUT", "30"))  # Idle seconds before closing a plain-HTTP client
+HTTP_CACHE_MAX_OBJECT_BYTES = int(float(os.getenv("HTTP_CACHE_MAX_OBJECT_MB", "16")) * 1024 * 1024)
+HTTP_MAX_HEADER_BYTES = 65536
+HTTP_MAX_REQUEST_BODY_BYTES = int(float(os.getenv("HTTP_MAX_REQUEST_BODY_MB", "1")) * 1024 * 1024)  # Buffered GET/HEAD request body cap
+HTTP_HEURISTIC_MAX_AGE = 86400  # Cap on freshness guessed from Last-Modified
+HTTP_FORWARD_THREADS = 64  # Worker threads serving plain-HTTP clients in the asyncio engine
+CACHE_SAVE_INTERVAL = 60
+USERS_FILE = os.path.join(os.path.dirname(__file__), "proxy_users.csv")
+ENCRYPTION_KEY_FILE = os.path.join(os.path.dirname(__file__), ".proxy_key")
+LOGIN_LOG_FILE = os.path.join(os.path.dirname(__file__), "proxy_login.log")
+USAGE_LOG_FILE = os.path.join(os.path.dirname(__file__), "proxy_usage.log")
+SERVER_LOG_FILE = os.path.join(os.path.dirname(__file__), "proxy_server.log")
+USAGE_TOTALS_FILE = os.path.join(os.path.dirname(__file__), "proxy_usage_totals.json")
+USAGE_FLUSH_INTERVAL = int(os.getenv("USAGE_FLUSH_INTERVAL", "10"))
+USAGE_ROLLUP_FILE = os.path.join(os.path.dirname(__file__), "proxy_usage_rollups.json")
+USAGE_ROLLUP_DAYS = int(os.getenv("USAGE_ROLLUP_DAYS", "400"))  # Daily usage buckets kept for USAGELOG queries
+USAGE_ROLLUP_HOURS = 14 * 24  # Hourly usage buckets kept
+USAGE_ROLLUP_SAVE_INTERVAL = 60
+QUOTA_FILE = os.path.join(os.path.dirname(__file__), "proxy_quotas.json")
+QUOTA_DAILY_MB = float(os.getenv("QUOTA_DAILY_MB", "0"))  # Default per-user daily quota (0 = none)
+QUOTA_MONTHLY_MB = float(os.getenv("QUOTA_MONTHLY_MB", "0"))  # Default per-user monthly quota (0 = none)
+QUOTA_ACTION = os.getenv("QUOTA_ACTION", "refuse").lower()  # Over quota: refuse (403, close tunnels) or throttle
+QUOTA_THROTTLE_KBPS = float(os.getenv("QUOTA_THROTTLE_KBPS", "256"))  # Per-user rate once over quota (throttle mode)
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(10 * 1024 * 1024)))  # Rotate log files above this size
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", "5"))
+LOG_FLUSH_INTERVAL = 1.0
+BANDWIDTH_LIMIT_MBPS = int(os.getenv("BANDWIDTH_LIMIT_MBPS", "30"))
+BANDWIDTH_PER_USER_MBPS = float(os.getenv("BANDWIDTH_PER_USER_MBPS", "0"))  # 0 = fair share only
+BANDWIDTH_PER_CONNECTION_MBPS = float(os.getenv("BANDWIDTH_PER_CONNECTION_MBPS", "0"))  # 0 = fair share only
+BANDWIDTH_REBALANCE_INTERVAL = 0.5
+PROXY_WORKERS = int(os.getenv("PROXY_WORKERS", "0"))  # >1 runs a supervisor with N SO_REUSEPORT workers
+WORKER_ID = int(os.environ["PROXY_WORKER_ID"]) if os.getenv("PROXY_WORKER_ID") else None  # Set by the supervisor
+WORKER_SYNC_INTERVAL = 1.0
+HANDOVER_TIMEOUT = 30  # Seconds a new process gets to take over after RESTART HANDOVER
+HANDOVER_DRAIN_TIMEOUT = int(os.getenv("HANDOVER_DRAIN_TIMEOUT", "3600"))  # Max seconds the old process keeps draining
+PROXY_KEEPER = os.getenv("PROXY_KEEPER", "1" if os.getpid() == 1 else "0") == "1"  # Thin parent that keeps the PID across handovers
+DNS_NEGATIVE_TTL = int(os.getenv("DNS_NEGATIVE_TTL", "10"))  # Seconds to cache failed lookups
+DNS_PREFETCH_MIN_HITS = 2  # Lookups since last refresh before a name is refreshed in the background
+DNS_MAX_ENTRIES = 10000
+PROXY_ACCESS_START_HOUR = int(os.getenv("PROXY_ACCESS_START_HOUR", "9"))
+PROXY_ACCESS_START_MINUTE = int(os.getenv("PROXY_ACCESS_START_MINUTE", "0"))
+PROXY_ACCESS_END_HOUR = int(os.getenv("PROXY_ACCESS_END_HOUR", "15"))
+PROXY_ACCESS_END_MINUTE = int(os.getenv("PROXY_ACCESS_END_MINUTE", "15"))
+PROXY_ENGINE = os.getenv("PROXY_ENGINE", "threaded").lower()  # "threaded" or "asyncio"
+UPSTREAM_CONNECT_TIMEOUT = 5
+HAPPY_EYEBALLS_DELAY = float(os.getenv("HAPPY_EYEBALLS_DELAY", "0.25"))  # RFC 8305 connection attempt delay
+RELAY_MODE = os.getenv("RELAY_MODE", "copy").lower()  # "copy" or "splice" (Linux zero-copy, falls back to copy)
+RELAY_CHUNK_SIZE = int(os.getenv("RELAY_CHUNK_SIZE", "4096"))  # Bytes per relay read (copy mode and asyncio engine)
+SPLICE_CHUNK_SIZE = 65536  # Default Linux pipe capacity
+PASSWORD_SCRYPT_N = 2 ** 14  # scrypt cost parameters for stored password hashes
+PASSWORD_SCRYPT_R = 8
+PASSWORD_SCRYPT_P = 1
+AUTH_CACHE_SIZE = int(os.getenv("AUTH_CACHE_SIZE", "1024"))  # Verified credentials kept in memory
+AUTH_CACHE_TTL = int(os.getenv("AUTH_CACHE_TTL", "300"))  # Seconds before a verified credential is re-checked
+AUTH_FAILURE_TTL = 5  # Seconds a rejected credential is remembered, so retries don't re-run the KDF
+AUTH_KDF_WORKERS = 2  # Concurrent password hash verifications
+LOCK_STATS = os.getenv("LOCK_STATS", "1") != "0"  # Record wait/hold times per lock for the LOCKS command
+LOCK_STRIPES = 16  # Independently locked shards for hot maps (sessions, DNS, active clients)
+METRICS_LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)  # Seconds
+
+# Dictionary of valid users and their salted password hashes (loaded from encrypted CSV file on startup).
+# Never mutated once published: writers build a new dict and swap the reference under users_write_lock,
+# so readers need no lock and never see a partial table.
+PROXY_USERS = {}
+users_write_lock = threading.Lock()
+user_ciphertexts = {}  # {username: ciphertext of its row in USERS_FILE}, reused when saving unchanged users
+decrypt_memo = {}  # {ciphertext: plaintext} for the rows in USERS_FILE, so reloads only decrypt changed rows
+USER_RELOAD_POLL_INTERVAL = 3  # Seconds between stat checks (the fallback when inotify is unavailable)
+users_ready = threading.Event()  # Set once the user CSV has been decrypted at startup; auth checks wait for it
+USERS_READY_TIMEOUT = int(os.getenv("USERS_READY_TIMEOUT", "30"))  # Longest an early auth check waits for it
+
+# Track data usage per user (username -> total_bytes), persisted by the usage ledger
+user_data_usage = {}  # {username: total_bytes_used}
+
+# Shared state across worker processes (see MULTI-PROCESS WORKERS)
+shared_state = None  # Worker: RPC client for the supervisor's SharedState
+supervisor_state = None  # Supervisor: the SharedState served to workers
+listening_sockets = {}  # {"proxy"/"monitor": socket} bound by this process, passed on by RESTART HANDOVER
+proxy_handover = None  # Old process: the ProxyHandover in progress after RESTART HANDOVER
+# Running under run_keeper(): the socket handovers ask it to start the new process on
+keeper_sock = socket.socket(fileno=int(os.environ.pop("PROXY_KEEPER_FD"))) if os.getenv("PROXY_KEEPER_FD") else None
+
+# Flag for remote restart
+restart_requested = False
+restart_lock = threading.Lock()
+
+
+# ============================
+# LOCK INSTRUMENTATION
+# ============================
+
+class InstrumentedLock:
+    """threading.Lock that records how long callers wait for it and how long it is held.
+
+    An uncontended acquire costs one extra non-blocking try and a clock read; wait time
+    is only measured when that try fails. Counters are updated while the lock is held,
+    so they need no lock of their own.
+    """
+    __slots__ = ('lock', 'acquisitions', 'contended', 'wait_total', 'wait_max',
+                 'hold_total', 'hold_max', 'acquired_at')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.acquisitions = 0
+        self.contended = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.hold_total = 0.0
+        self.hold_max = 0.0
+        self.acquired_at = 0.0
+
+    def acquire(self, blocking=True, timeout=-1):
+        if not self.lock.acquire(False):
+            if not blocking:
+                return False
+            started = time.perf_counter()
+            if not self.lock.acquire(True, timeout):
+                return False
+            waited = time.perf_counter() - started
+            self.contended += 1
+            self.wait_total += waited
+            if waited > self.wait_max:
+                self.wait_max = waited
+        self.acquisitions += 1
+        self.acquired_at = time.perf_counter()
+        return True
+
+    def release(self):
+        held = time.perf_counter() - self.acquired_at
+        self.hold_total += held
+        if held > self.hold_max:
+            self.hold_max = held
+        self.lock.release()
+
+    def locked(self):
+        return self.lock.locked()
+
+    __enter__ = acquire
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+lock_registry = defaultdict(list)  # {name: [InstrumentedLock, ...]}; stripes of one map share a name
+
+
+def make_lock(name):
+    """Return a lock registered under name for the LOCKS report (a plain Lock if LOCK_STATS=0)."""
+    if not LOCK_STATS:
+        return threading.Lock()
+    lock = InstrumentedLock()
+    lock_registry[name].append(lock)
+    return lock
+
+
+def lock_report():
+    """Return {name: counters summed over the name's locks} for every instrumented lock."""
+    report = {}
+    for name, locks in list(lock_registry.items()):
+        totals = {'locks': len(locks), 'acquisitions': 0, 'contended': 0,
+                  'wait_total': 0.0, 'wait_max': 0.0, 'hold_total': 0.0, 'hold_max': 0.0}
+        for lock in locks:
+            totals['acquisitions'] += lock.acquisitions
+            totals['contended'] += lock.contended
+            totals['wait_total'] += lock.wait_total
+            totals['hold_total'] += lock.hold_total
+            totals['wait_max'] = max(totals['wait_max'], lock.wait_max)
+            totals['hold_max'] = max(totals['hold_max'], lock.hold_max)
+        report[name] = totals
+    return report
+
+
+def merge_lock_reports(reports):
+    """Combine lock_report() results from several processes."""
+    merged = {}
+    for report in reports:
+        for name, totals in report.items():
+            combined = merged.setdefault(name, dict(totals, locks=0, acquisitions=0, contended=0,
+                                                    wait_total=0.0, hold_total=0.0))
+            for field in ('locks', 'acquisitions', 'contended', 'wait_total', 'hold_total'):
+                combined[field] += totals[field]
+            for field in ('wait_max', 'hold_max'):
+                combined[field] = max(combined[field], totals[field])
+    return merged
+
+
+def reset_lock_stats():
+    for locks in list(lock_registry.values()):
+        for lock in locks:
+            with lock.lock:
+                lock.reset()
+
+
+def format_lock_report(report):
+    """Render lock counters as the monitor's LOCKS table, most waited-on first."""
+    response = "LOCK CONTENTION\n===============\n"
+    if not report:
+        return response + "Lock instrumentation is disabled (LOCK_STATS=0).\n"
+    response += f"{'Lock':<16} {'Locks':>7} {'Acquires':>10} {'Contended':>9} {'Avg wait':>9} {'Max wait':>9} {'Avg hold':>9} {'Max hold':>9}\n"
+    for name, totals in sorted(report.items(), key=lambda item: -item[1]['wait_total']):
+        acquisitions = totals['acquisitions'] or 1
+        contended = totals['contended'] / acquisitions
+        response += (f"{name:<16} {totals['locks']:>7} {totals['acquisitions']:>10,} {contended:>9.1%} "
+                     f"{totals['wait_total'] / acquisitions * 1e6:>7.1f}us {totals['wait_max'] * 1e3:>7.2f}ms "
+                     f"{totals['hold_total'] / acquisitions * 1e6:>7.1f}us {totals['hold_max'] * 1e3:>7.2f}ms\n")
+    return response
+
+
+# ============================
+# METRICS
+# ============================
+
+class MetricCells:
+    """A vector of numbers accumulated in per-thread cells.
+
+    Each thread only ever adds to its own list, so updates need no lock and are never
+    lost. Reading sums the cells; totals of threads that have exited are folded into
+    `retired` so short-lived connection threads don't accumulate.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.local = threading.local()
+        self.cells = []  # [(thread, values), ...]
+        self.retired = [0] * size
+        self.lock = threading.Lock()  # Only taken when a thread first writes and when reading
+
+    def cell(self):
+        try:
+            return self.local.values
+        except AttributeError:
+            values = self.local.values = [0] * self.size
+            with self.lock:
+                self.cells.append((threading.current_thread(), values))
+            return values
+
+    def totals(self):
+        with self.lock:
+            live = []
+            for thread, values in self.cells:
+                if thread.is_alive():
+                    live.append((thread, values))
+                else:
+                    self.retired = [a + b for a, b in zip(self.retired, values)]
+            self.cells = live
+            totals = list(self.retired)
+            for _, values in live:
+                totals = [a + b for a, b in zip(totals, values)]
+        return totals
+
+
+class Counter:
+    __slots__ = ('cells',)
+
+    def __init__(self):
+        self.cells = MetricCells(1)
+
+    def inc(self, amount=1):
+        self.cells.cell()[0] += amount
+
+    def value(self):
+        return self.cells.totals()[0]
+
+
+class Histogram:
+    """Cumulative-bucket histogram; observe() costs one bisect and three additions."""
+    __slots__ = ('buckets', 'cells')
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.cells = MetricCells(len(self.buckets) + 2)  # Per-bucket counts, +Inf count, sum
+
+    def observe(self, value):
+        cell = self.cells.cell()
+        cell[bisect.bisect_left(self.buckets, value)] += 1
+        cell[-1] += value
+
+    def value(self):
+        totals = self.cells.totals()
+        cumulative = []
+        running = 0
+        for bound, count in zip(self.buckets + (float("inf"),), totals[:-1]):
+            running += count
+            cumulative.append((bound, running))
+        return cumulative, totals[-1], running
+
+
+class GaugeFunc:
+    """Gauge computed when metrics are collected."""
+    __slots__ = ('func',)
+
+    def __init__(self, func):
+        self.func = func
+
+    def value(self):
+        return self.func()
+
+
+class MetricsRegistry:
+    """Named metric families, rendered in OpenMetrics text format for /metrics."""
+    def __init__(self):
+        self.families = OrderedDict()  # {name: (type, help, unit, {label_items: metric})}
+        self.lock = threading.Lock()
+
+    def _series(self, kind, name, help_text, labels, factory, unit=None):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            family = self.families.setdefault(name, (kind, help_text, unit, {}))
+            series = family[3].get(key)
+            if series is None:
+                series = family[3][key] = factory()
+        return series
+
+    def counter(self, name, help_text, **labels):
+        return self._series("counter", name, help_text, labels, Counter)
+
+    def histogram(self, name, help_text, buckets=METRICS_LATENCY_BUCKETS, unit="seconds", **labels):
+        return self._series("histogram", name, help_text, labels, lambda: Histogram(buckets), unit)
+
+    def gauge(self, name, help_text, func, **labels):
+        return self._series("gauge", name, help_text, labels, lambda: GaugeFunc(func))
+
+    def snapshot(self):
+        """Return [(name, type, help, unit, [(label_items, value), ...]), ...] (picklable, for workers)."""
+        with self.lock:
+            families = [(name, kind, help_text, unit, list(series.items()))
+                        for name, (kind, help_text, unit, series) in self.families.items()]
+        snapshot = []
+        for name, kind, help_text, unit, series in families:
+            values = []
+            for labels, metric in series:
+                try:
+                    values.append((labels, metric.value()))
+                except Exception as e:
+                    print(f"[!] Metric {name} failed: {e}")
+            snapshot.append((name, kind, help_text, unit, values))
+        return snapshot
+
+
+def escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_metric_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label_value(value)}"' for name, value in labels) + "}"
+
+
+def format_metric_number(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value)
+
+
+def render_openmetrics(snapshots):
+    """Render [(extra_labels, snapshot), ...] as one OpenMetrics exposition.
+
+    extra_labels (e.g. the worker id) are added to every sample of that snapshot, so
+    families from several processes are merged under a single TYPE/HELP header.
+    """
+    families = OrderedDict()
+    for extra_labels, snapshot in snapshots:
+        for name, kind, help_text, unit, values in snapshot:
+            family = families.setdefault(name, (kind, help_text, unit, []))
+            family[3].extend((tuple(extra_labels) + tuple(labels), value) for labels, value in values)
+
+    lines = []
+    for name, (kind, help_text, unit, values) in families.items():
+        lines.append(f"# TYPE {name} {kind}")
+        if unit:
+            lines.append(f"# UNIT {name} {unit}")
+        lines.append(f"# HELP {name} {help_text}")
+        for labels, value in values:
+            if kind == "counter":
+                lines.append(f"{name}_total{format_metric_labels(labels)} {format_metric_number(value)}")
+            elif kind == "histogram":
+                buckets, total, count = value
+                for bound, cumulative in buckets:
+                    bucket_labels = labels + (("le", format_metric_number(float(bound))),)
+                    lines.append(f"{name}_bucket{format_metric_labels(bucket_labels)} {cumulative}")
+                lines.append(f"{name}_sum{format_metric_labels(labels)} {format_metric_number(total)}")
+                lines.append(f"{name}_count{format_metric_labels(labels)} {count}")
+            else:
+                lines.append(f"{name}{format_metric_labels(labels)} {format_metric_number(value)}")
+    lines.append("# EOF")
+    return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+
+metric_tunnels_opened = metrics.counter("helio_tunnels_opened", "CONNECT tunnels opened.")
+metric_tunnels_closed = metrics.counter("helio_tunnels_closed", "CONNECT tunnels closed.")
+metric_bytes_upstream = metrics.counter("helio_relayed_bytes", "Bytes relayed, by direction.", direction="upstream")
+metric_bytes_downstream = metrics.counter("helio_relayed_bytes", "Bytes relayed, by direction.", direction="downstream")
+metric_dns_resolve = metrics.histogram("helio_dns_resolve_seconds", "Time spent in DNS lookups that missed the cache.")
+metric_upstream_connect = metrics.histogram("helio_upstream_connect_seconds", "Time to connect to an upstream (after DNS).")
+metric_time_to_established = metrics.histogram("helio_time_to_established_seconds",
+                                               "Time from accepting a client to sending 200 Connection Established.")
+connection_counters = {}  # {result: Counter}
+error_counters = {}  # {status code: Counter}
+
+
+def count_error(code):
+    """Count an error status the proxy itself sent to a client (4xx rejections, 5xx upstream failures)."""
+    counter = error_counters.get(code)
+    if counter is None:
+        counter = error_counters[code] = metrics.counter(
+            "helio_client_errors", "Error statuses sent to clients by the proxy.", code=str(code))
+    counter.inc()
+
+
+def count_connection(result, code=None):
+    """Count a client connection as accepted, rejected (4xx sent) or failed (5xx sent)."""
+    counter = connection_counters.get(result)
+    if counter is None:
+        counter = connection_counters[result] = metrics.counter(
+            "helio_client_connections", "Client connections by outcome.", result=result)
+    counter.inc()
+    if code is not None:
+        count_error(code)
+
+
+metrics.gauge("helio_active_tunnels", "CONNECT tunnels currently open.",
+              lambda: metric_tunnels_opened.value() - metric_tunnels_closed.value())
+metrics.gauge("helio_threads", "Live threads in this process.", threading.active_count)
+metrics.gauge("helio_active_clients", "Connected proxy clients.", lambda: len(active_clients))
+metrics.gauge("helio_user_sessions", "User sessions (one device per user).", lambda: len(session_manager))
+metrics.gauge("helio_dns_cache_entries", "Names in the DNS cache.", lambda: len(dns_resolver))
+metrics.gauge("helio_dns_cache_hit_ratio", "Share of DNS lookups answered from the cache.", lambda: dns_resolver.hit_ratio())
+metrics.gauge("helio_warm_connections", "Idle pre-opened upstream connections.", lambda: len(warm_pool))
+metrics.gauge("helio_page_cache_bytes", "Distinct page cache body bytes.", lambda: cache_manager.cached_bytes)
+metrics.gauge("helio_rate_limiter_tokens_bytes", "Global bandwidth token bucket level (negative when in debt).",
+              lambda: rate_limiter.level())
+
+
+# ============================
+# LOGGING UTILITIES
+# ============================
+
+class LogPipeline:
+    """Bounded queue drained by a single writer thread.
+    
+    Callers never touch the disk: submit() is a non-blocking put. The writer keeps one
+    open handle per log file, writes records in batches, flushes once per batch and
+    rotates files past LOG_MAX_BYTES. When the queue is full new records are dropped
+    and counted, and the drop count is reported once the writer catches up.
+    """
+    def __init__(self, max_queue=LOG_QUEUE_SIZE, max_bytes=LOG_MAX_BYTES, backup_count=LOG_BACKUP_COUNT):
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.handles = {}  # {log_file: open file}
+        self.dropped = 0
+        self.dropped_lock = threading.Lock()  # submit() runs on many threads
+        self.writer_thread = None
+        self.start_lock = threading.Lock()
+    
+    def submit(self, log_file, line, console=None):
+        """Queue a line for log_file (may be None) and an optional console message."""
+        if self.writer_thread is None:
+            self.start()
+        try:
+            self.queue.put_nowait((log_file, line, console))
+        except queue.Full:
+            with self.dropped_lock:
+                self.dropped += 1
+    
+    def start(self):
+        """Start the writer thread (once per process)."""
+        with self.start_lock:
+            if self.writer_thread is None:
+                self.writer_thread = threading.Thread(target=self._writer_loop, daemon=True)
+                self.writer_thread.start()
+    
+    def stop(self):
+        """Drain everything still queued and close file handles."""
+        if self.writer_thread is None:
+            return
+        try:
+            self.queue.put((None, None, None), timeout=5)  # Sentinel
+        except queue.Full:
+            return  # Writer is stuck; don't hang shutdown on it
+        self.writer_thread.join(timeout=5)
+    
+    def _writer_loop(self):
+        """Write queued records in batches until the stop sentinel arrives."""
+        while True:
+            try:
+                batch = [self.queue.get(timeout=LOG_FLUSH_INTERVAL)]
+            except queue.Empty:
+                continue
+            try:
+                while len(batch) < 1000:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            
+            stopping = self._write_batch(batch)
+            if stopping:
+                for handle in self.handles.values():
+                    try:
+                        handle.close()
+                    except:
+                        pass
+                self.handles.clear()
+                return
+    
+    def _write_batch(self, batch):
+        """Write one batch of records. Returns True if the stop sentinel was seen."""
+        stopping = False
+        touched = set()
+        with self.dropped_lock:
+            dropped, self.dropped = self.dropped, 0
+        if dropped:
+            print(f"[!] Log queue full, dropped {dropped} log messages")
+        self._reopen_moved_files()
+        for log_file, line, console in batch:
+            if log_file is None and line is None and console is None:
+                stopping = True
+                continue
+            if console is not None:
+                print(console)
+            if log_file is None:
+                continue
+            try:
+                handle = self._get_handle(log_file)
+                handle.write(line + "\n")
+                touched.add(log_file)
+            except Exception as e:
+                print(f"[!] Error writing {log_file}: {e}")
+        for log_file in touched:
+            try:
+                handle = self.handles[log_file]
+                handle.flush()
+                if self.max_bytes and handle.tell() >= self.max_bytes:
+                    self._rotate(log_file)
+            except Exception as e:
+                print(f"[!] Error flushing {log_file}: {e}")
+        return stopping
+    
+    def _get_handle(self, log_file):
+        handle = self.handles.get(log_file)
+        if handle is None:
+            handle = open(log_file, 'a')
+            self.handles[log_file] = handle
+        return handle
+    
+    def _reopen_moved_files(self):
+        """Reopen files another process has rotated or removed (worker processes share logs)."""
+        for log_file, handle in list(self.handles.items()):
+            try:
+                if os.stat(log_file).st_ino == os.fstat(handle.fileno()).st_ino:
+                    continue
+            except FileNotFoundError:
+                pass
+            except Exception:
+                continue
+            handle.close()
+            del self.handles[log_file]
+    
+    def _rotate(self, log_file):
+        """Rotate log_file -> log_file.1 -> ... -> log_file.N."""
+        self.handles.pop(log_file).close()
+        for index in range(self.backup_count - 1, 0, -1):
+            source = f"{log_file}.{index}"
+            if os.path.exists(source):
+                os.replace(source, f"{log_file}.{index + 1}")
+        try:
+            if self.backup_count > 0:
+                os.replace(log_file, f"{log_file}.1")
+            else:
+                os.remove(log_file)
+        except FileNotFoundError:
+            pass  # Another process rotated it first
+
+
+log_pipeline = LogPipeline()
+atexit.register(log_pipeline.stop)
+
+
+class DualLogger:
+    """Log to both console and file through the shared log pipeline."""
+    def __init__(self, log_file):
+        self.log_file = log_file
+    
+    def log(self, message):
+        """Queue a message for both console and file (never blocks on I/O); file lines are timestamped."""
+        log_pipeline.submit(self.log_file, f"{time.strftime('%Y-%m-%d %H:%M:%S')} | {message}", console=message)
+
+server_logger = DualLogger(SERVER_LOG_FILE)
+
+
+# Monitor log views (LOGS/LOGINLOG) read log files in blocks and send matches as they go,
+# so memory stays bounded by the block size and the tail count, not the file size.
+LOG_TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+LOG_TIMESTAMP_LENGTH = 19
+LOG_READ_BLOCK = 65536
+LOG_SEND_CHUNK = 65536
+LOG_FOLLOW_POLL_INTERVAL = 0.5
+
+
+class LogQuery:
+    """Options for a LOGS/LOGINLOG request: [tail N] [since TIME] [user U] [ip X] [follow]."""
+    def __init__(self):
+        self.tail = None
+        self.since = None  # b"YYYY-mm-dd HH:MM:SS"; log timestamps compare correctly as bytes
+        self.user = None
+        self.ip = None
+        self.follow = False
+    
+    @classmethod
+    def parse(cls, args):
+        """Build a query from the words after the command. Raises ValueError on bad input."""
+        query = cls()
+        args = list(args)
+        while args:
+            option = args.pop(0).lower()
+            if option == "follow":
+                query.follow = True
+                continue
+            if not args:
+                raise ValueError(f"Missing value for '{option}'")
+            value = args.pop(0)
+            if option == "tail":
+                query.tail = int(value)
+                if query.tail < 0:
+                    raise ValueError("tail must be >= 0")
+            elif option == "since":
+                if args and re.fullmatch(r"\d{1,2}:\d{2}(:\d{2})?", args[0]):
+                    value += " " + args.pop(0)  # "since 2024-05-01 13:00"
+                query.since = parse_log_since(value).encode()
+            elif option == "user":
+                query.user = re.compile(rb"(?i)(?<![\w.-])" + re.escape(value.encode()) + rb"(?![\w.-])")
+            elif option == "ip":
+                query.ip = re.compile(rb"(?<![\w.:])" + re.escape(value.encode()) + rb"(?![\w.:])")
+            else:
+                raise ValueError(f"Unknown option '{option}'")
+        return query
+    
+    def matches(self, line, timestamp):
+        """timestamp is the line's own, or the last one seen before it for continuation lines."""
+        if self.since is not None and (timestamp is None or timestamp < self.since):
+            return False
+        if self.user is not None and not self.user.search(line):
+            return False
+        if self.ip is not None and not self.ip.search(line):
+            return False
+        return True
+
+
+def parse_log_since(value):
+    """Accept 'YYYY-mm-dd[ HH:MM[:SS]]', 'YYYY-mm-ddTHH:MM[:SS]', epoch seconds or a relative '30m'/'2h'/'7d'."""
+    relative = re.fullmatch(r"(\d+)([smhd])", value.lower())
+    if relative:
+        seconds = int(relative.group(1)) * {"s": 1, "m": 60, "h": 3600, "d": 86400}[relative.group(2)]
+        return time.strftime(LOG_TIMESTAMP_FORMAT, time.localtime(time.time() - seconds))
+    if re.fullmatch(r"\d{9,}(\.\d+)?", value):
+        return time.strftime(LOG_TIMESTAMP_FORMAT, time.localtime(float(value)))
+    value = value.replace("T", " ")
+    for layout in (LOG_TIMESTAMP_FORMAT, "%Y-%m-%d %H:%M", "%Y-%m-%d"):
+        try:
+            return time.strftime(LOG_TIMESTAMP_FORMAT, time.strptime(value, layout))
+        except ValueError:
+            pass
+    raise ValueError(f"Unrecognised time '{value}'")
+
+
+def log_line_timestamp(line):
+    """Return the leading timestamp of a log line as bytes, or None."""
+    stamp = line[:LOG_TIMESTAMP_LENGTH]
+    if len(stamp) == LOG_TIMESTAMP_LENGTH and stamp[4:5] == b"-" and stamp[10:11] == b" " and stamp[:4].isdigit():
+        return stamp
+    return None
+
+
+def log_file_chain(log_file):
+    """The log and its rotated backups, oldest first."""
+    backups = [f"{log_file}.{index}" for index in range(LOG_BACKUP_COUNT, 0, -1)]
+    return [path for path in backups + [log_file] if os.path.exists(path)]
+
+
+def iter_lines_reversed(f, end):
+    """Yield complete lines of f before offset end, newest first, reading fixed-size blocks backwards."""
+    position = end
+    remainder = b""
+    while position > 0:
+        size = min(LOG_READ_BLOCK, position)
+        position -= size
+        f.seek(position)
+        block = f.read(size) + remainder
+        lines = block.split(b"\n")
+        remainder = lines.pop(0)  # May continue in the previous block
+        for line in reversed(lines):
+            if line:
+                yield line + b"\n"
+    if remainder:
+        yield remainder + b"\n"
+
+
+def seek_log_since(f, since, size):
+    """Binary-search a log for the first line stamped at or after since; leaves f at that line."""
+    low, high = 0, size
+    while high - low > LOG_READ_BLOCK:
+        middle = (low + high) // 2
+        f.seek(middle)
+        f.readline()  # Skip the partial line
+        timestamp = None
+        while timestamp is None and f.tell() < high:
+            timestamp = log_line_timestamp(f.readline())
+        if timestamp is None or timestamp >= since:
+            high = middle
+        else:
+            low = middle
+    f.seek(low)
+    if low:
+        f.readline()
+
+
+def tail_log_lines(files, query):
+    """Return the last query.tail matching lines of files [(path, end), ...] (oldest first), reading newest first."""
+    matched = deque()
+    for path, end in reversed(files):
+        with open(path, "rb") as f:
+            pending = []  # Continuation lines, newest first, waiting for the timestamped line before them
+            for line in iter_lines_reversed(f, end):
+                timestamp = log_line_timestamp(line)
+                if timestamp is None and query.since is not None:
+                    pending.append(line)
+                    continue
+                for candidate in pending + [line]:
+                    if len(matched) < query.tail and query.matches(candidate, timestamp):
+                        matched.appendleft(candidate)
+                pending = []
+                if len(matched) >= query.tail or (query.since is not None and timestamp < query.since):
+                    return list(matched)
+    return list(matched)
+
+
+def stream_log(client_sock, log_file, title, query):
+    """Send matching lines of log_file (and its backups) to client_sock in chunks, then follow if asked.
+    
+    Each file is read only up to its size when the request started, so follow picks up
+    exactly where the history ends.
+    """
+    client_sock.sendall(f"{title}\n{'=' * len(title)}\n".encode())
+    files = []
+    identity = None
+    for path in log_file_chain(log_file):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue  # Rotated away meanwhile
+        files.append((path, stat.st_size))
+        if path == log_file:
+            identity = (stat.st_ino, stat.st_dev, stat.st_size)
+    if not files and not query.follow:
+        client_sock.sendall(b"No log file found.\n")
+        return
+    buffer = bytearray()
+    
+    def emit(line):
+        buffer.extend(line)
+        if len(buffer) >= LOG_SEND_CHUNK:
+            client_sock.sendall(buffer)
+            buffer.clear()
+    
+    if query.tail is not None:
+        for line in tail_log_lines(files, query):
+            emit(line)
+    else:
+        for path, end in files:
+            with open(path, "rb") as f:
+                if query.since is not None:
+                    seek_log_since(f, query.since, end)
+                position = f.tell()
+                timestamp = None
+                for line in f:
+                    position += len(line)
+                    if position > end:
+                        break
+                    timestamp = log_line_timestamp(line) or timestamp
+                    if query.matches(line, timestamp):
+                        emit(line)
+    if buffer:
+        client_sock.sendall(buffer)
+    if query.follow:
+        follow_log(client_sock, log_file, query, identity)
+
+
+def follow_log(client_sock, log_file, query, identity=None):
+    """Send lines appended to log_file until the monitor client disconnects. Survives rotation.
+    
+    identity is (inode, device, offset) of the history already sent, or None if there was no file.
+    """
+    f = None
+    timestamp = None
+    partial = b""
+    
+    def drain():
+        """Send everything appended to f so far."""
+        nonlocal timestamp, partial
+        while True:
+            chunk = f.read(LOG_SEND_CHUNK)
+            if not chunk:
+                return
+            lines = (partial + chunk).split(b"\n")
+            partial = lines.pop()  # Incomplete last line waits for the rest
+            out = bytearray()
+            for line in lines:
+                line += b"\n"
+                timestamp = log_line_timestamp(line) or timestamp
+                if query.matches(line, timestamp):
+                    out += line
+            if out:
+                client_sock.sendall(out)
+    
+    try:
+        while True:
+            try:
+                stat = os.stat(log_file)
+                if f is None or (stat.st_ino, stat.st_dev) != identity[:2] or stat.st_size < f.tell():
+                    # First open, rotated or truncated: anything not already sent is new
+                    same_file = f is None and identity is not None and (stat.st_ino, stat.st_dev) == identity[:2]
+                    offset = identity[2] if same_file else 0
+                    if f is not None:
+                        drain()  # Lines written to the old file just before it was rotated
+                        f.close()
+                    f = open(log_file, "rb")
+                    f.seek(offset)
+                    identity = (stat.st_ino, stat.st_dev, offset)
+                    partial = b""
+            except FileNotFoundError:
+                pass
+            if f is not None:
+                drain()
+            # A readable monitor socket means the client sent something or hung up
+            readable, _, _ = select.select([client_sock], [], [], LOG_FOLLOW_POLL_INTERVAL)
+            if readable and not client_sock.recv(1024):
+                return
+    finally:
+        if f is not None:
+            f.close()
+
+
+# ============================
+# ENCRYPTION UTILITIES
+# ============================
+
+def get_or_create_key():
+    """Get encryption key from file, or create one if it doesn't exist."""
+    if os.path.exists(ENCRYPTION_KEY_FILE):
+        with open(ENCRYPTION_KEY_FILE, 'rb') as f:
+            key_content = f.read().strip()
+            # Handle both binary and text (base64) formats
+            if key_content.startswith(b'-----'):
+                return key_content  # Binary format
+            else:
+                return key_content  # Base64 text format
+    else:
+        key = Fernet.generate_key()
+        with open(ENCRYPTION_KEY_FILE, 'wb') as f:
+            f.write(key)
+        os.chmod(ENCRYPTION_KEY_FILE, 0o600)  # Restrict to user only
+        return key
+
+cipher = None  # Created on first use so importing this module touches no files
+cipher_lock = threading.Lock()
+
+
+def get_cipher():
+    """Return the Fernet cipher, reading or creating the key on first use."""
+    global cipher
+    if cipher is None:
+        with cipher_lock:
+            if cipher is None:
+                encryption_key = get_or_create_key()
+                try:
+                    cipher = Fernet(encryption_key)
+                except Exception as e:
+                    print(f"[!] Error initializing cipher: {e}")
+                    print(f"[!] Encryption key: {encryption_key}")
+                    sys.exit(1)
+    return cipher
+
+
+def encrypt_text(text):
+    """Encrypt text using Fernet."""
+    return get_cipher().encrypt(text.encode()).decode()
+
+
+def decrypt_text(encrypted_text):
+    """Decrypt text using Fernet."""
+    cipher = get_cipher()
+    try:
+        return cipher.decrypt(encrypted_text.encode()).decode()
+    except:
+        return None
+
+
+def hash_password(password):
+    """Hash a password with scrypt and a random salt. Returns a self-describing record string."""
+    salt = os.urandom(16)
+    digest = hashlib.scrypt(password.encode(), salt=salt, n=PASSWORD_SCRYPT_N, r=PASSWORD_SCRYPT_R,
+                            p=PASSWORD_SCRYPT_P, dklen=32)
+    return "scrypt${}${}${}${}${}".format(
+        PASSWORD_SCRYPT_N, PASSWORD_SCRYPT_R, PASSWORD_SCRYPT_P,
+        base64.b64encode(salt).decode(), base64.b64encode(digest).decode())
+
+
+def verify_password(password, record):
+    """Check a password against a hash_password() record (slow: runs the KDF)."""
+    try:
+        scheme, n, r, p, salt, expected = record.split("$")
+        if scheme != "scrypt":
+            return False
+        expected = base64.b64decode(expected)
+        digest = hashlib.scrypt(password.encode(), salt=base64.b64decode(salt), n=int(n), r=int(r),
+                                p=int(p), maxmem=128 * int(n) * int(r) * (int(p) + 1) + 1024 * 1024,
+                                dklen=len(expected))
+    except (ValueError, TypeError):
+        return False
+    return hmac.compare_digest(digest, expected)
+
+
+# Verified in place of a missing user's record, so unknown usernames cost the same KDF run
+DUMMY_PASSWORD_HASH = "scrypt${}${}${}${}${}".format(
+    PASSWORD_SCRYPT_N, PASSWORD_SCRYPT_R, PASSWORD_SCRYPT_P,
+    base64.b64encode(bytes(16)).decode(), base64.b64encode(bytes(32)).decode())
+
+
+def is_password_hash(value):
+    return value.startswith("scrypt$")
+
+
+def save_users_to_csv():
+    """Save users to encrypted CSV file (each row holds the encrypted password hash).
+    
+    Rows for unchanged users reuse their existing ciphertext. The file is replaced
+    atomically so the reload watcher never reads a partial file.
+    """
+    try:
+        users = PROXY_USERS
+        rows = []
+        for username, password_hash in users.items():
+            encrypted_password = user_ciphertexts.get(username)
+            if encrypted_password is None or decrypt_memo.get(encrypted_password) != password_hash:
+                encrypted_password = encrypt_text(password_hash)
+                user_ciphertexts[username] = encrypted_password
+                decrypt_memo[encrypted_password] = password_hash
+            rows.append([username, encrypted_password])
+        
+        fd, tmp_path = tempfile.mkstemp(prefix=".proxy_users.", dir=os.path.dirname(os.path.abspath(USERS_FILE)))
+        try:
+            with os.fdopen(fd, 'w', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(['username', 'password_encrypted'])
+                writer.writerows(rows)
+            os.replace(tmp_path, USERS_FILE)
+        except:
+            os.unlink(tmp_path)
+            raise
+        print(f"[*] Saved {len(users)} users to encrypted CSV file")
+    except Exception as e:
+        print(f"[!] Error saving users to CSV: {e}")
+
+
+def publish_users(new_users):
+    """Swap in a new user table and drop cached verifications for changed users. Caller holds users_write_lock.
+    
+    Returns (added, removed, changed) usernames.
+    """
+    global PROXY_USERS
+    old_users = PROXY_USERS
+    PROXY_USERS = new_users
+    
+    added = [username for username in new_users if username not in old_users]
+    removed = [username for username in old_users if username not in new_users]
+    changed = [username for username, password_hash in new_users.items()
+               if username in old_users and old_users[username] != password_hash]
+    for username in removed + changed:
+        auth_cache.invalidate_user(username)
+    if added or changed:
+        auth_cache.clear_failures()
+    return added, removed, changed
+
+
+def add_user(username, password_hash):
+    """Add one user and persist the change. Returns False if the user already exists."""
+    with users_write_lock:
+        if username in PROXY_USERS:
+            return False
+        new_users = dict(PROXY_USERS)
+        new_users[username] = password_hash
+        publish_users(new_users)
+        save_users_to_csv()
+        return True
+
+
+def delete_user(username):
+    """Remove one user and persist the change. Returns False if the user did not exist."""
+    with users_write_lock:
+        if username not in PROXY_USERS:
+            return False
+        new_users = dict(PROXY_USERS)
+        del new_users[username]
+        publish_users(new_users)
+        save_users_to_csv()
+        return True
+
+
+def load_users_from_csv():
+    """Load users from encrypted CSV file and apply the difference to the published table.
+    
+    Only rows whose ciphertext is not in decrypt_memo are decrypted. Rows still holding
+    plaintext passwords are hashed and the file is rewritten.
+    """
+    global decrypt_memo, user_ciphertexts
+    if not os.path.exists(USERS_FILE):
+        print("[*] No user CSV file found, using default users")
+        return False
+    
+    try:
+        with users_write_lock:
+            new_users = {}
+            new_ciphertexts = {}
+            new_memo = {}
+            decrypted = 0
+            migrated = 0
+            with open(USERS_FILE, 'r') as f:
+                reader = csv.reader(f)
+                next(reader)  # Skip header
+                for row in reader:
+                    if len(row) >= 2:
+                        username, encrypted_password = row[0], row[1]
+                        decrypted_password = decrypt_memo.get(encrypted_password)
+                        if decrypted_password is None:
+                            decrypted_password = decrypt_text(encrypted_password)
+                            decrypted += 1
+                        if decrypted_password:
+                            new_memo[encrypted_password] = decrypted_password
+                            username_lower = username.lower()
+                            if not is_password_hash(decrypted_password):
+                                # Legacy row with the password itself
+                                decrypted_password = hash_password(decrypted_password.lower())
+                                migrated += 1
+                            else:
+                                new_ciphertexts[username_lower] = encrypted_password
+                            new_users[username_lower] = decrypted_password
+            
+            # Only ciphertexts still in the file are remembered, so the memo stays bounded
+            decrypt_memo = new_memo
+            user_ciphertexts = new_ciphertexts
+            added, removed, changed = publish_users(new_users)
+            if migrated:
+                print(f"[*] Hashed {migrated} plaintext passwords from the CSV file")
+                save_users_to_csv()
+        print(f"[*] Loaded {len(new_users)} users from encrypted CSV file "
+              f"({len(added)} added, {len(removed)} removed, {len(changed)} changed, {decrypted} decrypted)")
+        return True
+    except Exception as e:
+        print(f"[!] Error loading users from CSV: {e}")
+        return False
+
+
+class InotifyWatcher:
+    """Waits for changes to one file via Linux inotify (through libc, no extra dependency).
+    
+    The parent directory is watched so atomic replacements (rename over the file) are seen.
+    Raises OSError if inotify is unavailable.
+    """
+    IN_CLOSE_WRITE = 0x008
+    IN_MOVED_FROM = 0x040
+    IN_MOVED_TO = 0x080
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    EVENT_HEADER = struct.Struct('iIII')  # wd, mask, cookie, name length
+    
+    def __init__(self, path):
+        self.name = os.path.basename(path).encode()
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            init = libc.inotify_init1
+            add_watch = libc.inotify_add_watch
+        except (OSError, AttributeError) as e:
+            raise OSError(f"inotify not available: {e}")
+        self.fd = init(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        mask = self.IN_CLOSE_WRITE | self.IN_MOVED_FROM | self.IN_MOVED_TO | self.IN_CREATE | self.IN_DELETE
+        directory = os.path.dirname(os.path.abspath(path)).encode()
+        if add_watch(self.fd, directory, mask) < 0:
+            error = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(error, "inotify_add_watch failed")
+    
+    def wait(self, timeout):
+        """Block up to timeout seconds. Returns True if the watched file changed."""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return False
+        changed = False
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return changed
+            offset = 0
+            while offset < len(data):
+                _, _, _, name_len = self.EVENT_HEADER.unpack_from(data, offset)
+                offset += self.EVENT_HEADER.size
+                if data[offset:offset + name_len].rstrip(b"\0") == self.name:
+                    changed = True
+                offset += name_len
+
+
+class VerifiedTokenCache:
+    """Bounded cache of Proxy-Authorization tokens that already passed the password KDF.
+    
+    Entries are keyed by a SHA-256 digest of the token, so raw credentials are never kept,
+    and remember the password hash they were verified against: a hit only counts while
+    PROXY_USERS still holds that hash, so changed or deleted users fail closed even before
+    invalidate_user() runs. Misses are verified on a small thread pool (see verify()).
+    """
+    def __init__(self, max_entries=AUTH_CACHE_SIZE, ttl=AUTH_CACHE_TTL, failure_ttl=AUTH_FAILURE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.failure_ttl = failure_ttl
+        self.verified = OrderedDict()  # {token_digest: (username, password_hash, expires_at)}
+        self.failures = {}  # {token_digest: expires_at}
+        self.lock = make_lock("auth_cache")
+        self.kdf_pool = ThreadPoolExecutor(max_workers=AUTH_KDF_WORKERS, thread_name_prefix="auth-kdf")
+    
+    @staticmethod
+    def _digest(token):
+        return hashlib.sha256(token.encode()).digest()
+    
+    def lookup(self, token):
+        """Fast path. Returns (True, username or None) when the answer is cached, else (False, None)."""
+        key = self._digest(token)
+        now = time.monotonic()
+        with self.lock:
+            entry = self.verified.get(key)
+            if entry is not None:
+                username, password_hash, expires_at = entry
+                if now < expires_at and PROXY_USERS.get(username) == password_hash:
+                    self.verified.move_to_end(key)
+                    return True, username
+                del self.verified[key]
+            failed_until = self.failures.get(key)
+            if failed_until is not None:
+                if now < failed_until:
+                    return True, None
+                del self.failures[key]
+        return False, None
+    
+    def verify(self, token):
+        """Slow path: decode the token and run the KDF. Caches the outcome; returns the username or None."""
+        key = self._digest(token)
+        username = None
+        password_hash = None
+        users = PROXY_USERS
+        try:
+            user, password = base64.b64decode(token, validate=True).decode().split(":", 1)
+            password_hash = users.get(user)
+            if verify_password(password, password_hash or DUMMY_PASSWORD_HASH) and password_hash is not None:
+                username = user
+        except (ValueError, UnicodeDecodeError):
+            pass
+        
+        with self.lock:
+            if username is None:
+                if PROXY_USERS is not users:
+                    return None  # Table swapped during the KDF (the user may just have been added); don't cache
+                if len(self.failures) >= self.max_entries:
+                    self.failures.clear()
+                self.failures[key] = time.monotonic() + self.failure_ttl
+            else:
+                self.verified[key] = (username, password_hash, time.monotonic() + self.ttl)
+                self.verified.move_to_end(key)
+                while len(self.verified) > self.max_entries:
+                    self.verified.popitem(last=False)
+        return username
+    
+    def invalidate_user(self, username):
+        """Forget verified tokens for a user (password changed or user deleted)."""
+        with self.lock:
+            for key in [key for key, entry in self.verified.items() if entry[0] == username]:
+                del self.verified[key]
+    
+    def clear_failures(self):
+        """Forget rejected tokens (a user may have been added)."""
+        with self.lock:
+            self.failures.clear()
+
+
+auth_cache = VerifiedTokenCache()
+
+
+user_reload_thread = None  # Started once per process, not on every RESTART
+
+
+def start_user_reload_thread():
+    """Load users from CSV, then reload them when it changes, to pick up new approvals.
+    
+    The first load runs on this thread too, so the listener is bound before any row is
+    decrypted; auth checks wait on users_ready until it is done. Uses inotify where
+    available and falls back to polling the file's stat signature. Later calls return
+    the thread already running.
+    """
+    global user_reload_thread
+    if user_reload_thread is not None:
+        return user_reload_thread
+    
+    def file_signature():
+        try:
+            stat = os.stat(USERS_FILE)
+            return stat.st_mtime_ns, stat.st_size, stat.st_ino
+        except OSError:
+            return None
+    
+    def reload_users_on_change():
+        last_signature = file_signature()
+        try:
+            watcher = InotifyWatcher(USERS_FILE)
+        except OSError as e:
+            print(f"[*] User file watch falling back to polling every {USER_RELOAD_POLL_INTERVAL}s ({e})")
+            watcher = None
+        started = time.time()
+        try:
+            if not load_users_from_csv():
+                # If no CSV exists, save default users
+                save_users_to_csv()
+                last_signature = file_signature()
+        finally:
+            users_ready.set()
+        server_logger.log(f"[*] {len(PROXY_USERS)} users ready in {time.time() - started:.2f}s")
+        while True:
+            try:
+                if watcher is not None:
+                    notified = watcher.wait(USER_RELOAD_POLL_INTERVAL)
+                    if notified:
+                        # Let a burst of writes settle before reading
+                        time.sleep(0.05)
+                        watcher.wait(0)
+                else:
+                    notified = False
+                    time.sleep(USER_RELOAD_POLL_INTERVAL)
+                
+                signature = file_signature()
+                if signature is not None and (notified or signature != last_signature):
+                    last_signature = signature
+                    load_users_from_csv()
+                    print(f"[*] Reloaded users due to file modification")
+            except Exception as e:
+                print(f"[!] Error in user reload thread: {e}")
+                time.sleep(USER_RELOAD_POLL_INTERVAL)
+    
+    user_reload_thread = threading.Thread(target=reload_users_on_change, daemon=True)
+    user_reload_thread.start()
+    return user_reload_thread
+
+
+# ============================
+# BANDWIDTH RATE LIMITER
+# ============================
+
+def mbps_to_bytes_per_second(mbps):
+    """Convert megabits per second to bytes per second."""
+    return int(mbps * 1_000_000 / 8)
+
+
+class BandwidthLimiter:
+    """Token bucket rate limiter.
+    
+    reserve() always debits the bucket (it may go into debt) and returns how long the
+    caller must wait before sending more, so the lock is only held for the arithmetic
+    and callers can sleep with time.sleep() or asyncio.sleep().
+    """
+    def __init__(self, max_bytes_per_second, burst_seconds=1.0):
+        self.max_bytes_per_second = max_bytes_per_second
+        self.burst_seconds = burst_seconds
+        self.burst = max(int(max_bytes_per_second * burst_seconds), SPLICE_CHUNK_SIZE)
+        self.tokens = self.burst  # Start with full bucket
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+    
+    def _refill(self, now):
+        elapsed = now - self.last_refill
+        self.tokens = min(self.burst, self.tokens + elapsed * self.max_bytes_per_second)
+        self.last_refill = now
+    
+    def reserve(self, num_bytes):
+        """Consume num_bytes and return the delay (seconds) needed to stay under the rate."""
+        if self.max_bytes_per_second <= 0:
+            return 0.0
+        with self.lock:
+            self._refill(time.monotonic())
+            self.tokens -= num_bytes
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.max_bytes_per_second
+    
+    def level(self):
+        """Current token level in bytes (negative while callers are paying off debt)."""
+        with self.lock:
+            self._refill(time.monotonic())
+            return self.tokens
+    
+    def acquire(self, num_bytes):
+        """Blocking rate limit: consume num_bytes and sleep until they fit under the rate."""
+        wait = self.reserve(num_bytes)
+        if wait > 0:
+            time.sleep(wait)
+    
+    def set_rate(self, max_bytes_per_second):
+        """Change the refill rate, keeping tokens earned at the old rate."""
+        with self.lock:
+            self._refill(time.monotonic())
+            self.max_bytes_per_second = max_bytes_per_second
+            self.burst = max(int(max_bytes_per_second * self.burst_seconds), SPLICE_CHUNK_SIZE)
+            self.tokens = min(self.tokens, self.burst)
+
+
+def max_min_share(capacity, demands):
+    """Split capacity max-min fairly across {key: demand}; leftover is shared equally."""
+    allocations = {}
+    remaining = capacity
+    ordered = sorted(demands.items(), key=lambda item: item[1])
+    for index, (key, demand) in enumerate(ordered):
+        share = remaining / (len(ordered) - index)
+        allocations[key] = min(demand, share)
+        remaining -= allocations[key]
+    if allocations and remaining > 0:
+        bonus = remaining / len(allocations)
+        for key in allocations:
+            allocations[key] += bonus
+    return allocations
+
+
+class ShapedUser:
+    """Per-user node in the bandwidth hierarchy."""
+    def __init__(self, username, rate):
+        self.username = username
+        self.bucket = BandwidthLimiter(rate, burst_seconds=0.25)
+        self.flows = set()
+
+
+class ShapedFlow:
+    """Per-connection node in the bandwidth hierarchy."""
+    def __init__(self, shaper, user, rate):
+        self.shaper = shaper
+        self.user = user
+        self.bucket = BandwidthLimiter(rate, burst_seconds=0.25)
+        self.window_bytes = 0
+        self.throttled = False
+    
+    def reserve(self, num_bytes):
+        """Charge the connection, user and global buckets; return the longest wait."""
+        wait = max(
+            self.bucket.reserve(num_bytes),
+            self.user.bucket.reserve(num_bytes),
+            self.shaper.global_bucket.reserve(num_bytes),
+        )
+        self.window_bytes += num_bytes
+        if wait > 0:
+            self.throttled = True
+        return wait
+
+
+class BandwidthShaper:
+    """Hierarchical shaper: global bucket -> per-user buckets -> per-connection buckets.
+    
+    The relay path only touches the three buckets of its own flow. A rebalancer thread
+    periodically re-splits the global rate across active users, and each user's rate
+    across their connections, by max-min fairness: flows that were throttled in the last
+    window are treated as backlogged, the others get their measured rate plus headroom,
+    and capacity nobody is using is shared out equally (a fluid deficit round-robin).
+    """
+    def __init__(self, global_bucket, per_user_cap=0, per_connection_cap=0):
+        self.global_bucket = global_bucket
+        self.per_user_cap = per_user_cap
+        self.per_connection_cap = per_connection_cap
+        self.user_caps = {}  # {username: bytes/s}, e.g. users throttled for exceeding a data quota
+        self.users = {}  # {username: ShapedUser}
+        self.lock = make_lock("bandwidth_shaper")
+        self.rebalance_thread = None
+    
+    def _capped(self, rate, cap):
+        # A rate of 0 means unlimited, so a cap always wins over it
+        return cap if cap > 0 and (rate <= 0 or rate > cap) else rate
+    
+    def _user_cap(self, username):
+        cap = self.user_caps.get(username, 0)
+        if self.per_user_cap > 0:
+            cap = min(cap, self.per_user_cap) if cap > 0 else self.per_user_cap
+        return cap
+    
+    def set_user_cap(self, username, cap):
+        """Cap one user's rate (0 removes the cap). Applied now and kept across rebalances."""
+        with self.lock:
+            if cap > 0:
+                self.user_caps[username] = cap
+            else:
+                self.user_caps.pop(username, None)
+            user = self.users.get(username)
+            if user is None:
+                return
+            if cap <= 0:
+                # The rebalancer restores fair shares; without a global limit it never runs
+                if self.global_bucket.max_bytes_per_second <= 0:
+                    user.bucket.set_rate(self._user_cap(username))
+                    for flow in user.flows:
+                        flow.bucket.set_rate(self.per_connection_cap)
+                return
+            user.bucket.set_rate(self._capped(user.bucket.max_bytes_per_second, cap))
+            for flow in user.flows:
+                flow.bucket.set_rate(self._capped(flow.bucket.max_bytes_per_second, cap))
+    
+    def open_flow(self, username):
+        """Register a tunnel for username and return its flow."""
+        capacity = self.global_bucket.max_bytes_per_second
+        with self.lock:
+            user = self.users.get(username)
+            if user is None:
+                user_rate = self._capped(capacity / (len(self.users) + 1), self._user_cap(username))
+                user = ShapedUser(username, user_rate)
+                self.users[username] = user
+            flow_rate = user.bucket.max_bytes_per_second / (len(user.flows) + 1)
+            flow = ShapedFlow(self, user, self._capped(flow_rate, self.per_connection_cap))
+            user.flows.add(flow)
+        return flow
+    
+    def close_flow(self, flow):
+        """Unregister a tunnel; drop the user node once their last tunnel closes."""
+        with self.lock:
+            user = flow.user
+            user.flows.discard(flow)
+            if not user.flows and self.users.get(user.username) is user:
+                del self.users[user.username]
+    
+    def rebalance(self, interval=BANDWIDTH_REBALANCE_INTERVAL):
+        """Recompute per-user and per-connection rates from the last window's demand."""
+        capacity = self.global_bucket.max_bytes_per_second
+        if capacity <= 0:
+            return
+        with self.lock:
+            users = [(user, list(user.flows)) for user in self.users.values()]
+        if not users:
+            return
+        
+        floor = capacity / (4 * len(users))
+        flow_demands = {}
+        user_demands = {}
+        for user, flows in users:
+            for flow in flows:
+                if flow.throttled:
+                    demand = float('inf')
+                else:
+                    demand = max(flow.window_bytes / interval * 1.25, floor / max(1, len(flows)))
+                flow_demands[flow] = self._capped(demand, self.per_connection_cap)
+                flow.window_bytes = 0
+                flow.throttled = False
+            user_demands[user] = self._capped(sum(flow_demands[flow] for flow in flows), self._user_cap(user.username))
+        
+        user_rates = max_min_share(capacity, user_demands)
+        for user, flows in users:
+            user_rate = self._capped(user_rates[user], self._user_cap(user.username))
+            user.bucket.set_rate(user_rate)
+            flow_rates = max_min_share(user_rate, {flow: flow_demands[flow] for flow in flows})
+            for flow, flow_rate in flow_rates.items():
+                flow.bucket.set_rate(self._capped(flow_rate, self.per_connection_cap))
+    
+    def snapshot(self):
+        """Return [(username, connections, bytes_per_second)] for monitoring."""
+        with self.lock:
+            return [
+                (user.username, len(user.flows), user.bucket.max_bytes_per_second)
+                for user in self.users.values()
+            ]
+    
+    def _rebalance_loop(self):
+        while True:
+            time.sleep(BANDWIDTH_REBALANCE_INTERVAL)
+            try:
+                self.rebalance()
+            except Exception as e:
+                print(f"[!] Bandwidth rebalance error: {e}")
+    
+    def start(self):
+        """Start the background rebalancer (once per process)."""
+        if self.rebalance_thread and self.rebalance_thread.is_alive():
+            return
+        self.rebalance_thread = threading.Thread(target=self._rebalance_loop, daemon=True)
+        self.rebalance_thread.start()
+
+
+# Initialize rate limiter: 30 Mbps = 3,750,000 bytes/second
+rate_limiter = BandwidthLimiter(mbps_to_bytes_per_second(BANDWIDTH_LIMIT_MBPS))
+bandwidth_shaper = BandwidthShaper(
+    rate_limiter,
+    per_user_cap=mbps_to_bytes_per_second(BANDWIDTH_PER_USER_MBPS),
+    per_connection_cap=mbps_to_bytes_per_second(BANDWIDTH_PER_CONNECTION_MBPS),
+)
+
+
+def log_login(username, device_ip, status="LOGIN"):
+    """Log user login/logout events to file (queued, safe to call while holding locks)."""
+    timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
+    log_entry = f"{timestamp} | {status} | User: {username} | Device: {device_ip}"
+    log_pipeline.submit(LOGIN_LOG_FILE, log_entry, console=f"[*] Logged: {status} - {username} from {device_ip}")
+
+
+# ============================
+# USAGE LEDGER
+# ============================
+
+class ConnectionUsage:
+    """Byte counter for a single tunnel."""
+    __slots__ = ('username', 'host', 'port', 'bytes_used', 'bytes_reported', 'started')
+    
+    def __init__(self, username, host, port):
+        self.username = username
+        self.host = host
+        self.port = port
+        self.bytes_used = 0
+        self.bytes_reported = 0  # Portion already counted by destination analytics
+        self.started = time.time()
+
+
+USAGE_LINE_PATTERN = re.compile(rb"^(\d{4}-\d{2}-\d{2}) (\d{2}):\d{2}:\d{2} \| User: (.+?) \| Data: (\d+) bytes")
+
+
+class UsageRollups:
+    """Per-user usage summed into hourly and daily buckets.
+    
+    Buckets are keyed by local "YYYY-mm-dd" / "YYYY-mm-dd HH" strings, and the sorted day
+    list is the time index, so range queries touch days x users instead of log lines.
+    The file also records how far into the usage log the rollups reach; on startup any
+    log past that offset is replayed in one streaming pass, which doubles as the
+    one-time backfill of an existing proxy_usage.log.
+    """
+    def __init__(self, path=USAGE_ROLLUP_FILE, log_file=USAGE_LOG_FILE,
+                 days_kept=USAGE_ROLLUP_DAYS, hours_kept=USAGE_ROLLUP_HOURS):
+        self.path = path
+        self.log_file = log_file
+        self.days_kept = days_kept
+        self.hours_kept = hours_kept
+        self.daily = {}  # {"YYYY-mm-dd": {username: bytes}}
+        self.hourly = {}  # {"YYYY-mm-dd HH": {username: bytes}}
+        self.days = []  # Sorted day keys
+        self.log_offset = 0  # Usage log bytes already folded in
+        self.replaying = False
+        self.replay_offset = 0  # Furthest log offset flushed while replaying
+        self.ready = threading.Event()  # Set once the usage log has been fully folded in
+        self.dirty = False
+        self.last_save = 0
+        self.lock = make_lock("usage_rollups")
+    
+    def load(self):
+        """Restore rollups saved by a previous run, adding to anything counted since startup."""
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+            with self.lock:
+                for buckets, saved in ((self.daily, data.get('daily', {})), (self.hourly, data.get('hourly', {}))):
+                    for key, users in saved.items():
+                        bucket = buckets.setdefault(key, {})
+                        for username, bytes_used in users.items():
+                            bucket[username] = bucket.get(username, 0) + int(bytes_used)
+                self.days = sorted(self.daily)
+                self.log_offset = int(data.get('log_offset', 0))
+            print(f"[*] Loaded usage rollups for {len(self.days)} days from disk")
+        except Exception as e:
+            print(f"[!] Error loading usage rollups: {e}")
+    
+    def _add_locked(self, day, hour, username, bytes_used):
+        users = self.daily.get(day)
+        if users is None:
+            users = self.daily[day] = {}
+            bisect.insort(self.days, day)
+        users[username] = users.get(username, 0) + bytes_used
+        hour_key = f"{day} {hour}"
+        users = self.hourly.get(hour_key)
+        if users is None:
+            users = self.hourly[hour_key] = {}
+        users[username] = users.get(username, 0) + bytes_used
+    
+    def add(self, timestamp, pending, log_offset=None):
+        """Fold one flush ({username: bytes} written at `timestamp`) into the buckets."""
+        day, hour = timestamp[:10], timestamp[11:13]
+        with self.lock:
+            for username, bytes_used in pending.items():
+                self._add_locked(day, hour, username, bytes_used)
+            if log_offset is not None:
+                if self.replaying:
+                    self.replay_offset = max(self.replay_offset, log_offset)
+                else:
+                    self.log_offset = log_offset
+            self.dirty = True
+    
+    def _prune_locked(self):
+        """Drop buckets older than the retention windows."""
+        oldest_day = time.strftime("%Y-%m-%d", time.localtime(time.time() - self.days_kept * 86400))
+        cut = bisect.bisect_left(self.days, oldest_day)
+        for day in self.days[:cut]:
+            del self.daily[day]
+        del self.days[:cut]
+        oldest_hour = time.strftime("%Y-%m-%d %H", time.localtime(time.time() - self.hours_kept * 3600))
+        for hour in [hour for hour in self.hourly if hour < oldest_hour]:
+            del self.hourly[hour]
+    
+    def save(self, force=False):
+        """Persist the rollups (at most every USAGE_ROLLUP_SAVE_INTERVAL seconds unless forced)."""
+        with self.lock:
+            if not self.dirty or self.replaying:
+                return
+            if not force and time.time() - self.last_save < USAGE_ROLLUP_SAVE_INTERVAL:
+                return
+            self._prune_locked()
+            data = {
+                'daily': self.daily,
+                'hourly': self.hourly,
+                'log_offset': self.log_offset,
+                'timestamp': time.time(),
+            }
+            payload = json.dumps(data)
+            self.dirty = False
+            self.last_save = time.time()
+        try:
+            temp_file = self.path + ".tmp"
+            with open(temp_file, 'w') as f:
+                f.write(payload)
+            os.replace(temp_file, self.path)
+        except Exception as e:
+            print(f"[!] Error saving usage rollups: {e}")
+    
+    def start_replay(self):
+        """Load the saved rollups and fold in usage log records written since, in the background.
+        
+        The end of the log is fixed here, before the flusher starts, so records appended
+        later are counted once (by add) and never replayed.
+        """
+        try:
+            end = os.path.getsize(self.log_file)
+        except OSError:
+            end = 0
+        with self.lock:
+            self.replaying = True
+        threading.Thread(target=self._replay, args=(end,), daemon=True).start()
+    
+    def _replay(self, end):
+        """Load the rollups file, then stream log bytes [log_offset, end) into the buckets."""
+        self.load()
+        with self.lock:
+            if end < self.log_offset:
+                self.log_offset = 0  # Log was truncated or replaced; treat it as new
+            start = self.log_offset
+        if end > start:
+            started = time.time()
+            records = 0
+            try:
+                batch = []
+                with open(self.log_file, 'rb') as f:
+                    f.seek(start)
+                    position = start
+                    for line in f:
+                        position += len(line)
+                        if position > end:
+                            break
+                        match = USAGE_LINE_PATTERN.match(line)
+                        if match:
+                            batch.append(match.groups())
+                        if len(batch) >= 10000:
+                            records += self._apply_batch(batch)
+                            batch = []
+                records += self._apply_batch(batch)
+                server_logger.log(f"[*] Usage rollups: replayed {records:,} usage log records "
+                                  f"({(end - start) / (1024 * 1024):.1f} MB) in {time.time() - started:.1f}s")
+            except Exception as e:
+                server_logger.log(f"[!] Error replaying usage log into rollups: {e}")
+        with self.lock:
+            self.replaying = False
+            self.log_offset = max(self.log_offset, end, self.replay_offset)
+            self.dirty = True
+        self.save(force=True)
+        self.ready.set()
+    
+    def _apply_batch(self, batch):
+        with self.lock:
+            for day, hour, username, bytes_used in batch:
+                self._add_locked(day.decode(), hour.decode(), username.decode('utf-8', 'replace'), int(bytes_used))
+        return len(batch)
+    
+    def _recent_days_locked(self, days):
+        """Day keys covering the last `days` days (today included), found via the index."""
+        first = time.strftime("%Y-%m-%d", time.localtime(time.time() - (days - 1) * 86400))
+        return self.days[bisect.bisect_left(self.days, first):]
+    
+    def user_history(self, username, days):
+        """Return [(day, bytes)] for one user over the last `days` days, oldest first."""
+        with self.lock:
+            rows = [(day, self.daily[day].get(username, 0)) for day in self._recent_days_locked(days)]
+        return [row for row in rows if row[1]]
+    
+    def user_hours(self, username, hours):
+        """Return [(hour, bytes)] for one user over the last `hours` hours, oldest first."""
+        first = time.strftime("%Y-%m-%d %H", time.localtime(time.time() - (hours - 1) * 3600))
+        with self.lock:
+            rows = [(hour, users.get(username, 0)) for hour, users in self.hourly.items() if hour >= first]
+        return sorted(row for row in rows if row[1])
+    
+    def top_users(self, days, top_n):
+        """Return the top [(username, bytes)] summed over the last `days` days."""
+        totals = defaultdict(int)
+        with self.lock:
+            for day in self._recent_days_locked(days):
+                for username, bytes_used in self.daily[day].items():
+                    totals[username] += bytes_used
+        return sorted(totals.items(), key=lambda x: x[1], reverse=True)[:top_n]
+    
+    def totals_since(self, first_day):
+        """Return {username: bytes} summed over days from first_day ("YYYY-mm-dd") on."""
+        totals = defaultdict(int)
+        with self.lock:
+            for day in self.days[bisect.bisect_left(self.days, first_day):]:
+                for username, bytes_used in self.daily[day].items():
+                    totals[username] += bytes_used
+        return totals
+    
+    def daily_totals(self, days):
+        """Return [(day, total_bytes, active_users)] over the last `days` days, oldest first."""
+        with self.lock:
+            return [(day, sum(self.daily[day].values()), len(self.daily[day]))
+                    for day in self._recent_days_locked(days)]
+
+
+class UsageLedger:
+    """In-memory usage counters with a background flusher.
+    
+    The relay path only bumps counters. Aggregated per-user records are appended to the
+    usage log every USAGE_FLUSH_INTERVAL seconds (and soon after a disconnect), and
+    running totals are persisted so user_data_usage survives restarts.
+    """
+    def __init__(self, totals, rollups, log_file=USAGE_LOG_FILE, totals_file=USAGE_TOTALS_FILE):
+        self.totals = totals  # {username: total_bytes_used}, shared with user_data_usage
+        self.rollups = rollups
+        self.log_file = log_file
+        self.totals_file = totals_file
+        self.pending = defaultdict(int)  # {username: bytes since last flush}
+        self.connections = set()
+        self.lock = make_lock("usage_ledger")
+        self.flush_event = threading.Event()
+        self.flush_thread = None
+        self.remote = None  # Worker processes forward usage to the supervisor instead of writing files
+        self.quotas = None  # QuotaManager, charged from record()
+        self.totals_loaded = threading.Event()  # Set once totals_file has been read; it is not written before
+    
+    def load_totals(self):
+        """Restore per-user totals persisted by a previous run, adding usage counted since startup."""
+        try:
+            if not os.path.exists(self.totals_file):
+                return
+            with open(self.totals_file, 'r') as f:
+                data = json.load(f)
+            with self.lock:
+                for username, bytes_used in data.get('totals', {}).items():
+                    self.totals[username] = self.totals.get(username, 0) + int(bytes_used)
+            print(f"[*] Loaded usage totals for {len(self.totals)} users from disk")
+        except Exception as e:
+            print(f"[!] Error loading usage totals: {e}")
+        finally:
+            self.totals_loaded.set()
+    
+    def open_connection(self, username, host, port):
+        """Register a tunnel and return its counter."""
+        connection = ConnectionUsage(username, host, port)
+        with self.lock:
+            self.connections.add(connection)
+        return connection
+    
+    def close_connection(self, connection):
+        """Unregister a tunnel and ask the flusher to write its usage soon."""
+        with self.lock:
+            self.connections.discard(connection)
+        self.flush_event.set()
+    
+    def record(self, username, num_bytes, connection=None):
+        """Count bytes for a user (and optionally a tunnel). Hot path: memory only."""
+        with self.lock:
+            self.pending[username] += num_bytes
+            self.totals[username] = self.totals.get(username, 0) + num_bytes
+            if connection is not None:
+                connection.bytes_used += num_bytes
+            if self.quotas is not None:
+                self.quotas.charge(username, num_bytes)
+    
+    def open_connections(self):
+        """Return the currently open tunnel counters."""
+        with self.lock:
+            return list(self.connections)
+    
+    def snapshot_totals(self):
+        """Return a copy of per-user totals."""
+        with self.lock:
+            return dict(self.totals)
+    
+    def flush(self):
+        """Append aggregated records for pending usage and persist totals."""
+        with self.lock:
+            pending = self.pending
+            self.pending = defaultdict(int)
+            totals = dict(self.totals) if self.totals_loaded.is_set() else None
+        if not pending:
+            return
+        
+        if self.remote is not None:
+            try:
+                self.remote.add_usage(dict(pending))
+            except Exception as e:
+                print(f"[!] Error forwarding usage to supervisor: {e}")
+                with self.lock:
+                    for username, bytes_used in pending.items():
+                        self.pending[username] += bytes_used
+            return
+        
+        try:
+            timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
+            lines = []
+            for username, bytes_used in pending.items():
+                mb_used = bytes_used / (1024 * 1024)
+                lines.append(f"{timestamp} | User: {username} | Data: {bytes_used} bytes ({mb_used:.2f} MB)\n")
+            with open(self.log_file, 'a') as f:
+                f.writelines(lines)
+                log_offset = f.tell()
+            self.rollups.add(timestamp, pending, log_offset)
+        except Exception as e:
+            print(f"[!] Error writing usage log: {e}")
+            self.rollups.add(timestamp, pending)
+        self.rollups.save()
+        if totals is None:
+            return  # Still loading; writing now would lose the totals on disk
+        
+        try:
+            temp_file = self.totals_file + ".tmp"
+            with open(temp_file, 'w') as f:
+                json.dump({'totals': totals, 'timestamp': time.time()}, f)
+            os.replace(temp_file, self.totals_file)
+        except Exception as e:
+            print(f"[!] Error saving usage totals: {e}")
+    
+    def _flush_loop(self):
+        """Background thread that flushes on a fixed interval or when signalled."""
+        if self.remote is None and not self.totals_loaded.is_set():
+            self.load_totals()
+        while True:
+            self.flush_event.wait(USAGE_FLUSH_INTERVAL)
+            self.flush_event.clear()
+            self.flush()
+    
+    def start_flusher(self):
+        """Start the background flush thread (once per process)."""
+        if self.flush_thread and self.flush_thread.is_alive():
+            return
+        if self.remote is None:
+            self.rollups.start_replay()
+            atexit.register(self.rollups.save, True)
+        self.flush_thread = threading.Thread(target=self._flush_loop, daemon=True)
+        self.flush_thread.start()
+
+
+usage_ledger = UsageLedger(user_data_usage, UsageRollups())
+
+
+def log_data_usage(username, bytes_used, connection=None):
+    """Track data usage in memory; the usage ledger flushes it to file in the background."""
+    usage_ledger.record(username, bytes_used, connection)
+
+
+# ============================
+# DATA QUOTAS
+# ============================
+
+QUOTA_SIZE_UNITS = {"": 1, "B": 1, "K": 1024, "KB": 1024, "M": 1024 ** 2, "MB": 1024 ** 2,
+                    "G": 1024 ** 3, "GB": 1024 ** 3, "T": 1024 ** 4, "TB": 1024 ** 4}
+
+
+def parse_quota_size(text):
+    """Parse "500M", "2G", "1.5GB" or plain bytes. "0", "off" and "none" mean no limit."""
+    text = text.strip().upper()
+    if text in ("OFF", "NONE"):
+        return 0
+    match = re.match(r"^([\d.]+)\s*([KMGT]?B?)$", text)
+    if not match:
+        raise ValueError(f"Invalid size: {text}")
+    return int(float(match.group(1)) * QUOTA_SIZE_UNITS[match.group(2)])
+
+
+def format_quota_bytes(num_bytes):
+    if not num_bytes:
+        return "none"
+    if num_bytes >= 1024 ** 3:
+        return f"{num_bytes / 1024 ** 3:.2f} GB"
+    return f"{num_bytes / 1024 ** 2:.2f} MB"
+
+
+class QuotaCounter:
+    """Daily and monthly byte counts for one user or group, with its limits."""
+    __slots__ = ('name', 'daily_limit', 'monthly_limit', 'day_bytes', 'month_bytes', 'exceeded', 'accounts')
+    
+    def __init__(self, name):
+        self.name = name
+        self.daily_limit = 0
+        self.monthly_limit = 0
+        self.day_bytes = 0
+        self.month_bytes = 0
+        self.exceeded = False
+        self.accounts = []  # QuotaAccounts charged through this counter
+    
+    def over(self):
+        return ((self.daily_limit > 0 and self.day_bytes >= self.daily_limit) or
+                (self.monthly_limit > 0 and self.month_bytes >= self.monthly_limit))
+    
+    def reason(self):
+        """Describe the limit that is exhausted, or None."""
+        if self.daily_limit > 0 and self.day_bytes >= self.daily_limit:
+            return f"daily quota of {format_quota_bytes(self.daily_limit)}"
+        if self.monthly_limit > 0 and self.month_bytes >= self.monthly_limit:
+            return f"monthly quota of {format_quota_bytes(self.monthly_limit)}"
+        return None
+
+
+class QuotaAccount:
+    """A user's view of every counter that applies to them (their own plus their groups')."""
+    __slots__ = ('username', 'counters', 'exhausted')
+    
+    def __init__(self, username):
+        self.username = username
+        self.counters = []
+        self.exhausted = False  # Read without a lock on the relay path
+
+
+class QuotaManager:
+    """Per-user and per-group daily/monthly byte quotas.
+    
+    Counting piggybacks on UsageLedger.record(), which calls charge() with the ledger
+    lock held, so the relay path pays a dict lookup and a couple of additions per chunk
+    and tunnels only read account.exhausted. Limits and group membership live in
+    QUOTA_FILE. Counters are rebuilt from the usage rollups at startup, so they survive
+    restarts; workers mirror the supervisor's counters on every sync.
+    """
+    def __init__(self, ledger, path=QUOTA_FILE):
+        self.ledger = ledger
+        self.path = path
+        self.lock = ledger.lock  # Shared so charge() needs no lock of its own
+        self.default = {'daily': int(QUOTA_DAILY_MB * 1024 * 1024), 'monthly': int(QUOTA_MONTHLY_MB * 1024 * 1024)}
+        self.users = {}  # {username: {'daily': bytes, 'monthly': bytes}}
+        self.groups = {}  # {group: {'daily': bytes, 'monthly': bytes, 'members': [usernames]}}
+        self.version = 0  # Bumped on every limit change so workers know to pick it up
+        self.user_counters = {}  # {username: QuotaCounter}
+        self.group_counters = {}  # {group: QuotaCounter}
+        self.accounts = {}  # {username: QuotaAccount}
+        self.day = time.strftime("%Y-%m-%d")
+        self.month = self.day[:7]
+        self.remote = None
+        self.maintain_thread = None
+        ledger.quotas = self
+    
+    def load(self):
+        """Restore limits and groups from QUOTA_FILE."""
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+            with self.lock:
+                self._apply_config_locked(data)
+            print(f"[*] Loaded quotas for {len(self.users)} users and {len(self.groups)} groups from disk")
+        except Exception as e:
+            print(f"[!] Error loading quotas: {e}")
+    
+    def config(self):
+        """Return limits and groups as saved in QUOTA_FILE."""
+        with self.lock:
+            return {'default': dict(self.default), 'users': {u: dict(l) for u, l in self.users.items()},
+                    'groups': {g: dict(l, members=list(l['members'])) for g, l in self.groups.items()},
+                    'version': self.version}
+    
+    def save(self):
+        try:
+            temp_file = self.path + ".tmp"
+            with open(temp_file, 'w') as f:
+                json.dump(self.config(), f, indent=2)
+            os.replace(temp_file, self.path)
+        except Exception as e:
+            print(f"[!] Error saving quotas: {e}")
+    
+    def _apply_config_locked(self, data):
+        self.default = {k: int(v) for k, v in data.get('default', self.default).items()}
+        self.users = {u: {k: int(v) for k, v in l.items()} for u, l in data.get('users', {}).items()}
+        self.groups = {g: {'daily': int(l.get('daily', 0)), 'monthly': int(l.get('monthly', 0)),
+                           'members': [m.lower() for m in l.get('members', [])]}
+                       for g, l in data.get('groups', {}).items()}
+        self.version = int(data.get('version', self.version))
+        self._rebuild_locked()
+    
+    def _counter_locked(self, counters, name):
+        counter = counters.get(name)
+        if counter is None:
+            counter = counters[name] = QuotaCounter(name)
+        return counter
+    
+    def _account_locked(self, username):
+        account = self.accounts.get(username)
+        if account is None:
+            account = self.accounts[username] = QuotaAccount(username)
+            self._wire_locked(account)
+            self._set_exhausted_locked(account, any(counter.exceeded for counter in account.counters))
+        return account
+    
+    def _wire_locked(self, account):
+        """Point an account at its own counter and its groups' counters."""
+        counter = self._counter_locked(self.user_counters, account.username)
+        limits = self.users.get(account.username, self.default)
+        counter.daily_limit, counter.monthly_limit = limits.get('daily', 0), limits.get('monthly', 0)
+        counter.exceeded = counter.over()
+        account.counters = [counter] + [self.group_counters[group] for group, limits in self.groups.items()
+                                        if account.username in limits['members']]
+        for counter in account.counters:
+            counter.accounts.append(account)
+    
+    def _rebuild_locked(self):
+        """Re-apply limits and membership to every counter and account after a change."""
+        for username in list(self.users) + [m for limits in self.groups.values() for m in limits['members']]:
+            if username not in self.accounts:
+                self.accounts[username] = QuotaAccount(username)
+        for group in list(self.group_counters):
+            if group not in self.groups:
+                del self.group_counters[group]
+        for group, limits in self.groups.items():
+            counter = self._counter_locked(self.group_counters, group)
+            counter.daily_limit, counter.monthly_limit = limits['daily'], limits['monthly']
+            counter.exceeded = counter.over()
+        for counter in list(self.user_counters.values()) + list(self.group_counters.values()):
+            counter.accounts = []
+        for account in self.accounts.values():
+            self._wire_locked(account)
+        for account in self.accounts.values():
+            self._set_exhausted_locked(account, any(counter.exceeded for counter in account.counters))
+    
+    def _set_exhausted_locked(self, account, exhausted):
+        if account.exhausted == exhausted:
+            return
+        account.exhausted = exhausted
+        if QUOTA_ACTION == "throttle":
+            bandwidth_shaper.set_user_cap(account.username, QUOTA_THROTTLE_KBPS * 1024 if exhausted else 0)
+        if exhausted and self.remote is None:
+            log_login(account.username, "0.0.0.0", "QUOTA_EXCEEDED")
+    
+    def charge(self, username, num_bytes):
+        """Count bytes against username's quotas. Called by UsageLedger.record with its lock held."""
+        account = self.accounts.get(username)
+        if account is None:
+            account = self._account_locked(username)
+        for counter in account.counters:
+            counter.day_bytes += num_bytes
+            counter.month_bytes += num_bytes
+            if not counter.exceeded and counter.over():
+                counter.exceeded = True
+                for member in counter.accounts:
+                    self._set_exhausted_locked(member, True)
+    
+    def account(self, username):
+        """Return username's account; tunnels poll its exhausted flag."""
+        with self.lock:
+            return self.accounts.get(username) or self._account_locked(username)
+    
+    def refusal(self, username):
+        """Return why a new connection for username is refused, or None if it may proceed."""
+        if QUOTA_ACTION != "refuse":
+            return None
+        with self.lock:
+            account = self.accounts.get(username) or self._account_locked(username)
+            if not account.exhausted:
+                return None
+            for counter in account.counters:
+                reason = counter.reason()
+                if reason:
+                    owner = f"group '{counter.name}'" if counter is not account.counters[0] else f"user '{username}'"
+                    return f"The {reason} for {owner} has been used up."
+        return None
+    
+    def set_limit(self, kind, name, period, limit):
+        """Set a daily or monthly limit for a user, a group or the default (0 removes it)."""
+        with self.lock:
+            if kind == "default":
+                self.default[period] = limit
+            elif kind == "user":
+                self.users.setdefault(name, dict(self.default))[period] = limit
+            else:
+                self.groups.setdefault(name, {'daily': 0, 'monthly': 0, 'members': []})[period] = limit
+            self.version += 1
+            self._rebuild_locked()
+        self.save()
+    
+    def clear_user(self, username):
+        """Drop a user's own limits so the defaults apply again."""
+        with self.lock:
+            if self.users.pop(username, None) is None:
+                return False
+            self.version += 1
+            self._rebuild_locked()
+        self.save()
+        return True
+    
+    def set_members(self, group, usernames, add=True):
+        """Add users to (or remove them from) a group."""
+        with self.lock:
+            limits = self.groups.setdefault(group, {'daily': 0, 'monthly': 0, 'members': []})
+            for username in usernames:
+                if add and username not in limits['members']:
+                    limits['members'].append(username)
+                elif not add and username in limits['members']:
+                    limits['members'].remove(username)
+            self.version += 1
+            self._rebuild_locked()
+        self.save()
+    
+    def delete_group(self, group):
+        with self.lock:
+            if self.groups.pop(group, None) is None:
+                return False
+            self.version += 1
+            self._rebuild_locked()
+        self.save()
+        return True
+    
+    def status(self, username):
+        """Return [(label, day_bytes, daily_limit, month_bytes, monthly_limit)] for a user's counters."""
+        with self.lock:
+            account = self.accounts.get(username) or self._account_locked(username)
+            return [(("user " if index == 0 else "group ") + counter.name, counter.day_bytes, counter.daily_limit,
+                     counter.month_bytes, counter.monthly_limit)
+                    for index, counter in enumerate(account.counters)]
+    
+    def exhausted_users(self):
+        with self.lock:
+            return sorted(username for username, account in self.accounts.items() if account.exhausted)
+    
+    def group_status(self):
+        """Return [(group, day_bytes, daily_limit, month_bytes, monthly_limit, members)]."""
+        with self.lock:
+            return [(group, counter.day_bytes, counter.daily_limit, counter.month_bytes, counter.monthly_limit,
+                     list(self.groups[group]['members']))
+                    for group, counter in sorted(self.group_counters.items()) if group in self.groups]
+    
+    def _rollover_locked(self, day):
+        """Start a new day (and month) of counting."""
+        new_month = day[:7] != self.month
+        for counter in list(self.user_counters.values()) + list(self.group_counters.values()):
+            counter.day_bytes = 0
+            if new_month:
+                counter.month_bytes = 0
+        self.day, self.month = day, day[:7]
+        self._rebuild_locked()
+    
+    def seed(self, rollups):
+        """Rebuild counters from the usage rollups plus the ledger's unflushed usage."""
+        day_totals = rollups.totals_since(self.day)
+        month_totals = rollups.totals_since(self.month + "-01")
+        with self.lock:
+            self._seed_locked(day_totals, month_totals, self.ledger.pending)
+    
+    def _seed_locked(self, day_totals, month_totals, pending):
+        for username in set(day_totals) | set(month_totals) | set(pending):
+            self._account_locked(username)
+        for counter in list(self.user_counters.values()) + list(self.group_counters.values()):
+            counter.day_bytes = counter.month_bytes = 0
+        for username, account in self.accounts.items():
+            for counter in account.counters:
+                counter.day_bytes += day_totals.get(username, 0) + pending.get(username, 0)
+                counter.month_bytes += month_totals.get(username, 0) + pending.get(username, 0)
+        self._rebuild_locked()
+    
+    def snapshot(self):
+        """Config and per-user counts served to workers."""
+        config = self.config()
+        with self.lock:
+            return {'config': config, 'day': self.day,
+                    'users': {u: (c.day_bytes, c.month_bytes) for u, c in self.user_counters.items()}}
+    
+    def apply_remote(self, snapshot):
+        """Worker: mirror the supervisor's limits and counts, plus usage not yet forwarded."""
+        with self.lock:
+            if snapshot['config']['version'] != self.version:
+                self._apply_config_locked(snapshot['config'])
+            if snapshot['day'] != self.day:
+                return
+            users = snapshot['users']
+            self._seed_locked({u: d for u, (d, m) in users.items()}, {u: m for u, (d, m) in users.items()},
+                              self.ledger.pending)
+    
+    def _maintain_loop(self):
+        """Load limits, seed counters once the rollups are ready, then roll them over at midnight."""
+        if self.remote is None:
+            self.load()
+            self.ledger.rollups.ready.wait()
+            self.seed(self.ledger.rollups)
+        while True:
+            time.sleep(1)
+            day = time.strftime("%Y-%m-%d")
+            if day != self.day:
+                with self.lock:
+                    self._rollover_locked(day)
+    
+    def start(self):
+        """Start the seeding/rollover thread (once per process)."""
+        if self.maintain_thread and self.maintain_thread.is_alive():
+            return
+        self.maintain_thread = threading.Thread(target=self._maintain_loop, daemon=True)
+        self.maintain_thread.start()
+
+
+quota_manager = QuotaManager(usage_ledger)
+
+
+def build_quota_response(reason):
+    """Build the 403 response sent to users who are over their data quota."""
+    # Encoded first: reason may name a user or group outside ASCII, and Content-Length counts bytes
+    body = f"Data quota exceeded. {reason} Access resumes when the quota resets or is raised by an administrator.".encode()
+    response = f"HTTP/1.1 403 Forbidden\r\n"
+    response += f"Connection: close\r\n"
+    response += f"Content-Type: text/plain; charset=utf-8\r\n"
+    response += f"Content-Length: {len(body)}\r\n"
+    response += f"\r\n"
+    return response.encode() + body
+
+
+# ============================
+# DESTINATION ANALYTICS
+# ============================
+
+class SpaceSaving:
+    """Space-Saving heavy-hitter summary with at most `capacity` counters.
+    
+    When full, a new key replaces the smallest counter and inherits its count as error,
+    so any key's count is overestimated by at most its error and memory never grows.
+    The smallest counter is found through a lazy min-heap: counts only grow, so a heap
+    entry is at most its key's count and stale entries are re-pushed as they surface.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counters = {}  # {key: [count, error]}
+        self.heap = []  # [(count when pushed, key)], one entry per counter
+    
+    def add(self, key, weight=1, error=0):
+        """Add weight to key. Returns the evicted key, if any."""
+        counter = self.counters.get(key)
+        if counter is not None:
+            counter[0] += weight
+            counter[1] += error
+            return None
+        if len(self.counters) < self.capacity:
+            self.counters[key] = [weight, error]
+            heapq.heappush(self.heap, (weight, key))
+            return None
+        while True:
+            floor, victim = self.heap[0]
+            count = self.counters[victim][0]
+            if count == floor:
+                break
+            heapq.heapreplace(self.heap, (count, victim))
+        del self.counters[victim]
+        self.counters[key] = [floor + weight, floor + error]
+        heapq.heapreplace(self.heap, (floor + weight, key))
+        return victim
+    
+    def top(self, n):
+        """Return [(key, count, error)] for the n largest counters."""
+        ranked = sorted(self.counters.items(), key=lambda item: item[1][0], reverse=True)[:n]
+        return [(key, count, error) for key, (count, error) in ranked]
+
+
+class DestinationBucket:
+    """Per-destination bytes, connection counts and connect latencies for one time bucket."""
+    def __init__(self, start, capacity):
+        self.start = start
+        self.bytes = SpaceSaving(capacity)
+        self.connections = SpaceSaving(capacity)
+        self.latency = {}  # {(host, port): [total_seconds, samples]}, only for tracked keys
+    
+    def add_connection(self, key, count=1, error=0, latency_total=0.0, latency_samples=0):
+        victim = self.connections.add(key, count, error)
+        if victim is not None:
+            self.latency.pop(victim, None)
+        if latency_samples:
+            latency = self.latency.setdefault(key, [0.0, 0])
+            latency[0] += latency_total
+            latency[1] += latency_samples
+    
+    def export(self):
+        """Picklable form used to ship a closed bucket from a worker to the supervisor."""
+        return {
+            'bytes': list(self.bytes.counters.items()),
+            'connections': list(self.connections.counters.items()),
+            'latency': dict(self.latency),
+        }
+
+
+class DestinationStats:
+    """Sliding-window per-destination traffic analytics in fixed memory.
+    
+    Traffic is counted into one-minute buckets, each holding Space-Saving summaries, and
+    the last DESTINATION_WINDOW_BUCKETS are kept. Window queries merge the buckets that
+    fall inside the window. Bytes of long-lived tunnels are sampled at every rollover, so
+    they land in the minute they were transferred rather than when the tunnel closes.
+    """
+    def __init__(self, capacity=DESTINATION_TRACKED, bucket_seconds=DESTINATION_BUCKET_SECONDS,
+                 window_buckets=DESTINATION_WINDOW_BUCKETS):
+        self.capacity = capacity
+        self.bucket_seconds = bucket_seconds
+        self.history = deque(maxlen=window_buckets - 1)  # Closed buckets, oldest first
+        self.current = DestinationBucket(time.time(), capacity)
+        self.lock = make_lock("destinations")
+        self.rollover_thread = None
+        self.remote = None  # Worker processes ship closed buckets to the supervisor
+    
+    def record_connect(self, host, port, latency=None):
+        """Count a tunnel to (host, port), with its upstream connect time if it made a new connection."""
+        with self.lock:
+            if latency is None:
+                self.current.add_connection((host, port))
+            else:
+                self.current.add_connection((host, port), latency_total=latency, latency_samples=1)
+    
+    def record_close(self, connection):
+        """Count bytes a closing tunnel moved since the last sample."""
+        with self.lock:
+            delta = connection.bytes_used - connection.bytes_reported
+            connection.bytes_reported = connection.bytes_used
+            if delta:
+                self.current.bytes.add((connection.host, connection.port), delta)
+    
+    def sample_open_connections(self):
+        """Count bytes open tunnels moved since the last sample."""
+        connections = usage_ledger.open_connections()
+        with self.lock:
+            for connection in connections:
+                delta = connection.bytes_used - connection.bytes_reported
+                connection.bytes_reported += delta
+                if delta:
+                    self.current.bytes.add((connection.host, connection.port), delta)
+    
+    def rollover(self):
+        """Close the current bucket and start a new one."""
+        self.sample_open_connections()
+        with self.lock:
+            closed = self.current
+            self.history.append(closed)
+            self.current = DestinationBucket(time.time(), self.capacity)
+        if self.remote is not None:
+            try:
+                self.remote.merge_destinations(closed.export())
+            except Exception as e:
+                print(f"[!] Error forwarding destination stats to supervisor: {e}")
+    
+    def merge(self, exported):
+        """Merge a bucket exported by a worker into the current bucket."""
+        with self.lock:
+            for key, (count, error) in exported['bytes']:
+                self.current.bytes.add(key, count, error)
+            for key, (count, error) in exported['connections']:
+                latency_total, latency_samples = exported['latency'].get(key, (0.0, 0))
+                self.current.add_connection(key, count, error, latency_total, latency_samples)
+    
+    def top(self, metric, n=10, minutes=60):
+        """Return the top n destinations by 'bytes' or 'connections' over the last `minutes`.
+        
+        Rows are dicts with host, port, bytes, connections, error (overestimate bound of
+        the ranked metric) and avg_connect_ms (None if no fresh connects were timed).
+        """
+        cutoff = time.time() - minutes * 60
+        # Closed buckets are never written again, so only the current one is copied under
+        # the lock; the merge runs outside it to keep record_connect/record_close unblocked
+        with self.lock:
+            buckets = [(bucket.bytes.counters, bucket.connections.counters, bucket.latency)
+                       for bucket in self.history if bucket.start >= cutoff]
+            current = self.current
+            buckets.append(({key: tuple(counter) for key, counter in current.bytes.counters.items()},
+                            {key: tuple(counter) for key, counter in current.connections.counters.items()},
+                            {key: tuple(latency) for key, latency in current.latency.items()}))
+        merged_bytes = SpaceSaving(self.capacity)
+        merged = DestinationBucket(cutoff, self.capacity)
+        for bytes_counters, connection_counters, latencies in buckets:
+            for key, (count, error) in bytes_counters.items():
+                merged_bytes.add(key, count, error)
+            for key, (count, error) in connection_counters.items():
+                latency_total, latency_samples = latencies.get(key, (0.0, 0))
+                merged.add_connection(key, count, error, latency_total, latency_samples)
+        
+        ranked = merged_bytes.top(n) if metric == 'bytes' else merged.connections.top(n)
+        rows = []
+        for key, _, error in ranked:
+            latency_total, latency_samples = merged.latency.get(key, (0.0, 0))
+            rows.append({
+                'host': key[0],
+                'port': key[1],
+                'bytes': merged_bytes.counters.get(key, [0, 0])[0],
+                'connections': merged.connections.counters.get(key, [0, 0])[0],
+                'error': error,
+                'avg_connect_ms': latency_total / latency_samples * 1000 if latency_samples else None,
+            })
+        return rows
+    
+    def _rollover_loop(self):
+        while True:
+            time.sleep(self.bucket_seconds)
+            try:
+                self.rollover()
+            except Exception as e:
+                print(f"[!] Destination stats rollover error: {e}")
+    
+    def start(self):
+        """Start the bucket rollover thread (once per process)."""
+        if self.rollover_thread and self.rollover_thread.is_alive():
+            return
+        self.rollover_thread = threading.Thread(target=self._rollover_loop, daemon=True)
+        self.rollover_thread.start()
+
+
+destination_stats = DestinationStats()
+
+
+def is_proxy_access_allowed():
+    """Check if current time is within allowed proxy access hours."""
+    import datetime
+    now = datetime.datetime.now()
+    current_time = (now.hour, now.minute)
+    start_time = (PROXY_ACCESS_START_HOUR, PROXY_ACCESS_START_MINUTE)
+    end_time = (PROXY_ACCESS_END_HOUR, PROXY_ACCESS_END_MINUTE)
+    
+    if start_time <= current_time < end_time:
+        return True
+    return False
+
+
+# ============================
+# SESSION MANAGER
+# ============================
+
+class CoarseClock:
+    """Monotonic seconds, refreshed once per timer-wheel tick.
+
+    Hot paths (tunnel activity) read .now instead of calling time.monotonic().
+    """
+    def __init__(self):
+        self.now = time.monotonic()
+
+
+coarse_clock = CoarseClock()
+
+
+class WheelTimer:
+    __slots__ = ('deadline', 'callback', 'slot')
+
+    def __init__(self, deadline, callback):
+        self.deadline = deadline  # In ticks
+        self.callback = callback
+        self.slot = None  # The dict this timer sits in, so TimerWheel.cancel() is O(1)
+
+
+
+class TimerWheel:
+    """Hierarchical timing wheel: O(1) schedule and cancel, callbacks fired once per tick.
+
+    Level 0 holds timers due within `slots` ticks, one slot per tick. Each higher level
+    covers `slots` times the span of the one below and is cascaded down as time reaches
+    its slots. Timers beyond the top level wait in its farthest slot and are re-placed.
+    """
+    def __init__(self, tick=1.0, slots=64, levels=3):
+        self.tick = tick
+        self.slots = slots
+        self.wheels = [[{} for _ in range(slots)] for _ in range(levels)]
+        self.current = 0  # Ticks elapsed since started
+        self.started = time.monotonic()
+        self.lock = make_lock("timer_wheel")
+        self.thread = None
+
+    def schedule(self, delay, callback):
+        """Call callback() after at least delay seconds (rounded up to whole ticks)."""
+        with self.lock:
+            timer = WheelTimer(self.current + max(1, int(-(-delay // self.tick))), callback)
+            self._place(timer)
+        return timer
+
+    def cancel(self, timer):
+        with self.lock:
+            if timer.slot is not None:
+                timer.slot.pop(timer, None)
+                timer.slot = None
+
+    def _place(self, timer):
+        """Put a timer in the lowest level that covers its deadline. Caller holds lock."""
+        remaining = timer.deadline - self.current
+        span = self.slots
+        for level, wheel in enumerate(self.wheels):
+            if remaining < span or level == len(self.wheels) - 1:
+                unit = span // self.slots
+                if remaining >= span:
+                    index = (self.current // unit + self.slots - 1) % self.slots  # Beyond the top: park farthest
+                else:
+                    index = (timer.deadline // unit) % self.slots
+                timer.slot = wheel[index]
+                timer.slot[timer] = None
+                return
+            span *= self.slots
+
+    def advance(self):
+        """Move one tick forward and return the timers that fell due."""
+        with self.lock:
+            self.current += 1
+            # Cascade higher levels whose slot boundary was just reached, top down
+            unit = self.slots ** (len(self.wheels) - 1)
+            for level in range(len(self.wheels) - 1, 0, -1):
+                if self.current % unit == 0:
+                    slot = self.wheels[level][(self.current // unit) % self.slots]
+                    timers = list(slot)
+                    slot.clear()
+                    for timer in timers:
+                        self._place(timer)
+                unit //= self.slots
+            slot = self.wheels[0][self.current % self.slots]
+            due = [timer for timer in slot if timer.deadline <= self.current]
+            for timer in due:
+                del slot[timer]
+                timer.slot = None
+        return due
+
+    def _run(self):
+        while True:
+            time.sleep(self.tick)
+            now = time.monotonic()
+            coarse_clock.now = now
+            # Catch up if the thread was delayed
+            while self.current < int((now - self.started) / self.tick):
+                for timer in self.advance():
+                    try:
+                        timer.callback()
+                    except Exception as e:
+                        print(f"[!] Timer callback error: {e}")
+
+    def start(self):
+        """Start the tick thread (once per process)."""
+        if self.thread and self.thread.is_alive():
+            return
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+
+class Session:
+    """One user's session on one device."""
+    __slots__ = ('username', 'device_ip', 'started', 'last_active', 'handles', 'remote',
+                 'timer', 'disconnect_logged', 'synced_active')
+
+    def __init__(self, username, device_ip):
+        self.username = username
+        self.device_ip = device_ip
+        self.started = time.time()
+        self.last_active = time.monotonic()
+        self.handles = set()  # Client sockets/handles of this process's connections
+        self.remote = {}  # {worker_id: open connections} (supervisor only)
+        self.timer = None
+        self.disconnect_logged = False
+        self.synced_active = self.last_active  # Last activity reported to the supervisor (workers, and a process draining after a handover)
+
+    def touch(self):
+        """Record activity; called from relay loops, so it only stores the coarse clock."""
+        self.last_active = coarse_clock.now
+
+    def open_connections(self):
+        return len(self.handles) + sum(self.remote.values())
+
+    def idle_seconds(self):
+        return max(0.0, time.monotonic() - self.last_active)
+
+
+def run_deferred(deferred):
+    """Run the (function, args) calls a SessionManager helper deferred until its stripe lock was released."""
+    for function, args in deferred:
+        function(*args)
+
+
+def close_handles(handles):
+    for handle in handles:
+        try:
+            handle.close()
+        except:
+            pass
+
+
+def build_session_conflict_response(remaining):
+    """407 sent to a second device while the user's session is still active."""
+    response = b"HTTP/1.1 407 Proxy Authentication Required\r\n"
+    response += b"Proxy-Authenticate: Basic realm=\"Credentials Already In Use\"\r\n"
+    response += b"Connection: close\r\n"
+    response += b"\r\nCredentials already in use on another device. Try again in " + f"{remaining:.0f}s".encode() + b".\r\n"
+    return response
+
+
+class SessionManager:
+    """Enforces one device per user, with sessions that expire after SESSION_TIMEOUT idle.
+
+    An idle session whose connections are still open (a quiet SSH or websocket tunnel)
+    is kept; it is only ended, and its connections closed, when another device logs in.
+
+    Sessions are split across lock stripes by username. Each session has one timer on
+    the wheel; activity only moves last_active, and the timer re-arms itself for the
+    remaining idle time when it fires early, so touching a session never takes a lock.
+
+    In a worker process the supervisor makes admission decisions and owns timers and
+    login logging; the local sessions only track this worker's sockets and activity.
+    
+    Login logging and closing sockets are not done under a stripe lock: the *_locked
+    helpers append them to a `deferred` list of (function, args) that the caller runs
+    with run_deferred() after releasing the lock.
+    """
+    def __init__(self, timeout=SESSION_TIMEOUT, stripes=LOCK_STRIPES):
+        self.timeout = timeout
+        self.stripes = [({}, make_lock("sessions")) for _ in range(stripes)]  # ({username: Session}, lock)
+        self.last_devices = {}  # {username: device_ip} of expired sessions, for LOGIN_NEW_DEVICE
+        self.wheel = TimerWheel()
+        self.expiring = True  # False while draining after a handover: the new process owns expiry
+
+    def _stripe(self, username):
+        return self.stripes[hash(username) % len(self.stripes)]
+
+    def __len__(self):
+        return sum(len(sessions) for sessions, _ in self.stripes)
+
+    def start(self):
+        self.wheel.start()
+
+    def _admit(self, username, device_ip, deferred):
+        """Apply the one-device rule. Caller holds the stripe lock and runs deferred after it.
+
+        Returns (session, message, remaining): session is None if the user is active elsewhere.
+        """
+        sessions, _ = self._stripe(username)
+        session = sessions.get(username)
+
+        if session is not None and session.device_ip != device_ip:
+            idle = session.idle_seconds()
+            if idle < self.timeout:
+                # Previous session still active - block this new device
+                remaining = self.timeout - idle
+                print(f"[!] User {username} already active on {session.device_ip}. Blocking device {device_ip} for {remaining:.0f}s")
+                return None, f"User {username} already connected on another device", remaining
+            # Timed out but the timer has not fired yet
+            self._expire_locked(session, deferred)
+            session = None
+
+        if session is not None:
+            # Same device - ALWAYS require fresh login but don't log again
+            session.last_active = time.monotonic()
+            return session, f"Fresh login required for {username} from {device_ip}", 0
+
+        session = Session(username, device_ip)
+        sessions[username] = session
+        if WORKER_ID is None:
+            session.timer = self.wheel.schedule(self.timeout, lambda: self._on_timer(session))
+            previous_device = self.last_devices.pop(username, None)
+            if previous_device is not None and previous_device != device_ip:
+                deferred.append((log_login, (username, device_ip, "LOGIN_NEW_DEVICE")))
+                return session, f"New device allowed for {username} (previous session timed out)", 0
+            deferred.append((log_login, (username, device_ip, "LOGIN")))
+        return session, f"New session for {username} from {device_ip}", 0
+
+    def acquire(self, username, device_ip, handle):
+        """Admit a client connection. Returns (session, message); session is None if refused.
+
+        On refusal the 407 has already been sent on handle and handle closed.
+        """
+        if shared_state is not None:
+            allowed, msg, reply = shared_state.check_session(username, device_ip, WORKER_ID)
+            if not allowed:
+                handle.sendall(reply)
+                handle.close()
+                return None, msg
+            sessions, lock = self._stripe(username)
+            with lock:
+                session = sessions.get(username)
+                if session is None or session.device_ip != device_ip:
+                    session = Session(username, device_ip)
+                    sessions[username] = session
+                session.handles.add(handle)
+            return session, msg
+
+        sessions, lock = self._stripe(username)
+        deferred = []
+        with lock:
+            session, msg, remaining = self._admit(username, device_ip, deferred)
+            if session is not None:
+                session.handles.add(handle)
+                session.disconnect_logged = False
+        run_deferred(deferred)
+        if session is None:
+            handle.sendall(build_session_conflict_response(remaining))
+            handle.close()
+        return session, msg
+
+    def acquire_remote(self, username, device_ip, worker_id):
+        """Supervisor side of acquire() for a worker's connection. Returns (allowed, message, reply)."""
+        sessions, lock = self._stripe(username)
+        deferred = []
+        with lock:
+            session, msg, remaining = self._admit(username, device_ip, deferred)
+            if session is not None:
+                session.remote[worker_id] = session.remote.get(worker_id, 0) + 1
+                session.disconnect_logged = False
+        run_deferred(deferred)
+        if session is None:
+            return False, msg, build_session_conflict_response(remaining)
+        return True, msg, b""
+
+    def _released(self, session, deferred):
+        """Bookkeeping after a connection closed. Caller holds the stripe lock and runs deferred after it."""
+        session.last_active = time.monotonic()  # Idle time starts now
+        if session.open_connections() == 0 and not session.disconnect_logged and WORKER_ID is None:
+            session.disconnect_logged = True
+            deferred.append((log_login, (session.username, session.device_ip, "DISCONNECT")))
+
+    def release(self, session, handle):
+        """A local client connection closed."""
+        sessions, lock = self._stripe(session.username)
+        deferred = []
+        with lock:
+            session.handles.discard(handle)
+            if WORKER_ID is not None:
+                # Worker mirror: drop it once unused; the supervisor keeps the real session
+                if not session.handles and sessions.get(session.username) is session:
+                    del sessions[session.username]
+            elif sessions.get(session.username) is session:
+                self._released(session, deferred)  # Not already expired or evicted
+        run_deferred(deferred)
+        if shared_state is not None:
+            shared_state.release_session(session.username, session.device_ip, WORKER_ID)
+
+    def release_remote(self, username, device_ip, worker_id):
+        """Supervisor side of release() for a worker's connection."""
+        sessions, lock = self._stripe(username)
+        deferred = []
+        with lock:
+            session = sessions.get(username)
+            if session is None or session.device_ip != device_ip or not session.remote.get(worker_id):
+                return
+            session.remote[worker_id] -= 1
+            if not session.remote[worker_id]:
+                del session.remote[worker_id]
+            self._released(session, deferred)
+        run_deferred(deferred)
+
+    def touch_remote(self, activity):
+        """Supervisor or new process: apply activity reported by a worker or draining process as [(username, device_ip), ...]."""
+        now = time.monotonic()
+        for username, device_ip in activity:
+            sessions, lock = self._stripe(username)
+            with lock:
+                session = sessions.get(username)
+                if session is not None and session.device_ip == device_ip:
+                    session.last_active = now
+
+    def take_activity(self):
+        """Worker or draining process: sessions with activity since the last call, as [(username, device_ip), ...]."""
+        activity = []
+        for sessions, lock in self.stripes:
+            with lock:
+                for session in sessions.values():
+                    if session.last_active > session.synced_active:
+                        session.synced_active = session.last_active
+                        activity.append((session.username, session.device_ip))
+        return activity
+
+    def _close_connections(self, session, deferred):
+        """Close every connection of a session, here and in workers. Caller holds the stripe lock and runs deferred after it."""
+        if session.handles:
+            deferred.append((close_handles, (list(session.handles),)))
+        session.handles.clear()
+        if supervisor_state is not None:
+            for worker_id in session.remote:
+                supervisor_state.queue_eviction(worker_id, session.username, session.device_ip)
+        session.remote.clear()
+
+    def _expire_locked(self, session, deferred):
+        """End a timed-out session. Caller holds the stripe lock and runs deferred after it."""
+        sessions, _ = self._stripe(session.username)
+        if sessions.get(session.username) is not session:
+            return
+        del sessions[session.username]
+        if session.timer is not None:
+            self.wheel.cancel(session.timer)
+        self._close_connections(session, deferred)
+        self.last_devices[session.username] = session.device_ip
+        print(f"[*] Session for {session.username} expired after {session.idle_seconds():.0f}s inactivity")
+        deferred.append((log_login, (session.username, session.device_ip, "LOGOUT_TIMEOUT")))
+
+    def _on_timer(self, session):
+        sessions, lock = self._stripe(session.username)
+        deferred = []
+        with lock:
+            if sessions.get(session.username) is not session or not self.expiring:
+                return
+            remaining = self.timeout - session.idle_seconds()
+            if remaining > 0:
+                # Active since the timer was set: re-arm for the rest of the idle window
+                session.timer = self.wheel.schedule(remaining, lambda: self._on_timer(session))
+                return
+            if session.open_connections():
+                # Idle but still connected: keep it, release() restarts the idle window
+                session.timer = self.wheel.schedule(self.timeout, lambda: self._on_timer(session))
+                return
+            self._expire_locked(session, deferred)
+        run_deferred(deferred)
+
+    def export(self):
+        """Return [(username, device_ip, started, idle_seconds)] for a handover snapshot."""
+        entries = []
+        for sessions, lock in self.stripes:
+            with lock:
+                entries.extend((session.username, session.device_ip, session.started, session.idle_seconds())
+                               for session in sessions.values())
+        return entries
+
+    def restore(self, entries):
+        """Recreate sessions exported by a previous process, without logging new logins."""
+        for username, device_ip, started, idle in entries:
+            if idle >= self.timeout:
+                continue
+            sessions, lock = self._stripe(username)
+            with lock:
+                if username in sessions:
+                    continue
+                session = Session(username, device_ip)
+                session.started = started
+                session.last_active = time.monotonic() - idle
+                session.disconnect_logged = True
+                sessions[username] = session
+                session.timer = self.wheel.schedule(self.timeout - idle, lambda session=session: self._on_timer(session))
+
+    def close_local(self, username, device_ip):
+        """Worker: close this process's connections for a session the supervisor evicted."""
+        sessions, lock = self._stripe(username)
+        deferred = []
+        with lock:
+            session = sessions.get(username)
+            if session is not None and session.device_ip == device_ip:
+                self._close_connections(session, deferred)
+        run_deferred(deferred)
+
+    def evict_user(self, username, event):
+        """End a user's session now (e.g. the user was deleted). Returns the device IP or None."""
+        sessions, lock = self._stripe(username)
+        deferred = []
+        with lock:
+            session = sessions.pop(username, None)
+            if session is None:
+                return None
+            if session.timer is not None:
+                self.wheel.cancel(session.timer)
+            self._close_connections(session, deferred)
+            self.last_devices.pop(username, None)
+        run_deferred(deferred)
+        log_login(username, session.device_ip, event)
+        return session.device_ip
+
+
+session_manager = SessionManager()
+
+
+class ActiveClients:
+    """Connected clients for the STATUS and CLIENTS commands, striped by client address."""
+    def __init__(self, stripes=LOCK_STRIPES):
+        self.stripes = [({}, make_lock("active_clients")) for _ in range(stripes)]  # ({client_address: (user, timestamp)}, lock)
+    
+    def _stripe(self, addr):
+        return self.stripes[hash(addr) % len(self.stripes)]
+    
+    def add(self, addr, username):
+        clients, lock = self._stripe(addr)
+        with lock:
+            clients[addr] = (username, time.time())
+    
+    def remove(self, addr):
+        clients, lock = self._stripe(addr)
+        with lock:
+            clients.pop(addr, None)
+    
+    def items(self):
+        items = []
+        for clients, lock in self.stripes:
+            with lock:
+                items.extend(clients.items())
+        return items
+    
+    def __len__(self):
+        return sum(len(clients) for clients, _ in self.stripes)
+
+
+active_clients = ActiveClients()
+
+
+# ============================
+# DNS RESOLVER
+# ============================
+
+class DNSEntry:
+    """Cached lookup result for one hostname."""
+    __slots__ = ('addresses', 'negative_until', 'error', 'hits', 'last_used')
+    
+    def __init__(self):
+        self.addresses = {}  # {(family, ip): expiry}, in preferred connect order
+        self.negative_until = 0
+        self.error = None
+        self.hits = 0  # Lookups since the last refresh
+        self.last_used = 0
+    
+    def live_addresses(self, now):
+        return [address for address, expiry in self.addresses.items() if expiry > now]
+    
+    def next_expiry(self, now):
+        expiries = [expiry for expiry in self.addresses.values() if expiry > now]
+        return min(expiries) if expiries else 0
+
+
+class _Lookup:
+    """An in-flight lookup that concurrent callers for the same name wait on."""
+    __slots__ = ('event', 'result', 'error')
+    
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class DNSShard:
+    """One independently locked slice of the resolver's cache."""
+    __slots__ = ('entries', 'inflight', 'hits', 'misses', 'lock')
+    
+    def __init__(self):
+        self.entries = {}  # {hostname: DNSEntry}
+        self.inflight = {}  # {hostname: _Lookup}
+        self.hits = 0
+        self.misses = 0
+        self.lock = make_lock("dns")
+
+
+class DNSResolver:
+    """Caching resolver with single-flight lookups, negative caching and prefetch.
+    
+    Every address keeps its own expiry, so a refresh that returns a different set does
+    not throw away addresses that are still valid. getaddrinfo() does not expose record
+    TTLs, so each address lives for `ttl` seconds from the lookup that returned it.
+    Names that are used often are refreshed in the background before they expire.
+    
+    Names are spread over LOCK_STRIPES shards by hash, each with its own lock and an
+    equal share of max_entries, so lookups for different names rarely contend.
+    """
+    def __init__(self, ttl=CACHE_TTL, negative_ttl=DNS_NEGATIVE_TTL, max_entries=DNS_MAX_ENTRIES, shards=LOCK_STRIPES):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.shards = [DNSShard() for _ in range(shards)]
+        self.max_entries = max(1, max_entries // shards)  # Per shard
+        self.prefetch_thread = None
+        self.prefetch_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="dns-prefetch")
+    
+    def __len__(self):
+        return sum(len(shard.entries) for shard in self.shards)
+    
+    def _shard(self, hostname):
+        return self.shards[hash(hostname) % len(self.shards)]
+    
+    def resolve(self, hostname):
+        """Return [(family, ip), ...] for hostname, or raise socket.gaierror."""
+        literal = self._ip_literal(hostname)
+        if literal:
+            return [literal]
+        
+        now = time.time()
+        shard = self._shard(hostname)
+        with shard.lock:
+            entry = shard.entries.get(hostname)
+            if entry is not None:
+                entry.hits += 1
+                entry.last_used = now
+                live = entry.live_addresses(now)
+                if live:
+                    shard.hits += 1
+                    return live
+                if entry.negative_until > now:
+                    shard.hits += 1
+                    raise socket.gaierror(entry.error)
+            shard.misses += 1
+        return self._lookup_single_flight(hostname)
+    
+    def cached(self, hostname):
+        """Return live cached addresses without resolving (empty on a miss, which resolve() then counts)."""
+        literal = self._ip_literal(hostname)
+        if literal:
+            return [literal]
+        
+        now = time.time()
+        shard = self._shard(hostname)
+        with shard.lock:
+            entry = shard.entries.get(hostname)
+            live = entry.live_addresses(now) if entry is not None else []
+            if live:
+                # Count it like resolve() does, so prefetch and the hit ratio see it
+                entry.hits += 1
+                entry.last_used = now
+                shard.hits += 1
+            return live
+    
+    def record_connect(self, hostname, winner, failed=()):
+        """Reorder cached addresses after a connect race: winner first, failures last."""
+        shard = self._shard(hostname)
+        with shard.lock:
+            entry = shard.entries.get(hostname)
+            if entry is None or winner not in entry.addresses:
+                return
+            ordered = [winner]
+            ordered += [address for address in entry.addresses if address != winner and address not in failed]
+            ordered += [address for address in entry.addresses if address in failed and address != winner]
+            entry.addresses = {address: entry.addresses[address] for address in ordered}
+    
+    def _ip_literal(self, hostname):
+        try:
+            ip = ipaddress.ip_address(hostname.strip("[]"))
+        except ValueError:
+            return None
+        return (socket.AF_INET6 if ip.version == 6 else socket.AF_INET, str(ip))
+    
+    def _lookup_single_flight(self, hostname):
+        """Resolve hostname, coalescing concurrent lookups for the same name."""
+        shard = self._shard(hostname)
+        with shard.lock:
+            lookup = shard.inflight.get(hostname)
+            leader = lookup is None
+            if leader:
+                lookup = shard.inflight[hostname] = _Lookup()
+        
+        if not leader:
+            lookup.event.wait()
+            if lookup.error is not None:
+                raise lookup.error
+            return lookup.result
+        
+        try:
+            started = time.monotonic()
+            try:
+                addresses = self._getaddrinfo(hostname)
+            finally:
+                metric_dns_resolve.observe(time.monotonic() - started)
+            lookup.result = self._store(hostname, addresses)
+            return lookup.result
+        except OSError as e:
+            lookup.error = e if isinstance(e, socket.gaierror) else socket.gaierror(str(e))
+            self._store_failure(hostname, lookup.error)
+            raise lookup.error
+        except Exception as e:
+            lookup.error = e  # e.g. UnicodeError for a name IDNA cannot encode; not cached
+            raise
+        finally:
+            with shard.lock:
+                del shard.inflight[hostname]
+            lookup.event.set()
+    
+    def _getaddrinfo(self, hostname):
+        addresses = []
+        for family, _, _, _, sockaddr in socket.getaddrinfo(hostname, None, socket.AF_UNSPEC, socket.SOCK_STREAM):
+            address = (family, sockaddr[0])
+            if address not in addresses:
+                addresses.append(address)
+        if not addresses:
+            raise socket.gaierror(f"No addresses for {hostname}")
+        return addresses
+    
+    def _entry(self, shard, hostname, now):
+        """Return hostname's entry, creating it (and evicting if full). Caller holds shard.lock."""
+        entry = shard.entries.get(hostname)
+        if entry is None:
+            entry = shard.entries[hostname] = DNSEntry()
+            entry.last_used = now
+            self._evict_if_full(shard)
+        return entry
+    
+    def _store(self, hostname, addresses):
+        """Record fresh addresses; still-valid old addresses keep their own expiry."""
+        now = time.time()
+        shard = self._shard(hostname)
+        with shard.lock:
+            entry = self._entry(shard, hostname, now)
+            refreshed = {address: now + self.ttl for address in addresses}
+            for address, expiry in entry.addresses.items():
+                if address not in refreshed and expiry > now:
+                    refreshed[address] = expiry
+            entry.addresses = refreshed
+            entry.negative_until = 0
+            entry.error = None
+            entry.hits = 0
+            return entry.live_addresses(now)
+    
+    def _store_failure(self, hostname, error):
+        now = time.time()
+        shard = self._shard(hostname)
+        with shard.lock:
+            entry = self._entry(shard, hostname, now)
+            entry.negative_until = now + self.negative_ttl
+            entry.error = str(error)
+    
+    def _evict_if_full(self, shard):
+        """Drop the shard's least recently used names once over its share of entries. Caller holds shard.lock."""
+        if len(shard.entries) <= self.max_entries:
+            return
+        overflow = len(shard.entries) - self.max_entries
+        for hostname, _ in sorted(shard.entries.items(), key=lambda item: item[1].last_used)[:overflow]:
+            if hostname not in shard.inflight:
+                del shard.entries[hostname]
+    
+    def prefetch_due(self):
+        """Refresh hot names that are about to expire and drop names nobody uses."""
+        now = time.time()
+        window = max(self.ttl * 0.2, 2)
+        due = []
+        for shard in self.shards:
+            with shard.lock:
+                for hostname, entry in list(shard.entries.items()):
+                    next_expiry = entry.next_expiry(now)
+                    if not next_expiry and entry.negative_until <= now and now - entry.last_used > self.ttl:
+                        del shard.entries[hostname]
+                    elif (next_expiry and next_expiry - now < window
+                            and entry.hits >= DNS_PREFETCH_MIN_HITS and hostname not in shard.inflight):
+                        due.append(hostname)
+        for hostname in due:
+            self.prefetch_pool.submit(self._prefetch, hostname)
+    
+    def _prefetch(self, hostname):
+        try:
+            self._lookup_single_flight(hostname)
+        except OSError:
+            pass  # Live addresses stay usable until their own expiry
+    
+    def _prefetch_loop(self):
+        while True:
+            time.sleep(1)
+            try:
+                self.prefetch_due()
+            except Exception as e:
+                print(f"[!] DNS prefetch error: {e}")
+    
+    def start_prefetch(self):
+        """Start the background prefetch thread (once per process)."""
+        if self.prefetch_thread and self.prefetch_thread.is_alive():
+            return
+        self.prefetch_thread = threading.Thread(target=self._prefetch_loop, daemon=True)
+        self.prefetch_thread.start()
+    
+    def hit_ratio(self):
+        hits = sum(shard.hits for shard in self.shards)
+        total = hits + sum(shard.misses for shard in self.shards)
+        return hits / total if total else 0.0
+    
+    def export(self):
+        """Return live positive entries as {hostname: [[family, ip, expiry], ...]} for persistence."""
+        now = time.time()
+        exported = {}
+        for shard in self.shards:
+            with shard.lock:
+                for hostname, entry in shard.entries.items():
+                    if entry.next_expiry(now):
+                        exported[hostname] = [[int(family), ip, expiry]
+                                              for (family, ip), expiry in entry.addresses.items() if expiry > now]
+        return exported
+    
+    def seed(self, data):
+        """Load entries saved by export() (or the old {hostname: [ip, timestamp]} format)."""
+        now = time.time()
+        for hostname, records in data.items():
+            if records and not isinstance(records[0], list):
+                ip, timestamp = records  # Old single-address format
+                records = [[socket.AF_INET, ip, timestamp + self.ttl]]
+            addresses = {(family, ip): expiry for family, ip, expiry in records if expiry > now}
+            if addresses:
+                shard = self._shard(hostname)
+                with shard.lock:
+                    entry = shard.entries[hostname] = DNSEntry()
+                    entry.addresses = addresses
+                    entry.last_used = now
+    
+    def clear(self):
+        for shard in self.shards:
+            with shard.lock:
+                shard.entries.clear()
+
+
+dns_resolver = DNSResolver()
+
+
+# ============================
+# WARM CONNECTION POOL
+# ============================
+
+def is_idle_socket_healthy(sock):
+    """An idle upstream socket is healthy unless the peer closed it or it errored."""
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+        if not readable:
+            return True
+        # Readable while idle: either EOF/reset, or a server-first banner (which is fine)
+        return bool(sock.recv(1, socket.MSG_PEEK))
+    except (OSError, ValueError):
+        return False
+
+
+class WarmConnectionPool:
+    """Pool of fresh, never-used upstream TCP connections for the busiest destinations.
+    
+    Each CONNECT is counted per (host, port). A maintainer thread turns the counts into
+    a smoothed request rate and pre-opens up to WARM_POOL_MAX_PER_DESTINATION sockets
+    for the top destinations, sized so a burst at the current rate finds a socket ready.
+    Idle sockets are health-checked and recycled after WARM_POOL_IDLE_TIMEOUT, before
+    typical upstream idle timeouts close them. A socket is handed out at most once.
+    """
+    def __init__(self, max_connections=MAX_CACHED_CONNECTIONS, max_per_destination=WARM_POOL_MAX_PER_DESTINATION,
+                 max_idle=WARM_POOL_IDLE_TIMEOUT, interval=1.0):
+        self.max_connections = max_connections
+        self.max_per_destination = max_per_destination
+        self.max_idle = max_idle
+        self.interval = interval
+        self.idle = defaultdict(deque)  # {(host, port): deque([(socket, created), ...])}
+        self.requests = defaultdict(int)  # {(host, port): CONNECTs since last maintenance}
+        self.demand = {}  # {(host, port): smoothed CONNECTs per second}
+        self.opening = defaultdict(int)  # {(host, port): connects in progress}
+        self.hits = 0
+        self.misses = 0
+        self.lock = make_lock("warm_pool")
+        self.maintain_thread = None
+        self.connect_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="warm-pool")
+    
+    def __len__(self):
+        return sum(len(sockets) for sockets in self.idle.values())
+    
+    def acquire(self, host, port):
+        """Count a CONNECT to (host, port) and return a healthy warm socket, or None."""
+        key = (host, port)
+        now = time.monotonic()
+        with self.lock:
+            self.requests[key] += 1
+        while True:
+            with self.lock:
+                sockets = self.idle.get(key)
+                if not sockets:
+                    self.misses += 1
+                    return None
+                sock, created = sockets.pop()  # Newest first
+            # Popped sockets belong to this caller, so the health check runs unlocked
+            if now - created < self.max_idle and is_idle_socket_healthy(sock):
+                with self.lock:
+                    self.hits += 1
+                return sock
+            self._close(sock)
+    
+    def _close(self, sock):
+        try:
+            sock.close()
+        except OSError:
+            pass
+    
+    def _targets(self):
+        """Pool size per destination from recent demand. Caller holds lock."""
+        hot = sorted(
+            (item for item in self.demand.items() if item[1] >= WARM_POOL_MIN_RATE),
+            key=lambda item: item[1], reverse=True,
+        )[:WARM_POOL_MAX_DESTINATIONS]
+        targets = {}
+        budget = self.max_connections
+        for key, rate in hot:
+            # Enough sockets to cover the requests expected before the next refill
+            target = min(self.max_per_destination, max(1, int(rate * self.interval * 2 + 0.999)), budget)
+            if target <= 0:
+                break
+            targets[key] = target
+            budget -= target
+        return targets
+    
+    def maintain(self):
+        """Update demand, recycle stale sockets and top up the pool."""
+        now = time.monotonic()
+        to_open = []
+        with self.lock:
+            idle = [entry for sockets in self.idle.values() for entry in sockets]
+        # Health checks only peek, so they run unlocked; a socket acquired meanwhile is simply skipped below
+        stale = {sock for sock, created in idle if now - created >= self.max_idle or not is_idle_socket_healthy(sock)}
+        with self.lock:
+            for key in set(self.demand) | set(self.requests):
+                rate = self.requests.pop(key, 0) / self.interval
+                self.demand[key] = 0.8 * self.demand.get(key, 0) + 0.2 * rate
+                if self.demand[key] < WARM_POOL_MIN_RATE / 10 and not self.idle.get(key):
+                    del self.demand[key]
+            
+            targets = self._targets()
+            for key in list(self.idle):
+                fresh = deque()
+                for sock, created in self.idle[key]:
+                    if sock in stale:
+                        self._close(sock)
+                    else:
+                        fresh.append((sock, created))
+                while len(fresh) > targets.get(key, 0):
+                    self._close(fresh.popleft()[0])  # Oldest first
+                if fresh:
+                    self.idle[key] = fresh
+                else:
+                    del self.idle[key]
+            
+            for key, target in targets.items():
+                missing = target - len(self.idle.get(key, ())) - self.opening[key]
+                for _ in range(missing):
+                    self.opening[key] += 1
+                    to_open.append(key)
+        
+        for key in to_open:
+            self.connect_pool.submit(self._open, key)
+    
+    def _open(self, key):
+        host, port = key
+        try:
+            sock = connect_upstream(host, port)
+        except Exception:
+            sock = None
+        with self.lock:
+            self.opening[key] -= 1
+            if not self.opening[key]:
+                del self.opening[key]
+            if sock is not None:
+                self.idle[key].append((sock, time.monotonic()))
+    
+    def _maintain_loop(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.maintain()
+            except Exception as e:
+                print(f"[!] Warm pool maintenance error: {e}")
+    
+    def start(self):
+        """Start the background maintainer (once per process)."""
+        if self.maintain_thread and self.maintain_thread.is_alive():
+            return
+        self.maintain_thread = threading.Thread(target=self._maintain_loop, daemon=True)
+        self.maintain_thread.start()
+    
+    def clear(self):
+        with self.lock:
+            for sockets in self.idle.values():
+                for sock, _ in sockets:
+                    self._close(sock)
+            self.idle.clear()
+
+
+warm_pool = WarmConnectionPool()
+
+
+# ============================
+# CACHING SYSTEM
+# ============================
+
+class BlobStore:
+    """Content-addressed store for cached page bodies.
+    
+    Each distinct body is written once to CACHE_BLOB_DIR under its SHA-256 digest, so
+    pages with identical bodies share one file. Bodies are read back through mmap.
+    Reference counts live in the CacheManager of one process, so every process that
+    deletes blobs needs a directory of its own (see process_blob_dir()).
+    """
+    def __init__(self, directory=CACHE_BLOB_DIR):
+        self.directory = directory
+        self.owner = True  # False once another process manages these files (after a handover)
+    
+    @staticmethod
+    def digest(data):
+        return hashlib.sha256(data).hexdigest()
+    
+    def path(self, digest):
+        return os.path.join(self.directory, digest)
+    
+    def exists(self, digest):
+        return os.path.exists(self.path(digest))
+    
+    def write(self, digest, data):
+        """Write a body unless a blob with the same digest already exists."""
+        path = self.path(digest)
+        if os.path.exists(path):
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix=".blob.", dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+    
+    def read(self, digest):
+        """Return the body as a read-only mmap (b"" for empty bodies), or None if missing."""
+        try:
+            with open(self.path(digest), 'rb') as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    return b""
+                return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            return None
+    
+    def adopt(self, digest, source):
+        """Hard-link source's blob for digest into this store. Returns True if it is here now."""
+        os.makedirs(self.directory, exist_ok=True)
+        try:
+            os.link(source.path(digest), self.path(digest))
+        except FileExistsError:
+            pass
+        except OSError:
+            return False
+        return True
+    
+    def delete(self, digest):
+        if not self.owner:
+            return
+        try:
+            os.unlink(self.path(digest))
+        except FileNotFoundError:
+            pass
+    
+    def digests(self):
+        """Digests of all blobs on disk (not those in other processes' subdirectories)."""
+        try:
+            return [name for name in os.listdir(self.directory)
+                    if len(name) == 64 and all(c in '0123456789abcdef' for c in name)]
+        except FileNotFoundError:
+            return []
+
+
+def process_blob_dir():
+    """Blob directory for this process.
+    
+    The process that writes the snapshot (single process, or worker 0) uses
+    CACHE_BLOB_DIR, which the snapshot's digests refer to. Other workers keep their
+    own references, so they use a subdirectory and hard-link snapshot blobs into it.
+    """
+    if WORKER_ID in (None, 0):
+        return CACHE_BLOB_DIR
+    return os.path.join(CACHE_BLOB_DIR, f"worker-{WORKER_ID}")
+
+
+class CacheSnapshot:
+    """Length-prefixed binary snapshot of the DNS cache and page cache metadata.
+    
+    Layout (little-endian):
+        header   MAGIC, saved_at <d, dns_len <I, DNS entries as JSON
+        records  per page: key_len <H, key JSON, versions <B,
+                 then per version: timestamp <d, size <Q, SHA-256 digest (32 bytes)
+        index    count <I, then per page: key_len <H, key JSON, offset <Q, length <I
+        footer   index_offset <Q, MAGIC
+    
+    The footer is written last, so a truncated file is rejected as a whole. Page bodies
+    are not part of the snapshot; they live in the BlobStore. Pages are decoded on first
+    use via the index; saves copy undecoded records byte-for-byte.
+    
+    LEGACY_MAGIC snapshots (HPCACHE1) carry the bodies inline instead: per version
+    timestamp <d, kind <B, data_len <I, data. They are read once and migrated.
+    """
+    MAGIC = b"HPCACHE2"
+    LEGACY_MAGIC = b"HPCACHE1"
+    VERSION_FORMAT = '<dQ32s'
+    LEGACY_KIND_TEXT = 1
+    
+    @staticmethod
+    def encode_record(key, versions):
+        """Encode one page key and its (digest, size, timestamp) versions as a record."""
+        key_bytes = json.dumps(key).encode()
+        parts = [struct.pack('<H', len(key_bytes)), key_bytes, struct.pack('<B', len(versions))]
+        for digest, size, timestamp in versions:
+            parts.append(struct.pack(CacheSnapshot.VERSION_FORMAT, timestamp, size, bytes.fromhex(digest)))
+        return b"".join(parts)
+    
+    @staticmethod
+    def decode_record(buf, offset):
+        """Decode the versions of the record at offset (the key is skipped)."""
+        key_len, = struct.unpack_from('<H', buf, offset)
+        offset += 2 + key_len
+        count, = struct.unpack_from('<B', buf, offset)
+        offset += 1
+        versions = []
+        for _ in range(count):
+            timestamp, size, digest = struct.unpack_from(CacheSnapshot.VERSION_FORMAT, buf, offset)
+            offset += struct.calcsize(CacheSnapshot.VERSION_FORMAT)
+            versions.append((digest.hex(), size, timestamp))
+        return tuple(versions)
+    
+    @staticmethod
+    def decode_legacy_record(buf, offset):
+        """Decode the (body, timestamp) versions of an HPCACHE1 record at offset."""
+        key_len, = struct.unpack_from('<H', buf, offset)
+        offset += 2 + key_len
+        count, = struct.unpack_from('<B', buf, offset)
+        offset += 1
+        versions = []
+        for _ in range(count):
+            timestamp, kind, data_len = struct.unpack_from('<dBI', buf, offset)
+            offset += struct.calcsize('<dBI')
+            data = bytes(buf[offset:offset + data_len])
+            offset += data_len
+            versions.append((data.decode() if kind == CacheSnapshot.LEGACY_KIND_TEXT else data, timestamp))
+        return tuple(versions)
+    
+    @staticmethod
+    def write(path, dns_entries, records):
+        """Write a snapshot to a temp file and atomically rename it over path.
+        
+        records yields (key, record_bytes). Returns {key: (offset, length)} for the new file.
+        """
+        index = {}
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(prefix=".proxy_cache.", dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                dns_bytes = json.dumps(dns_entries, separators=(',', ':')).encode()
+                f.write(CacheSnapshot.MAGIC + struct.pack('<dI', time.time(), len(dns_bytes)) + dns_bytes)
+                offset = f.tell()
+                for key, record in records:
+                    f.write(record)
+                    index[key] = (offset, len(record))
+                    offset += len(record)
+                
+                index_offset = offset
+                parts = [struct.pack('<I', len(index))]
+                for key, (record_offset, length) in index.items():
+                    key_bytes = json.dumps(key).encode()
+                    parts.append(struct.pack('<H', len(key_bytes)) + key_bytes + struct.pack('<QI', record_offset, length))
+                f.write(b"".join(parts))
+                f.write(struct.pack('<Q', index_offset) + CacheSnapshot.MAGIC)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        except:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+        return index
+    
+    @staticmethod
+    def open(path):
+        """Map a snapshot and read its DNS entries and page index without decoding pages.
+        
+        Returns (dns_entries, {key: (offset, length)}, mapping, magic).
+        """
+        with open(path, 'rb') as f:
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic_len = len(CacheSnapshot.MAGIC)
+        footer_len = 8 + magic_len
+        magic = mapping[:magic_len]
+        if (len(mapping) < magic_len + 12 + footer_len or magic not in (CacheSnapshot.MAGIC, CacheSnapshot.LEGACY_MAGIC)
+                or mapping[-magic_len:] != magic):
+            mapping.close()
+            raise ValueError("not a complete cache snapshot")
+        
+        _, dns_len = struct.unpack_from('<dI', mapping, magic_len)
+        dns_start = magic_len + 12
+        dns_entries = json.loads(mapping[dns_start:dns_start + dns_len])
+        
+        offset, = struct.unpack_from('<Q', mapping, len(mapping) - footer_len)
+        count, = struct.unpack_from('<I', mapping, offset)
+        offset += 4
+        index = {}
+        for _ in range(count):
+            key_len, = struct.unpack_from('<H', mapping, offset)
+            offset += 2
+            key = tuple(json.loads(mapping[offset:offset + key_len]))
+            offset += key_len
+            index[key] = struct.unpack_from('<QI', mapping, offset)
+            offset += 12
+        return dns_entries, index, mapping, magic
+
+
+class CacheManager:
+    """Manages page caching, active clients and DNS cache persistence.
+    
+    Pages map to up to two versions of (digest, size, timestamp); the bodies live in the
+    BlobStore. The total size of distinct referenced bodies is kept under max_bytes by
+    evicting whole pages in LRU or LFU order, and pages older than page_ttl expire.
+    Pages loaded from the snapshot stay in page_index until first use; until then they
+    hold no references and are not counted against the budget.
+    """
+    
+    def __init__(self, resolver, ttl=CACHE_TTL, cache_file=CACHE_FILE, blob_dir=CACHE_BLOB_DIR,
+                 max_bytes=int(PAGE_CACHE_MAX_MB * 1024 * 1024), page_ttl=PAGE_CACHE_TTL, policy=PAGE_CACHE_POLICY):
+        self.ttl = ttl
+        self.cache_file = cache_file
+        self.resolver = resolver  # DNS entries live in the resolver; persisted here
+        self.blobs = BlobStore(blob_dir)
+        # Where the snapshot's blobs are, if not in our own directory
+        self.shared_blobs = BlobStore(CACHE_BLOB_DIR) if blob_dir != CACHE_BLOB_DIR else None
+        self.max_bytes = max_bytes
+        self.page_ttl = page_ttl
+        self.policy = policy
+        # {(host, port, path): ((digest, size, timestamp), ...)} in LRU order (oldest first);
+        # version tuples are replaced rather than mutated so a shallow copy is a consistent snapshot
+        self.page_cache = OrderedDict()
+        self.page_hits = {}  # {(host, port, path): hit count} for LFU eviction
+        self.page_index = {}  # {(host, port, path): (offset, length)} - pages still on disk
+        self.snapshot_map = None  # mmap of the snapshot page_index points into
+        self.blob_refs = {}  # {digest: [references, size]}
+        self.cached_bytes = 0  # Total size of distinct referenced bodies
+        self.lock = make_lock("page_cache")
+        self.save_lock = threading.Lock()  # Serializes snapshot writers, never held with self.lock for long
+        self.save_thread = None
+        self.should_exit = False
+        self.load_thread = None
+        self.loaded = threading.Event()  # Set once the snapshot on disk has been read; saves wait for it
+    
+    def start_loading(self):
+        """Load the snapshot on disk in the background (once per process).
+        
+        Until it is done lookups simply miss, and pages cached meanwhile are kept.
+        """
+        if self.load_thread is not None:
+            return
+        self.load_thread = threading.Thread(target=self._load_in_background, daemon=True)
+        self.load_thread.start()
+    
+    def _load_in_background(self):
+        # Users gate every CONNECT while the page cache only saves upstream fetches, so they go first
+        users_ready.wait(USERS_READY_TIMEOUT)
+        started = time.time()
+        try:
+            self.load_cache_from_disk()
+        finally:
+            self.loaded.set()
+        server_logger.log(f"[*] Page cache ready in {time.time() - started:.2f}s")
+    
+    def load_cache_from_disk(self):
+        """Load cached DNS entries and the page index from disk. Pages are decoded on first use.
+        
+        Pages already cached by this process are newer and win. Blobs no page refers to are
+        removed once the index is in place; an HPCACHE1 snapshot is migrated into the blob store.
+        """
+        if not os.path.exists(self.cache_file):
+            if self.cache_file == CACHE_FILE and os.path.exists(LEGACY_CACHE_FILE):
+                self.load_legacy_cache(LEGACY_CACHE_FILE)
+            return
+        
+        try:
+            dns_entries, index, mapping, magic = CacheSnapshot.open(self.cache_file)
+            # Restore DNS cache (only unexpired addresses)
+            self.resolver.seed(dns_entries)
+            if magic == CacheSnapshot.LEGACY_MAGIC:
+                self._migrate_legacy_snapshot(index, mapping)
+                mapping.close()
+                return
+            with self.lock:
+                self.page_index = {key: location for key, location in index.items() if key not in self.page_cache}
+                self.snapshot_map = mapping
+            print(f"[*] Loaded {len(self.resolver)} DNS cache entries and indexed {len(index)} page cache entries from disk")
+            self._remove_orphan_blobs()
+        except Exception as e:
+            print(f"[!] Error loading cache from disk: {e}")
+    
+    def _migrate_legacy_snapshot(self, index, mapping):
+        """Move the pages of an HPCACHE1 snapshot (bodies inline) into the blob store.
+        
+        The next save writes the current format.
+        """
+        for key, (offset, _) in index.items():
+            with self.lock:
+                if key in self.page_cache:
+                    continue
+            try:
+                for body, _ in CacheSnapshot.decode_legacy_record(mapping, offset):
+                    self.cache_page(*key, body)
+            except Exception as e:
+                print(f"[!] Error migrating cached page {key}: {e}")
+        print(f"[*] Migrated {len(self.page_cache)} page cache entries from an HPCACHE1 snapshot")
+    
+    def _indexed_digests(self, indexed, source):
+        """Digests referenced by undecoded snapshot records [(offset, length), ...]."""
+        return {digest for offset, _ in indexed for digest, _, _ in CacheSnapshot.decode_record(source, offset)}
+    
+    def _remove_orphan_blobs(self):
+        """Delete blobs in this process's directory that no page refers to (e.g. cached after the last save)."""
+        on_disk = set(self.blobs.digests())
+        with self.lock:
+            indexed = list(self.page_index.values())
+            source = self.snapshot_map
+        # Only the digests are read; the records stay undecoded
+        referenced = self._indexed_digests(indexed, source)
+        with self.lock:
+            # Deleted under the lock so a concurrent cache_page() rewrites a body it needs
+            for digest in on_disk - referenced - set(self.blob_refs):
+                self.blobs.delete(digest)
+    
+    def _has_blob(self, digest):
+        if self.blobs.exists(digest):
+            return True
+        return self.shared_blobs is not None and self.blobs.adopt(digest, self.shared_blobs)
+    
+    def _load_page(self, key):
+        """Decode an indexed page into page_cache, dropping versions whose blob is gone. Caller holds self.lock."""
+        location = self.page_index.pop(key, None)
+        if location is None:
+            return
+        try:
+            versions = CacheSnapshot.decode_record(self.snapshot_map, location[0])
+        except Exception as e:
+            print(f"[!] Error reading cached page {key}: {e}")
+            return
+        versions = tuple(version for version in versions if self._has_blob(version[0]))
+        if versions:
+            self._set_versions(key, versions)
+    
+    def load_legacy_cache(self, path):
+        """Load a JSON cache file written by older versions; the next save converts it."""
+        try:
+            with open(path, 'r') as f:
+                data = json.load(f)
+            self.resolver.seed(data.get('dns_cache', {}))
+            for page_key, versions in data.get('page_cache', {}).items():
+                try:
+                    key = tuple(json.loads(page_key))
+                    if not isinstance(versions[0], list):
+                        # Handle old format (single version)
+                        versions = [versions]
+                    for body, _ in versions:
+                        self.cache_page(*key, body)
+                except:
+                    pass
+            print(f"[*] Loaded {len(self.resolver)} DNS cache entries and {len(self.page_cache)} page cache entries from {path}")
+        except Exception as e:
+            print(f"[!] Error loading cache from disk: {e}")
+    
+    def save_cache_to_disk(self):
+        """Save cache to disk asynchronously to avoid blocking."""
+        # Spawn async thread instead of blocking main thread
+        save_thread = threading.Thread(target=self._save_cache_async, daemon=True)
+        save_thread.start()
+    
+    def _save_cache_async(self):
+        """Write a snapshot to disk. Only the shallow copy below runs under self.lock."""
+        if self.load_thread is not None and not self.loaded.is_set():
+            return  # The file on disk still holds pages not loaded yet
+        try:
+            with self.save_lock:
+                with self.lock:
+                    pages = list(self.page_cache.items())
+                    indexed = dict(self.page_index)
+                    source = self.snapshot_map
+                
+                def records():
+                    for key, versions in pages:
+                        yield key, CacheSnapshot.encode_record(key, versions)
+                    for key, (offset, length) in indexed.items():
+                        # Not decoded since load: copy the record as-is
+                        yield key, source[offset:offset + length]
+                
+                index = CacheSnapshot.write(self.cache_file, self.resolver.export(), records())
+                
+                # Point still-undecoded pages at the new file so the old mapping can be dropped
+                mapping = None
+                if indexed:
+                    with open(self.cache_file, 'rb') as f:
+                        mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                with self.lock:
+                    self.page_index = {key: index[key] for key in self.page_index if key in index}
+                    self.snapshot_map = mapping if self.page_index else None
+            print(f"[*] Saved cache to disk ({len(self.resolver)} DNS entries, {len(index)} page entries)")
+        except Exception as e:
+            print(f"[!] Error saving cache to disk: {e}")
+    
+    def _auto_save_thread(self):
+        """Background thread that periodically saves cache."""
+        while not self.should_exit:
+            time.sleep(CACHE_SAVE_INTERVAL)
+            if not self.should_exit:
+                self.save_cache_to_disk()
+    
+    def start_auto_save(self):
+        """Start the background thread for periodic cache saves."""
+        self.should_exit = False
+        self.save_thread = threading.Thread(target=self._auto_save_thread, daemon=True)
+        self.save_thread.start()
+    
+    def stop_auto_save(self):
+        """Stop the background save thread."""
+        self.should_exit = True
+        if self.save_thread:
+            self.save_thread.join(timeout=2)
+    
+    def _set_versions(self, key, versions):
+        """Replace a page's versions, keeping blob references and the byte total in step. Caller holds self.lock."""
+        for digest, size, _ in versions:
+            ref = self.blob_refs.get(digest)
+            if ref is None:
+                self.blob_refs[digest] = [1, size]
+                self.cached_bytes += size
+            else:
+                ref[0] += 1
+        unreferenced = []
+        for digest, _, _ in self.page_cache.get(key, ()):
+            ref = self.blob_refs[digest]
+            ref[0] -= 1
+            if ref[0] == 0:
+                del self.blob_refs[digest]
+                self.cached_bytes -= ref[1]
+                unreferenced.append(digest)
+        if versions:
+            self.page_cache[key] = versions
+            self.page_cache.move_to_end(key)
+        else:
+            self.page_cache.pop(key, None)
+            self.page_hits.pop(key, None)
+        # Deleted under the lock so a concurrent cache_page() cannot re-reference a blob mid-unlink
+        for digest in unreferenced:
+            self.blobs.delete(digest)
+    
+    def _evict_over_budget(self, keep=None):
+        """Evict pages until the distinct body bytes fit max_bytes. Caller holds self.lock."""
+        while self.cached_bytes > self.max_bytes and len(self.page_cache) > (1 if keep in self.page_cache else 0):
+            candidates = (key for key in self.page_cache if key != keep)
+            if self.policy == "lfu":
+                # Least hits first; iteration order makes ties fall back to LRU
+                victim = min(candidates, key=lambda key: self.page_hits.get(key, 0))
+            else:
+                victim = next(candidates)
+            self._set_versions(victim, ())
+    
+    def _expired(self, versions):
+        return self.page_ttl > 0 and time.time() - versions[-1][2] > self.page_ttl
+    
+    def lookup_page(self, host, port, path):
+        """Return (body, timestamp) for the newest cached version of a page, or None on a miss.
+        
+        body is a read-only buffer (mmap or bytes); timestamp is when it was stored or last revalidated.
+        """
+        key = (host, port, path)
+        with self.lock:
+            if key in self.page_index:
+                self._load_page(key)
+            versions = self.page_cache.get(key)
+            if not versions:
+                return None
+            if self._expired(versions):
+                self._set_versions(key, ())
+                return None
+            self.page_cache.move_to_end(key)
+            self.page_hits[key] = self.page_hits.get(key, 0) + 1
+            digest, _, timestamp = versions[-1]
+        
+        body = self.blobs.read(digest)
+        if body is None:
+            with self.lock:
+                if self.page_cache.get(key) is versions:
+                    self._set_versions(key, ())
+            return None
+        return body, timestamp
+    
+    def get_cached_page(self, host, port, path):
+        """Retrieve the newest cached version of a page.
+        
+        Returns the body as a read-only buffer (mmap or bytes), or None on a miss.
+        """
+        entry = self.lookup_page(host, port, path)
+        if entry is None:
+            return None
+        print(f"[*] Found cached page for {host}:{port}{path}")
+        return entry[0]
+    
+    def cached_digest(self, host, port, path):
+        """Return the digest of the newest cached version of a page, or None."""
+        key = (host, port, path)
+        with self.lock:
+            if key in self.page_index:
+                self._load_page(key)
+            versions = self.page_cache.get(key)
+            return versions[-1][0] if versions else None
+    
+    def cache_page(self, host, port, path, response_data):
+        """Cache a page response. Keep only the newest and 2nd newest versions."""
+        if isinstance(response_data, str):
+            response_data = response_data.encode()
+        key = (host, port, path)
+        # Hash and write the body before taking the lock; identical bodies share one blob
+        digest = self.blobs.digest(response_data)
+        size = len(response_data)
+        if size > self.max_bytes:
+            print(f"[*] Page too large to cache: {host}:{port}{path} ({size} bytes)")
+            return
+        if digest not in self.blob_refs:
+            self.blobs.write(digest, response_data)
+        
+        with self.lock:
+            if key in self.page_index:
+                self._load_page(key)
+            versions = self.page_cache.get(key, ())
+            # Check if page already cached
+            if versions:
+                if versions[-1][0] == digest:
+                    print(f"[*] Page unchanged for {host}:{port}{path} - keeping cached version")
+                    self.page_cache[key] = versions[:-1] + ((digest, size, time.time()),)
+                    self.page_cache.move_to_end(key)
+                    return  # Don't add a version if same as newest
+                print(f"[*] Page updated for {host}:{port}{path} - new version added to cache")
+            else:
+                # First version of this page
+                print(f"[*] Cached new page: {host}:{port}{path}")
+            # Add new version; keep only newest and 2nd newest (delete oldest if more than 2)
+            versions = (versions + ((digest, size, time.time()),))[-2:]
+            self._set_versions(key, versions)
+            if not self.blobs.exists(digest):
+                # Evicted and unlinked between the write above and taking the lock
+                self.blobs.write(digest, response_data)
+            self._evict_over_budget(keep=key)
+    
+    def clear_cache(self):
+        """Clear all cached pages and DNS entries."""
+        if self.load_thread is not None:
+            self.loaded.wait()
+        with self.lock:
+            for key in list(self.page_cache):
+                self._set_versions(key, ())
+            self.page_hits.clear()
+            indexed = list(self.page_index.values())
+            source = self.snapshot_map
+            self.page_index = {}
+            self.snapshot_map = None
+        if indexed:
+            # Undecoded pages hold no references; delete their bodies unless a page cached since uses them
+            digests = self._indexed_digests(indexed, source)
+            with self.lock:
+                for digest in digests - set(self.blob_refs):
+                    self.blobs.delete(digest)
+        self.resolver.clear()
+        # Save empty cache to disk
+        self.save_cache_to_disk()
+
+
+# Initialize global cache manager
+cache_manager = CacheManager(dns_resolver, blob_dir=process_blob_dir())
+
+
+# ============================
+# MULTI-PROCESS WORKERS
+# ============================
+
+class SharedState:
+    """Global state owned by the supervisor and called by workers over a Unix socket.
+    
+    The supervisor's session_manager and usage_ledger are the single source of
+    truth; workers keep only local mirrors of their own sockets.
+    """
+    RPC_METHODS = {'check_session', 'release_session', 'touch_sessions', 'add_usage', 'publish_worker',
+                   'take_evictions', 'merge_destinations', 'quota_snapshot'}
+    
+    def __init__(self):
+        self.worker_stats = {}  # {worker_id: (timestamp, stats)}
+        self.evictions = defaultdict(list)  # {worker_id: [(username, device_ip), ...]}
+        self.lock_resets = set()  # Worker ids that have not yet picked up a LOCKS RESET
+        self.lock = make_lock("shared_state")
+    
+    def check_session(self, username, device_ip, worker_id):
+        """Run the one-device-per-user check. Returns (allowed, message, reply_bytes)."""
+        return session_manager.acquire_remote(username, device_ip, worker_id)
+    
+    def release_session(self, username, device_ip, worker_id):
+        session_manager.release_remote(username, device_ip, worker_id)
+    
+    def touch_sessions(self, activity):
+        session_manager.touch_remote(activity)
+    
+    def add_usage(self, deltas):
+        for username, bytes_used in deltas.items():
+            usage_ledger.record(username, bytes_used)
+    
+    def merge_destinations(self, exported):
+        destination_stats.merge(exported)
+    
+    def quota_snapshot(self):
+        return quota_manager.snapshot()
+    
+    def publish_worker(self, worker_id, stats):
+        """Store a worker's stats. Returns True if the worker should reset its lock counters."""
+        with self.lock:
+            self.worker_stats[worker_id] = (time.time(), stats)
+            if worker_id in self.lock_resets:
+                self.lock_resets.discard(worker_id)
+                return True
+        return False
+    
+    def request_lock_reset(self):
+        """Ask every live worker to reset its lock counters on its next sync."""
+        with self.lock:
+            self.lock_resets.update(self.worker_stats)
+    
+    def queue_eviction(self, worker_id, username, device_ip):
+        with self.lock:
+            self.evictions[worker_id].append((username, device_ip))
+    
+    def take_evictions(self, worker_id):
+        with self.lock:
+            return self.evictions.pop(worker_id, [])
+    
+    def live_worker_stats(self, max_age=5):
+        """Return stats published recently by live workers."""
+        now = time.time()
+        with self.lock:
+            return [stats for timestamp, stats in self.worker_stats.values() if now - timestamp < max_age]
+
+
+class SharedStateClient:
+    """Pooled RPC client used by workers to call the supervisor's SharedState.
+    
+    Connections are reused across threads, so a CONNECT costs one round trip on an
+    already-authenticated Unix socket rather than a new connection.
+    """
+    def __init__(self, address, authkey):
+        self.address = address
+        self.authkey = authkey
+        self.pool = queue.LifoQueue()
+    
+    def call(self, method, *args):
+        try:
+            conn = self.pool.get_nowait()
+        except queue.Empty:
+            conn = Client(self.address, family='AF_UNIX', authkey=self.authkey)
+        try:
+            conn.send((method, args))
+            ok, result = conn.recv()
+        except Exception:
+            conn.close()
+            raise
+        self.pool.put(conn)
+        if not ok:
+            raise RuntimeError(result)
+        return result
+    
+    def __getattr__(self, method):
+        if method not in SharedState.RPC_METHODS:
+            raise AttributeError(method)
+        return lambda *args: self.call(method, *args)
+
+
+def _serve_shared_state_connection(conn, state):
+    """Answer RPCs from one worker connection until it closes."""
+    try:
+        while True:
+            try:
+                method, args = conn.recv()
+            except (EOFError, OSError):
+                return
+            if method not in SharedState.RPC_METHODS:
+                conn.send((False, f"Unknown method: {method}"))
+                continue
+            try:
+                conn.send((True, getattr(state, method)(*args)))
+            except Exception as e:
+                conn.send((False, str(e)))
+    finally:
+        conn.close()
+
+
+def start_shared_state_server():
+    """Serve SharedState to workers on a Unix socket (once per supervisor process)."""
+    global supervisor_state
+    if supervisor_state is not None:
+        return supervisor_state.address, supervisor_state.authkey
+    
+    state = SharedState()
+    state.address = os.path.join(tempfile.gettempdir(), f"helio_proxy_{os.getpid()}.sock")
+    state.authkey = os.urandom(32)
+    if os.path.exists(state.address):
+        os.remove(state.address)
+    listener = Listener(state.address, family='AF_UNIX', authkey=state.authkey)
+    atexit.register(lambda: os.path.exists(state.address) and os.remove(state.address))
+    
+    def accept_loop():
+        while True:
+            try:
+                conn = listener.accept()
+            except Exception as e:
+                print(f"[!] Shared state connection rejected: {e}")
+                continue
+            threading.Thread(target=_serve_shared_state_connection, args=(conn, state), daemon=True).start()
+    
+    threading.Thread(target=accept_loop, daemon=True).start()
+    supervisor_state = state
+    return state.address, state.authkey
+
+
+def connect_shared_state():
+    """Connect this worker to the supervisor's shared state."""
+    global shared_state
+    if shared_state is None:
+        shared_state = SharedStateClient(
+            os.environ["PROXY_STATE_ADDRESS"],
+            bytes.fromhex(os.environ["PROXY_STATE_AUTHKEY"]),
+        )
+        usage_ledger.remote = shared_state
+        destination_stats.remote = shared_state
+        quota_manager.remote = shared_state
+        quota_manager.version = -1  # Limits are not read from disk here; take the supervisor's on first sync
+
+
+def start_worker_sync_thread():
+    """Publish this worker's stats and apply evictions from the supervisor."""
+    def sync_with_supervisor():
+        failures = 0
+        while True:
+            time.sleep(WORKER_SYNC_INTERVAL)
+            try:
+                stats = {
+                    'pid': os.getpid(),
+                    'dns_count': len(dns_resolver),
+                    'page_count': len(cache_manager.page_cache) + len(cache_manager.page_index),
+                    'conn_count': len(warm_pool),
+                    'clients': active_clients.items(),
+                    'locks': lock_report(),
+                    'worker_id': WORKER_ID,
+                    'metrics': metrics.snapshot(),
+                }
+                if shared_state.publish_worker(WORKER_ID, stats):
+                    reset_lock_stats()
+                activity = session_manager.take_activity()
+                if activity:
+                    shared_state.touch_sessions(activity)
+                for username, device_ip in shared_state.take_evictions(WORKER_ID):
+                    session_manager.close_local(username, device_ip)
+                quota_manager.apply_remote(shared_state.quota_snapshot())
+                failures = 0
+            except Exception as e:
+                failures += 1
+                print(f"[!] Worker {WORKER_ID} sync error: {e}")
+                if failures >= 5:
+                    print(f"[!] Worker {WORKER_ID} lost contact with supervisor, exiting")
+                    os._exit(1)
+    
+    sync_thread = threading.Thread(target=sync_with_supervisor, daemon=True)
+    sync_thread.start()
+    return sync_thread
+
+
+def collect_proxy_stats():
+    """Return status counts and active clients for this process plus any live workers."""
+    stats = {
+        'dns_count': len(dns_resolver),
+        'page_count': len(cache_manager.page_cache) + len(cache_manager.page_index),
+        'conn_count': len(warm_pool),
+        'clients': active_clients.items(),
+        'workers': 0,
+    }
+    lock_reports = [lock_report()]
+    if supervisor_state is not None:
+        for worker in supervisor_state.live_worker_stats():
+            stats['dns_count'] += worker['dns_count']
+            stats['page_count'] += worker['page_count']
+            stats['conn_count'] += worker['conn_count']
+            stats['clients'].extend(worker['clients'])
+            lock_reports.append(worker['locks'])
+            stats['workers'] += 1
+    stats['locks'] = merge_lock_reports(lock_reports)
+    return stats
+
+
+def collect_metrics():
+    """Render this process's metrics plus live workers' (labelled by worker) as OpenMetrics text."""
+    snapshots = [((("worker", "supervisor"),) if supervisor_state is not None else (), metrics.snapshot())]
+    if supervisor_state is not None:
+        for worker in supervisor_state.live_worker_stats():
+            snapshots.append(((("worker", str(worker['worker_id'])),), worker['metrics']))
+    return render_openmetrics(snapshots)
+
+
+def spawn_worker(worker_id, address, authkey):
+    """Start one worker process running this file with PROXY_WORKER_ID set."""
+    env = dict(os.environ)
+    env["PROXY_WORKER_ID"] = str(worker_id)
+    env["PROXY_STATE_ADDRESS"] = address
+    env["PROXY_STATE_AUTHKEY"] = authkey.hex()
+    proc = subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env)
+    server_logger.log(f"[*] Started worker {worker_id} (pid {proc.pid})")
+    return proc
+
+
+def start_supervisor(num_workers):
+    """Run num_workers proxy processes sharing LISTEN_PORT via SO_REUSEPORT.
+    
+    The supervisor owns sessions, usage and the user table, serves them to workers,
+    runs the monitor server (aggregating across workers) and respawns dead workers.
+    """
+    get_cipher()
+    address, authkey = start_shared_state_server()
+    
+    server_logger.log(f"[*] HTTPS Proxy Supervisor with {num_workers} workers")
+    server_logger.log(f"[*] Listening on {LISTEN_HOST}:{LISTEN_PORT} (SO_REUSEPORT)")
+    server_logger.log(f"[*] Monitor listening on {LISTEN_HOST}:{MONITOR_PORT}")
+    
+    usage_ledger.start_flusher()
+    quota_manager.start()
+    destination_stats.start()
+    session_manager.start()
+    start_user_reload_thread()
+    # Workers serve and own the page cache; loading it here too would only pin their blobs
+    monitor_thread = threading.Thread(target=start_monitor_server, daemon=True)
+    monitor_thread.start()
+    
+    # Make "docker stop" take the workers down with us
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    
+    workers = {worker_id: spawn_worker(worker_id, address, authkey) for worker_id in range(num_workers)}
+    try:
+        while True:
+            with restart_lock:
+                if restart_requested:
+                    print(f"[*] Supervisor detected restart signal, stopping workers...")
+                    break
+            for worker_id, proc in list(workers.items()):
+                if proc.poll() is not None:
+                    server_logger.log(f"[!] Worker {worker_id} exited with code {proc.returncode}, respawning")
+                    workers[worker_id] = spawn_worker(worker_id, address, authkey)
+            time.sleep(1)
+    except KeyboardInterrupt:
+        print("\n[*] Shutting down...")
+        usage_ledger.flush()
+    finally:
+        for proc in workers.values():
+            proc.terminate()
+        for proc in workers.values():
+            try:
+                proc.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+        usage_ledger.flush()  # Including what the workers forwarded on their way out
+
+
+# ============================
+# ZERO-DOWNTIME HANDOVER
+# ============================
+
+class KeptProcess:
+    """A proxy process the keeper started for us; stands in for the Popen of a direct child."""
+    def __init__(self, pid):
+        self.pid = pid
+    
+    def poll(self):
+        """None while the process is running (the keeper reaps it as soon as it exits)."""
+        try:
+            os.kill(self.pid, 0)
+        except ProcessLookupError:
+            return -1
+        return None
+    
+    def kill(self):
+        try:
+            os.kill(self.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+
+def spawn_successor(extra_env):
+    """Start the process a handover passes to: through the keeper if there is one, else as a child."""
+    if keeper_sock is None:
+        return subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=dict(os.environ, **extra_env))
+    request_id = os.urandom(8).hex()
+    keeper_sock.settimeout(HANDOVER_TIMEOUT)
+    keeper_sock.send(json.dumps({'id': request_id, 'env': extra_env}).encode())
+    while True:
+        reply = json.loads(keeper_sock.recv(4096))
+        if reply['id'] == request_id:  # Skip a late reply to an earlier, timed-out request
+            break
+    if not reply['pid']:
+        raise RuntimeError("keeper could not start a new process")
+    return KeptProcess(reply['pid'])
+
+
+def run_keeper():
+    """Run the proxy as a child of this process and keep this PID across RESTART HANDOVER.
+    
+    A handover's new process normally is a child of the old one, which exits after
+    draining; as PID 1 of a container (or the main PID of a service) that ends the
+    service. Under the keeper, handovers ask it to start the new process instead. It
+    forwards SIGTERM/SIGINT/SIGHUP to the proxy processes, reaps orphans when it is
+    PID 1 and exits with the status of the last proxy process.
+    """
+    keeper_end, proxy_end = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+    children = {}  # {pid: Popen}
+    lock = make_lock("keeper")
+    
+    def spawn(extra_env):
+        env = dict(os.environ, PROXY_KEEPER_FD=str(proxy_end.fileno()), **extra_env)
+        with lock:
+            process = subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env,
+                                       pass_fds=(proxy_end.fileno(),))
+            children[process.pid] = process
+        print(f"[*] Keeper: started proxy process {process.pid}")
+        return process
+    
+    def serve_spawn_requests():
+        while True:
+            request = json.loads(keeper_end.recv(65536))
+            try:
+                pid = spawn(request['env']).pid
+            except OSError as e:
+                print(f"[!] Keeper: could not start a new process: {e}")
+                pid = 0
+            keeper_end.send(json.dumps({'id': request['id'], 'pid': pid}).encode())
+    
+    def forward_signal(signum, frame):
+        for pid in list(children):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+    
+    spawn({})
+    for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+        signal.signal(signum, forward_signal)
+    threading.Thread(target=serve_spawn_requests, daemon=True).start()
+    
+    exit_code = 0
+    while True:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        with lock:
+            process = children.pop(pid, None)
+            remaining = len(children)
+        if process is None:
+            continue  # An orphan reparented to us as PID 1
+        process.returncode = exit_code = os.waitstatus_to_exitcode(status)
+        print(f"[*] Keeper: proxy process {pid} exited with code {exit_code}")
+        if not remaining:
+            break
+    sys.exit(exit_code if exit_code >= 0 else 128 - exit_code)
+
+
+class HandoverForwarder:
+    """Stands in for the supervisor RPC client in a draining process: usage and
+    destination stats from its remaining connections go to the new process."""
+    def __init__(self, handover):
+        self.handover = handover
+    
+    def add_usage(self, deltas):
+        self.handover.send(('usage', deltas))
+    
+    def merge_destinations(self, exported):
+        self.handover.send(('destinations', exported))
+
+
+def send_handover_message(conn, lock, message, fds=()):
+    """Send a message, and any file descriptors after it via SCM_RIGHTS."""
+    with lock:
+        conn.send(message)
+        if fds:
+            with socket.fromfd(conn.fileno(), socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                reduction.sendfds(sock, list(fds))
+
+
+def receive_handover_fds(conn, count):
+    with socket.fromfd(conn.fileno(), socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        return reduction.recvfds(sock, count)
+
+
+class ProxyHandover:
+    """Old-process side of RESTART HANDOVER.
+    
+    Starts a new process running this file, passes it the listening sockets over a Unix
+    socket with SCM_RIGHTS plus a snapshot of sessions, usage totals and DNS, and stops
+    accepting once it is ready. Both processes share the same listening socket, so
+    nothing is refused during the switch. Existing connections then either drain here
+    (their usage and session activity forwarded to the new process, which alone expires
+    sessions from then on) or, with TUNNELS on the threaded engine, are passed over
+    between two relay reads and carry on in the new process.
+    """
+    def __init__(self, with_tunnels=False):
+        self.with_tunnels = with_tunnels and PROXY_ENGINE == "threaded"
+        self.conn = None
+        self.process = None
+        self.completed = False
+        self.taking_tunnels = False
+        self.tunnels_passed = 0
+        self.drain_deadline = None
+        self.finished = threading.Event()
+        self.lock = make_lock("handover")
+    
+    def send(self, message, fds=()):
+        send_handover_message(self.conn, self.lock, message, fds)
+    
+    def _accept(self, listener):
+        """Wait for the new process to connect, giving up if it dies or takes too long."""
+        accepted = []
+        
+        def accept():
+            try:
+                accepted.append(listener.accept())
+            except Exception:
+                pass
+        
+        accept_thread = threading.Thread(target=accept, daemon=True)
+        accept_thread.start()
+        deadline = time.monotonic() + HANDOVER_TIMEOUT
+        while not accepted and time.monotonic() < deadline and self.process.poll() is None:
+            accept_thread.join(0.2)
+        if not accepted:
+            raise RuntimeError("new process did not connect")
+        return accepted[0]
+    
+    def start(self):
+        """Hand over to a new process. Returns a status message for the monitor.
+        
+        On success the caller sets restart_requested so this process stops accepting.
+        """
+        if not (cache_manager.loaded.is_set() and usage_ledger.totals_loaded.is_set() and users_ready.is_set()):
+            return "Handover refused: still loading state from disk after startup. Try again shortly.\n"
+        address = os.path.join(tempfile.gettempdir(), f"helio_proxy_handover_{os.getpid()}.sock")
+        authkey = os.urandom(32)
+        if os.path.exists(address):
+            os.remove(address)
+        listener = Listener(address, family='AF_UNIX', authkey=authkey)
+        
+        # Write the state the new process loads from disk, and stop writing it from here
+        cache_manager.stop_auto_save()
+        cache_manager._save_cache_async()
+        usage_ledger.flush()
+        usage_ledger.rollups.save(force=True)
+        
+        forwarder = HandoverForwarder(self)
+        try:
+            self.process = spawn_successor({'PROXY_HANDOVER_ADDRESS': address, 'PROXY_HANDOVER_AUTHKEY': authkey.hex()})
+            server_logger.log(f"[*] Handover: started new process (pid {self.process.pid})")
+            self.conn = self._accept(listener)
+            state = {
+                'sessions': session_manager.export(),
+                'dns': dns_resolver.export(),
+                'usage_totals': usage_ledger.snapshot_totals(),
+            }
+            self.send(('state', state), [listening_sockets['proxy'].fileno(), listening_sockets['monitor'].fileno()])
+            usage_ledger.remote = destination_stats.remote = quota_manager.remote = forwarder
+            if not self.conn.poll(HANDOVER_TIMEOUT) or self.conn.recv() != ('ready',):
+                raise RuntimeError("new process did not become ready")
+        except Exception as e:
+            usage_ledger.remote = destination_stats.remote = quota_manager.remote = None
+            if self.conn is not None:
+                self.conn.close()
+            if self.process is not None:
+                self.process.kill()
+            cache_manager.start_auto_save()
+            server_logger.log(f"[!] Handover failed: {e}")
+            return f"Handover failed: {e}. Still serving from this process.\n"
+        finally:
+            listener.close()
+            if os.path.exists(address):
+                os.remove(address)
+        
+        # The new process owns the rollups file, session expiry and the blob store from now on
+        atexit.unregister(usage_ledger.rollups.save)
+        cache_manager.blobs.owner = False
+        session_manager.expiring = False
+        threading.Thread(target=self._forward_activity, daemon=True).start()
+        self.drain_deadline = time.monotonic() + HANDOVER_DRAIN_TIMEOUT
+        self.taking_tunnels = self.with_tunnels
+        self.completed = True
+        open_clients = len(active_clients)
+        server_logger.log(f"[*] Handover: pid {self.process.pid} is accepting; "
+                          f"{'passing on' if self.taking_tunnels else 'draining'} {open_clients} connection(s)")
+        return (f"Handed over to pid {self.process.pid}. "
+                f"{'Passing on' if self.taking_tunnels else 'Draining'} {open_clients} open connection(s).\n")
+    
+    def _forward_activity(self):
+        """Keep sessions with draining connections alive in the new process."""
+        while not self.finished.wait(WORKER_SYNC_INTERVAL):
+            activity = session_manager.take_activity()
+            if activity:
+                try:
+                    self.send(('activity', activity))
+                except Exception as e:
+                    print(f"[!] Handover: could not forward session activity: {e}")
+                    return
+    
+    def pass_tunnel(self, client, remote, host, port, username, session):
+        """Send a live tunnel's sockets to the new process. Returns True if it took them."""
+        device_ip = session.device_ip if session is not None else client.getpeername()[0]
+        try:
+            self.send(('tunnel', (username, device_ip, host, port)), [client.fileno(), remote.fileno()])
+        except Exception as e:
+            print(f"[!] Handover: could not pass tunnel for {username}: {e}")
+            self.taking_tunnels = False
+            return False
+        self.tunnels_passed += 1
+        return True
+    
+    def draining(self):
+        """True while this process still has client connections and time left to finish them."""
+        return len(active_clients) > 0 and time.monotonic() < self.drain_deadline
+    
+    def drain(self):
+        """Wait for remaining connections, forward their last usage and let the new process know."""
+        while self.draining():
+            time.sleep(1)
+        self.finished.set()
+        usage_ledger.flush()
+        destination_stats.rollover()
+        try:
+            self.send(('done',))
+            self.conn.close()
+        except Exception as e:
+            print(f"[!] Handover: error closing connection to new process: {e}")
+        server_logger.log(f"[*] Handover complete ({self.tunnels_passed} tunnel(s) passed on); exiting")
+
+
+def adopt_tunnel(details, fds):
+    """New process: carry on relaying a tunnel passed over by the old process."""
+    username, device_ip, host, port = details
+    client = socket.socket(fileno=fds[0])
+    remote = socket.socket(fileno=fds[1])
+    for sock in (client, remote):
+        sock.setblocking(True)
+    try:
+        addr = client.getpeername()
+    except OSError:
+        client.close()
+        remote.close()
+        return
+    session, msg = session_manager.acquire(username, device_ip, client)
+    if session is None:
+        remote.close()
+        return
+    active_clients.add(addr, username)
+    try:
+        tunnel(client, remote, host, port, username, b"", session)
+    finally:
+        release_client_session(session, client, addr)
+
+
+def _serve_handover_connection(conn):
+    """New process: apply usage, destination stats and tunnels sent by the draining process."""
+    while True:
+        try:
+            kind, *payload = conn.recv()
+        except (EOFError, OSError):
+            break
+        if kind == 'usage':
+            for username, bytes_used in payload[0].items():
+                usage_ledger.record(username, bytes_used)
+        elif kind == 'destinations':
+            destination_stats.merge(payload[0])
+        elif kind == 'activity':
+            session_manager.touch_remote(payload[0])
+        elif kind == 'tunnel':
+            fds = receive_handover_fds(conn, 2)
+            threading.Thread(target=adopt_tunnel, args=(payload[0], fds), daemon=True).start()
+        elif kind == 'done':
+            break
+    conn.close()
+    server_logger.log(f"[*] Handover: previous process finished")
+
+
+def receive_handover(address, authkey):
+    """New process: take over the listening sockets and state from the old process.
+    
+    Returns (conn, proxy_sock, monitor_sock); send ('ready',) on conn once accepting.
+    """
+    conn = Client(address, family='AF_UNIX', authkey=authkey)
+    kind, state = conn.recv()
+    proxy_fd, monitor_fd = receive_handover_fds(conn, 2)
+    session_manager.restore(state['sessions'])
+    dns_resolver.seed(state['dns'])
+    with usage_ledger.lock:
+        usage_ledger.totals.update(state['usage_totals'])
+    usage_ledger.totals_loaded.set()  # Exact in-memory totals; the file may be a flush behind
+    threading.Thread(target=_serve_handover_connection, args=(conn,), daemon=True).start()
+    server_logger.log(f"[*] Handover: took over listening sockets, {len(state['sessions'])} sessions "
+                      f"and {len(state['dns'])} DNS entries")
+    return conn, socket.socket(fileno=proxy_fd), socket.socket(fileno=monitor_fd)
+
+
+# ============================
+# HTTPS PROXY HANDLER
+# ============================
+
+PROXY_AUTH_REQUIRED_RESPONSE = (
+    b"HTTP/1.1 407 Proxy Authentication Required\r\n"
+    b"Proxy-Authenticate: Basic realm=\"Home PC Proxy\"\r\n"
+    b"Connection: close\r\n"
+    b"\r\n"
+)
+CONNECTION_ESTABLISHED_RESPONSE = b"HTTP/1.1 200 Connection Established\r\n\r\n"
+BAD_GATEWAY_RESPONSE = b"HTTP/1.1 502 Bad Gateway\r\nConnection: close\r\n\r\n"
+GATEWAY_TIMEOUT_RESPONSE = b"HTTP/1.1 504 Gateway Timeout\r\nConnection: close\r\n\r\n"
+HEADERS_TOO_LARGE_RESPONSE = b"HTTP/1.1 431 Request Header Fields Too Large\r\nConnection: close\r\n\r\n"
+
+
+def build_access_hours_response(current_time):
+    """Build the 403 response sent outside allowed proxy access hours."""
+    response = f"HTTP/1.1 403 Forbidden\r\n"
+    response += f"Connection: close\r\n"
+    response += f"\r\n"
+    response += f"Proxy access is only allowed from {PROXY_ACCESS_START_HOUR}:{PROXY_ACCESS_START_MINUTE:02d} to {PROXY_ACCESS_END_HOUR}:{PROXY_ACCESS_END_MINUTE:02d}. Current time: {current_time}"
+    return response.encode()
+
+
+def read_request_head(sock, limit=HTTP_MAX_HEADER_BYTES):
+    """Read a request head with recv_into on a reusable per-thread buffer.
+    
+    Returns (head, early_data): head runs through the blank line, early_data is whatever
+    the client already sent after it (e.g. an optimistic TLS ClientHello). Returns None if
+    the client closed first; raises ValueError if the head does not fit in limit bytes.
+    """
+    buf = getattr(_request_buffers, 'buf', None)
+    if buf is None or len(buf) != limit:
+        buf = _request_buffers.buf = bytearray(limit)
+    view = memoryview(buf)
+    filled = 0
+    try:
+        while True:
+            if filled == limit:
+                raise ValueError("request head too large")
+            received = sock.recv_into(view[filled:])
+            if not received:
+                return None
+            # Only rescan the new bytes plus a possible delimiter split across reads
+            end = buf.find(b"\r\n\r\n", max(0, filled - 3), filled + received)
+            filled += received
+            if end >= 0:
+                end += 4
+                return bytes(view[:end]), bytes(view[end:filled])
+    finally:
+        view.release()
+
+
+_request_buffers = threading.local()
+
+
+def parse_connect_request(request):
+    """Parse a CONNECT request head (bytes). Returns (host, port, auth_header) or None if malformed."""
+    line_end = request.find(b"\r\n")
+    parts = request[:line_end].split()
+    
+    # Check if it's a CONNECT request
+    if len(parts) < 2 or parts[0] != b"CONNECT":
+        return None
+    
+    # Parse host and port ([v6]:port or host:port)
+    host, sep, port = parts[1].rpartition(b":")
+    if not sep or not host:
+        return None
+    try:
+        port = int(port)
+        host = host.decode('ascii')
+    except (ValueError, UnicodeDecodeError):
+        return None
+    if host.startswith("[") and host.endswith("]"):
+        host = host[1:-1]
+    
+    # Find the authentication header without splitting the head into lines
+    auth_header = None
+    start = request.lower().find(b"\r\nproxy-authorization:", line_end)
+    if start >= 0:
+        start += len(b"\r\nproxy-authorization:")
+        auth_header = request[start:request.find(b"\r\n", start)].strip().decode('latin-1')
+    
+    return host, port, auth_header
+
+
+def proxy_auth_token(auth_header):
+    """Extract the Basic token from a Proxy-Authorization header value, or None."""
+    if not auth_header or not auth_header.startswith("Basic "):
+        return None
+    return auth_header.split(" ", 1)[1].strip() or None
+
+
+def authenticate_proxy_request(auth_header):
+    """Validate a Proxy-Authorization header value. Returns the username or None.
+    
+    Cached verifications answer immediately; otherwise the KDF runs on the auth pool and
+    this thread waits for it. Right after startup it first waits for the user table.
+    """
+    token = proxy_auth_token(auth_header)
+    if token is None:
+        return None
+    if not users_ready.is_set():
+        users_ready.wait(USERS_READY_TIMEOUT)
+    cached, username = auth_cache.lookup(token)
+    if cached:
+        return username
+    return auth_cache.kdf_pool.submit(auth_cache.verify, token).result()
+
+
+async def authenticate_proxy_request_async(auth_header):
+    """Event-loop version of authenticate_proxy_request(): a cache miss awaits the auth pool."""
+    token = proxy_auth_token(auth_header)
+    if token is None:
+        return None
+    if not users_ready.is_set():
+        await asyncio.get_running_loop().run_in_executor(None, users_ready.wait, USERS_READY_TIMEOUT)
+    cached, username = auth_cache.lookup(token)
+    if cached:
+        return username
+    return await asyncio.get_running_loop().run_in_executor(auth_cache.kdf_pool, auth_cache.verify, token)
+
+
+def release_client_session(session, handle, addr):
+    """Drop a disconnected client from active clients and its session (which logs DISCONNECT once)."""
+    active_clients.remove(addr)
+    try:
+        session_manager.release(session, handle)
+    except Exception as e:
+        print(f"[!] Error releasing session for {session.username}: {e}")
+
+
+def interleave_address_families(addresses):
+    """Order addresses for Happy Eyeballs (RFC 8305 section 4): alternate families, first family first."""
+    if not addresses:
+        return []
+    first_family = addresses[0][0]
+    primary = [address for address in addresses if address[0] == first_family]
+    secondary = [address for address in addresses if address[0] != first_family]
+    ordered = []
+    for index in range(max(len(primary), len(secondary))):
+        if index < len(primary):
+            ordered.append(primary[index])
+        if index < len(secondary):
+            ordered.append(secondary[index])
+    return ordered
+
+
+def race_connect(addresses, port, timeout=UPSTREAM_CONNECT_TIMEOUT, delay=HAPPY_EYEBALLS_DELAY):
+    """Happy Eyeballs connect: start attempts `delay` apart (or as soon as one fails), keep the first to succeed.
+    
+    Returns (socket, winning_address, failed_addresses). Raises socket.timeout if nothing
+    connected in time, or the last connection error if every address failed.
+    """
+    pending = interleave_address_families(addresses)
+    attempts = {}  # {socket: (family, ip)}
+    failed = []
+    last_error = None
+    deadline = time.monotonic() + timeout
+    next_start = time.monotonic()
+    
+    try:
+        while pending or attempts:
+            now = time.monotonic()
+            if now >= deadline:
+                break
+            
+            if pending and (now >= next_start or not attempts):
+                address = pending.pop(0)
+                sock = socket.socket(address[0], socket.SOCK_STREAM)
+                sock.setblocking(False)
+                err = sock.connect_ex((address[1], port))
+                if err in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN):
+                    attempts[sock] = address
+                    next_start = now + delay
+                else:
+                    sock.close()
+                    failed.append(address)
+                    last_error = OSError(err, os.strerror(err))
+                continue
+            
+            wait = deadline - now
+            if pending:
+                wait = min(wait, next_start - now)
+            _, writable, _ = select.select([], list(attempts), [], max(wait, 0))
+            for sock in writable:
+                address = attempts.pop(sock)
+                err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if err == 0:
+                    sock.setblocking(True)
+                    sock.settimeout(timeout)
+                    return sock, address, failed
+                sock.close()
+                failed.append(address)
+                last_error = OSError(err, os.strerror(err))
+                next_start = time.monotonic()  # Failure: start the next attempt right away
+    finally:
+        for sock in attempts:
+            sock.close()
+    
+    if last_error is None or attempts or time.monotonic() >= deadline:
+        raise socket.timeout(f"Timed out connecting on port {port}")
+    raise last_error
+
+
+def connect_upstream(host, port, timeout=UPSTREAM_CONNECT_TIMEOUT):
+    """Resolve host through the DNS cache and race connections across its addresses.
+    
+    The winning address is moved to the front of the DNS cache so later connects try it first.
+    Raises socket.timeout if nothing answered in time (504), other OSErrors otherwise (502).
+    """
+    addresses = dns_resolver.resolve(host)
+    started = time.monotonic()
+    sock, winner, failed = race_connect(addresses, port, timeout)
+    metric_upstream_connect.observe(time.monotonic() - started)
+    dns_resolver.record_connect(host, winner, failed)
+    return sock
+
+
+def handle_client(client_sock, addr):
+    """Handle incoming proxy connections: CONNECT tunnels and absolute-URI GET/HEAD requests."""
+    authenticated_user = None
+    accepted_at = time.monotonic()
+    try:
+        # Read the request head; bytes the client sent after it are kept as early data
+        try:
+            received = read_request_head(client_sock)
+        except ValueError:
+            count_connection("rejected", 431)
+            client_sock.sendall(HEADERS_TOO_LARGE_RESPONSE)
+            client_sock.close()
+            return
+        if received is None:
+            client_sock.close()
+            return
+        request, early_data = received
+        
+        # Parse the request
+        http_request = None
+        parsed = parse_connect_request(request)
+        if parsed is None:
+            http_request = parse_http_request(request)
+            if http_request is None:
+                client_sock.close()
+                return
+            host, port, auth_header = http_request.host, http_request.port, http_request.auth_header
+        else:
+            host, port, auth_header = parsed
+        
+        # Validate token and get username
+        authenticated_user = authenticate_proxy_request(auth_header)
+        if authenticated_user is None:
+            count_connection("rejected", 407)
+            client_sock.sendall(PROXY_AUTH_REQUIRED_RESPONSE)
+            client_sock.close()
+            return
+        
+        device_ip = addr[0]
+        server_logger.log(f"[*] Authenticated user: {authenticated_user} from device {device_ip}")
+        
+        # Check if proxy access is allowed at this time
+        if not is_proxy_access_allowed():
+            current_time = time.strftime("%H:%M")
+            count_connection("rejected", 403)
+            client_sock.sendall(build_access_hours_response(current_time))
+            client_sock.close()
+            print(f"[!] Access denied for {authenticated_user} - outside allowed hours ({current_time})")
+            return
+        
+        # Refuse users who have used up a data quota
+        reason = quota_manager.refusal(authenticated_user)
+        if reason:
+            count_connection("rejected", 403)
+            client_sock.sendall(build_quota_response(reason))
+            client_sock.close()
+            print(f"[!] Access denied for {authenticated_user} - {reason}")
+            return
+        
+        # Check and manage user sessions (one device per user with 3-minute timeout)
+        session, msg = session_manager.acquire(authenticated_user, device_ip, client_sock)
+        server_logger.log(f"[*] {msg}")
+        if session is None:
+            # Session check already sent error response and closed socket
+            count_connection("rejected", 407)
+            return
+        active_clients.add(addr, authenticated_user)
+        
+        try:
+            if http_request is not None:
+                count_connection("accepted")
+                serve_http_client(client_sock, addr, BufferedReader(client_sock, early_data), http_request,
+                                  authenticated_user, session)
+                return
+            
+            remote_sock = warm_pool.acquire(host, port)
+            connect_latency = None
+            
+            # If no warm connection is ready, create new connection
+            if remote_sock is None:
+                try:
+                    connect_started = time.monotonic()
+                    remote_sock = connect_upstream(host, port)
+                    connect_latency = time.monotonic() - connect_started
+                except socket.timeout:
+                    count_connection("failed", 504)
+                    client_sock.sendall(GATEWAY_TIMEOUT_RESPONSE)
+                    client_sock.close()
+                    return
+                except Exception as e:
+                    count_connection("failed", 502)
+                    client_sock.sendall(BAD_GATEWAY_RESPONSE)
+                    client_sock.close()
+                    return
+            else:
+                print(f"[*] Using warm connection to {host}:{port}")
+            destination_stats.record_connect(host, port, connect_latency)
+            
+            # Send 200 response
+            client_sock.sendall(CONNECTION_ESTABLISHED_RESPONSE)
+            count_connection("accepted")
+            metric_time_to_established.observe(time.monotonic() - accepted_at)
+            
+            # Tunnel data bidirectionally (pass authenticated_user to check if deleted)
+            tunnel(client_sock, remote_sock, host, port, authenticated_user, early_data, session)
+        
+        except Exception as e:
+            print(f"[Error] {e}")
+        finally:
+            # Release the session on disconnect (logs DISCONNECT only once)
+            release_client_session(session, client_sock, addr)
+            try:
+                client_sock.close()
+            except:
+                pass
+    
+    except Exception as e:
+        print(f"[Error in handle_client] {e}")
+        try:
+            client_sock.close()
+        except:
+            pass
+
+
+def copy_transfer(src, dst):
+    """Move one chunk from src to dst through user space. Returns bytes moved, 0 on EOF."""
+    data = src.recv(RELAY_CHUNK_SIZE)
+    if data:
+        dst.sendall(data)
+    return len(data)
+
+
+class SpliceRelay:
+    """Zero-copy relay that moves socket data through kernel pipes with os.splice().
+    
+    Each direction gets its own pipe so a half-drained pipe never mixes streams.
+    Falls back to copy_transfer() if the kernel refuses to splice these sockets.
+    """
+    def __init__(self, client, remote):
+        self.pipes = {}
+        self.fallback = False
+        # Blocking writes mirror sendall(); reads only happen after select() says readable
+        client.settimeout(None)
+        remote.settimeout(None)
+        for sock in (client, remote):
+            self.pipes[sock] = os.pipe()
+    
+    def transfer(self, src, dst):
+        """Move one chunk from src to dst. Returns bytes moved, 0 on EOF, None if nothing was ready."""
+        if self.fallback:
+            return copy_transfer(src, dst)
+        pipe_r, pipe_w = self.pipes[src]
+        try:
+            moved = os.splice(src.fileno(), pipe_w, SPLICE_CHUNK_SIZE,
+                              flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+        except BlockingIOError:
+            return None
+        except OSError as e:
+            if e.errno in (errno.EINVAL, errno.ENOSYS):
+                print(f"[!] splice() unsupported for this connection, falling back to copy relay")
+                self.fallback = True
+                return copy_transfer(src, dst)
+            raise
+        remaining = moved
+        while remaining:
+            remaining -= os.splice(pipe_r, dst.fileno(), remaining, flags=os.SPLICE_F_MOVE)
+        return moved
+    
+    def close(self):
+        for pipe_r, pipe_w in self.pipes.values():
+            for fd in (pipe_r, pipe_w):
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
+        self.pipes.clear()
+
+
+def tunnel(client, remote, host, port, authenticated_user, early_data=b"", session=None):
+    """Tunnel data bidirectionally and check if user still exists.
+    
+    early_data is client data that arrived with the CONNECT head; it is sent upstream first.
+    Traffic in either direction keeps session from idling out.
+    """
+    check_interval = 0
+    splice_relay = None
+    transfer = copy_transfer
+    connection_usage = usage_ledger.open_connection(authenticated_user, host, port)
+    flow = bandwidth_shaper.open_flow(authenticated_user)
+    quota = quota_manager.account(authenticated_user) if QUOTA_ACTION == "refuse" else None
+    metric_tunnels_opened.inc()
+    
+    try:
+        if early_data:
+            remote.sendall(early_data)
+            log_data_usage(authenticated_user, len(early_data), connection_usage)
+            metric_bytes_upstream.inc(len(early_data))
+            wait = flow.reserve(len(early_data))
+            if wait > 0:
+                time.sleep(wait)
+        
+        if RELAY_MODE == "splice" and hasattr(os, "splice"):
+            try:
+                splice_relay = SpliceRelay(client, remote)
+                transfer = splice_relay.transfer
+            except OSError as e:
+                print(f"[!] Could not set up splice relay ({e}), using copy relay")
+        
+        while True:
+            # Between reads nothing is buffered here, so a handover can move the sockets
+            if proxy_handover is not None and proxy_handover.taking_tunnels:
+                if proxy_handover.pass_tunnel(client, remote, host, port, authenticated_user, session):
+                    if session is not None:
+                        session.disconnect_logged = True  # The user did not disconnect
+                    return
+            
+            # Only check if user still exists every 10 iterations (not every select)
+            check_interval += 1
+            if check_interval % 10 == 0:
+                if authenticated_user not in PROXY_USERS:
+                    print(f"[!] User {authenticated_user} was deleted. Disconnecting.")
+                    log_login(authenticated_user, "0.0.0.0", "DISCONNECT_USER_DELETED_MID_SESSION")
+                    return
+            
+            readable, _, exceptional = select.select([client, remote], [], [client, remote], 1)
+            
+            if exceptional:
+                break
+            
+            for sock in readable:
+                try:
+                    num_bytes = transfer(sock, remote if sock is client else client)
+                    if num_bytes is None:
+                        continue
+                    if not num_bytes:
+                        return
+                    
+                    # Log data usage
+                    log_data_usage(authenticated_user, num_bytes, connection_usage)
+                    (metric_bytes_upstream if sock is client else metric_bytes_downstream).inc(num_bytes)
+                    if session is not None:
+                        session.touch()
+                    if quota is not None and quota.exhausted:
+                        print(f"[!] User {authenticated_user} is over their data quota. Disconnecting.")
+                        log_login(authenticated_user, "0.0.0.0", "DISCONNECT_QUOTA_EXCEEDED")
+                        return
+                    
+                    # Pace the tunnel to its share of the bandwidth
+                    wait = flow.reserve(num_bytes)
+                    if wait > 0:
+                        time.sleep(wait)
+                except:
+                    return
+    except:
+        pass
+    finally:
+        metric_tunnels_closed.inc()
+        usage_ledger.close_connection(connection_usage)
+        destination_stats.record_close(connection_usage)
+        bandwidth_shaper.close_flow(flow)
+        if splice_relay:
+            splice_relay.close()
+        for sock in (client, remote):
+            try:
+                sock.close()
+            except:
+                pass
+
+
+# ============================
+# HTTP FORWARD PROXY
+# ============================
+
+HTTP_HOP_BY_HOP_HEADERS = {
+    'connection', 'proxy-connection', 'keep-alive', 'proxy-authorization', 'proxy-authenticate',
+    'te', 'trailer', 'transfer-encoding', 'upgrade',
+}
+HTTP_CACHE_INTERNAL_HEADER = 'X-Cache-Lifetime'  # Remaining freshness at store time; never sent to clients
+HTTP_NOT_IMPLEMENTED_RESPONSE = b"HTTP/1.1 501 Not Implemented\r\nConnection: close\r\nContent-Length: 0\r\n\r\n"
+HTTP_BAD_REQUEST_RESPONSE = b"HTTP/1.1 400 Bad Request\r\nConnection: close\r\nContent-Length: 0\r\n\r\n"
+HTTP_PAYLOAD_TOO_LARGE_RESPONSE = b"HTTP/1.1 413 Content Too Large\r\nConnection: close\r\nContent-Length: 0\r\n\r\n"
+
+
+class HttpRequest:
+    """An absolute-URI request (GET http://host/path HTTP/1.1) received in forward-proxy mode."""
+    __slots__ = ('method', 'version', 'host', 'port', 'path', 'headers', 'auth_header')
+
+    def __init__(self, method, version, host, port, path, headers, auth_header):
+        self.method = method
+        self.version = version
+        self.host = host
+        self.port = port
+        self.path = path  # Origin-form target including the query string
+        self.headers = headers  # [(name, value)] in received order
+        self.auth_header = auth_header
+
+
+class BufferedReader:
+    """Reads header blocks and exact byte counts from a socket-like object."""
+    def __init__(self, sock, initial=b""):
+        self.sock = sock
+        self.buffer = bytearray(initial)
+
+    def _fill(self):
+        chunk = self.sock.recv(65536)
+        if not chunk:
+            raise EOFError("connection closed")
+        self.buffer += chunk
+
+    def read_until(self, delimiter, limit):
+        """Read through delimiter (inclusive). Raises ValueError past limit, EOFError on close."""
+        start = 0
+        while True:
+            index = self.buffer.find(delimiter, start)
+            if index >= 0:
+                end = index + len(delimiter)
+                data = bytes(self.buffer[:end])
+                del self.buffer[:end]
+                return data
+            if len(self.buffer) > limit:
+                raise ValueError("header block too large")
+            start = max(0, len(self.buffer) - len(delimiter) + 1)
+            self._fill()
+
+    def read_some(self, max_bytes=65536):
+        """Return buffered bytes if any, otherwise the next chunk from the socket (b"" on close)."""
+        if not self.buffer:
+            return self.sock.recv(max_bytes)
+        data = bytes(self.buffer[:max_bytes])
+        del self.buffer[:max_bytes]
+        return data
+
+    def read_exact(self, count):
+        while len(self.buffer) < count:
+            self._fill()
+        data = bytes(self.buffer[:count])
+        del self.buffer[:count]
+        return data
+
+
+class OriginPool:
+    """Idle keep-alive connections to plain-HTTP origins, reused across clients."""
+    def __init__(self, max_per_origin=4, max_idle=WARM_POOL_IDLE_TIMEOUT):
+        self.max_per_origin = max_per_origin
+        self.max_idle = max_idle
+        self.idle = {}  # {(host, port): [(sock, idle_since), ...]} newest last
+        self.lock = make_lock("origin_pool")
+
+    def acquire(self, host, port):
+        """Pop the newest healthy idle connection, or None."""
+        stale = []
+        found = None
+        with self.lock:
+            connections = self.idle.get((host, port), [])
+            now = time.monotonic()
+            while connections:
+                sock, idle_since = connections.pop()
+                if now - idle_since < self.max_idle and is_idle_socket_healthy(sock):
+                    found = sock
+                    break
+                stale.append(sock)
+            if not connections:
+                self.idle.pop((host, port), None)
+        for sock in stale:
+            try:
+                sock.close()
+            except OSError:
+                pass
+        return found
+
+    def release(self, host, port, sock):
+        """Return a connection whose last response was fully read."""
+        with self.lock:
+            connections = self.idle.setdefault((host, port), [])
+            if len(connections) < self.max_per_origin:
+                connections.append((sock, time.monotonic()))
+                return
+        try:
+            sock.close()
+        except OSError:
+            pass
+
+
+origin_pool = OriginPool()
+
+
+def parse_http_head(head):
+    """Split a header block into (first_line, [(name, value)])."""
+    lines = head.decode('latin-1').split("\r\n")
+    headers = []
+    for line in lines[1:]:
+        if not line:
+            continue
+        if ":" not in line:
+            return lines[0], None
+        name, value = line.split(":", 1)
+        headers.append((name.strip(), value.strip()))
+    return lines[0], headers
+
+
+def header_value(headers, name):
+    """Comma-join every value of a header (case-insensitive), or None if absent."""
+    name = name.lower()
+    values = [value for header, value in headers if header.lower() == name]
+    return ", ".join(values) if values else None
+
+
+def parse_cache_control(value):
+    """Parse a Cache-Control value into {directive: argument or True}."""
+    directives = {}
+    for part in (value or "").split(","):
+        part = part.strip()
+        if not part:
+            continue
+        name, _, argument = part.partition("=")
+        directives[name.strip().lower()] = argument.strip().strip('"') if argument else True
+    return directives
+
+
+def parse_http_request(request):
+    """Parse an absolute-URI proxy request head. Returns an HttpRequest or None if malformed."""
+    first_line, headers = parse_http_head(request.split(b"\r\n\r\n", 1)[0])
+    parts = first_line.split()
+    if headers is None or len(parts) != 3 or not parts[2].startswith("HTTP/1."):
+        return None
+    method, target, version = parts
+    url = urlsplit(target)
+    if url.scheme.lower() != "http" or not url.hostname:
+        return None
+    try:
+        port = url.port or 80
+    except ValueError:
+        return None
+    path = url.path or "/"
+    if url.query:
+        path += "?" + url.query
+    return HttpRequest(method.upper(), version, url.hostname, port, path, headers,
+                       header_value(headers, "Proxy-Authorization"))
+
+
+def end_to_end_headers(headers):
+    """Drop hop-by-hop headers, including any named in Connection."""
+    named = {token.strip().lower() for token in (header_value(headers, "Connection") or "").split(",")}
+    return [(name, value) for name, value in headers
+            if name.lower() not in HTTP_HOP_BY_HOP_HEADERS and name.lower() not in named]
+
+
+def wants_keep_alive(version, headers):
+    tokens = {token.strip().lower() for token in
+              ((header_value(headers, "Connection") or "") + "," + (header_value(headers, "Proxy-Connection") or "")).split(",")}
+    if version == "HTTP/1.0":
+        return "keep-alive" in tokens
+    return "close" not in tokens
+
+
+def freshness_lifetime(headers, cache_control):
+    """Seconds a response stays fresh in a shared cache (RFC 9111 section 4.2.1), minus its Age."""
+    lifetime = 0
+    if 's-maxage' in cache_control or 'max-age' in cache_control:
+        try:
+            lifetime = int(cache_control.get('s-maxage', cache_control.get('max-age')))
+        except (TypeError, ValueError):
+            lifetime = 0
+    else:
+        try:
+            date = email.utils.parsedate_to_datetime(header_value(headers, "Date")).timestamp()
+        except (TypeError, ValueError):
+            date = time.time()
+        expires = header_value(headers, "Expires")
+        last_modified = header_value(headers, "Last-Modified")
+        try:
+            if expires is not None:
+                lifetime = email.utils.parsedate_to_datetime(expires).timestamp() - date
+            elif last_modified is not None:
+                # Heuristic freshness: 10% of the time since last modification, capped
+                age = date - email.utils.parsedate_to_datetime(last_modified).timestamp()
+                lifetime = min(age / 10, HTTP_HEURISTIC_MAX_AGE)
+        except (TypeError, ValueError):
+            lifetime = 0  # Invalid Expires means already expired
+    try:
+        lifetime -= int(header_value(headers, "Age") or 0)
+    except ValueError:
+        pass
+    return max(0, int(lifetime))
+
+
+def is_storable(request, status, headers):
+    """Whether a GET response may be stored by this shared cache."""
+    if request.method != "GET" or status != 200:
+        return False
+    request_cc = parse_cache_control(header_value(request.headers, "Cache-Control"))
+    response_cc = parse_cache_control(header_value(headers, "Cache-Control"))
+    if 'no-store' in request_cc or 'no-store' in response_cc or 'private' in response_cc:
+        return False
+    if header_value(request.headers, "Authorization") is not None and 's-maxage' not in response_cc and 'public' not in response_cc:
+        return False
+    # Per-user responses and content negotiation are passed through uncached
+    if header_value(headers, "Set-Cookie") is not None or header_value(headers, "Vary") is not None:
+        return False
+    has_validator = header_value(headers, "ETag") is not None or header_value(headers, "Last-Modified") is not None
+    return has_validator or freshness_lifetime(headers, response_cc) > 0
+
+
+def build_stored_response(status_line, headers, body):
+    """Serialize a response for the page cache: end-to-end headers without Date/Age, framed by Content-Length."""
+    response_cc = parse_cache_control(header_value(headers, "Cache-Control"))
+    lifetime = 0 if 'no-cache' in response_cc else freshness_lifetime(headers, response_cc)
+    lines = [status_line]
+    for name, value in end_to_end_headers(headers):
+        # An origin's own X-Cache-Lifetime must not be stored next to ours
+        if name.lower() not in ('date', 'age', 'content-length', HTTP_CACHE_INTERNAL_HEADER.lower()):
+            lines.append(f"{name}: {value}")
+    lines.append(f"Content-Length: {len(body)}")
+    lines.append(f"{HTTP_CACHE_INTERNAL_HEADER}: {lifetime}")
+    return ("\r\n".join(lines) + "\r\n\r\n").encode('latin-1') + body
+
+
+class StoredResponse:
+    """A page cache entry written by build_stored_response()."""
+    def __init__(self, data, stored_at):
+        self.data = data
+        self.stored_at = stored_at
+        self.body_start = data.find(b"\r\n\r\n") + 4
+        self.status_line, headers = parse_http_head(bytes(data[:self.body_start - 4]))
+        if self.body_start < 4 or headers is None:
+            raise ValueError("malformed page cache entry")
+        internal = HTTP_CACHE_INTERNAL_HEADER.lower()
+        # Ours is always the last header; entries stored by older builds may also carry the origin's
+        lifetimes = [value for name, value in headers if name.lower() == internal]
+        try:
+            self.lifetime = int(lifetimes[-1]) if lifetimes else 0
+        except ValueError:
+            self.lifetime = 0
+        self.headers = [(name, value) for name, value in headers if name.lower() != internal]
+        self.etag = header_value(headers, "ETag")
+        self.last_modified = header_value(headers, "Last-Modified")
+
+    def age(self):
+        return max(0, int(time.time() - self.stored_at))
+
+    def is_fresh(self, request):
+        """Fresh for this request, taking request Cache-Control/Pragma into account."""
+        request_cc = parse_cache_control(header_value(request.headers, "Cache-Control"))
+        if 'no-cache' in request_cc or (header_value(request.headers, "Pragma") or "").lower() == "no-cache":
+            return False
+        try:
+            if 'max-age' in request_cc and self.age() > int(request_cc['max-age']):
+                return False
+        except ValueError:
+            pass
+        return self.age() < self.lifetime
+
+    def send(self, client, request, keep_alive, cache_status):
+        """Serve this entry (or a 304 if the client already holds it)."""
+        client_etags = header_value(request.headers, "If-None-Match")
+        not_modified = self.etag is not None and client_etags is not None and (
+            client_etags.strip() == "*" or self.etag in [tag.strip() for tag in client_etags.split(",")])
+        status_line = self.status_line
+        headers = self.headers
+        if not_modified:
+            status_line = f"{request.version} 304 Not Modified"
+            headers = [(name, value) for name, value in headers if name.lower() != 'content-length']
+        lines = [status_line] + [f"{name}: {value}" for name, value in headers]
+        lines.append(f"Date: {email.utils.formatdate(usegmt=True)}")
+        lines.append(f"Age: {self.age()}")
+        lines.append(f"X-Cache: {cache_status}")
+        lines.append(f"Connection: {'keep-alive' if keep_alive else 'close'}")
+        client.sendall(("\r\n".join(lines) + "\r\n\r\n").encode('latin-1'))
+        if request.method == "GET" and not not_modified and len(self.data) > self.body_start:
+            client.sendall(memoryview(self.data)[self.body_start:])
+
+
+def revalidated_response(stored, headers):
+    """Rebuild a stored response with the headers of a 304 that confirmed it (RFC 9111 section 4.3.4)."""
+    updates = [(name, value) for name, value in end_to_end_headers(headers) if name.lower() != 'content-length']
+    replaced = {name.lower() for name, _ in updates}
+    merged = [(name, value) for name, value in stored.headers if name.lower() not in replaced] + updates
+    return build_stored_response(stored.status_line, merged, bytes(memoryview(stored.data)[stored.body_start:]))
+
+
+def open_origin(host, port):
+    """Return (socket, reused, connect_latency): an idle keep-alive, a warm, or a new connection."""
+    sock = origin_pool.acquire(host, port)
+    if sock is not None:
+        return sock, True, None
+    sock = warm_pool.acquire(host, port)
+    if sock is not None:
+        return sock, False, None
+    connect_started = time.monotonic()
+    sock = connect_upstream(host, port)
+    return sock, False, time.monotonic() - connect_started
+
+
+def build_origin_request(request, stored):
+    """Rewrite a proxy request into origin form; revalidate stored with our own validators."""
+    lines = [f"{request.method} {request.path} HTTP/1.1"]
+    host_header = request.host if request.port == 80 else f"{request.host}:{request.port}"
+    lines.append(f"Host: {host_header}")
+    for name, value in end_to_end_headers(request.headers):
+        lower = name.lower()
+        if lower == 'host' or (stored is not None and lower in ('if-none-match', 'if-modified-since')):
+            continue
+        lines.append(f"{name}: {value}")
+    if stored is not None:
+        if stored.etag:
+            lines.append(f"If-None-Match: {stored.etag}")
+        if stored.last_modified:
+            lines.append(f"If-Modified-Since: {stored.last_modified}")
+    lines.append("Connection: keep-alive")
+    return ("\r\n".join(lines) + "\r\n\r\n").encode('latin-1')
+
+
+def relay_response_body(origin_reader, client, headers, collect, account):
+    """Forward a response body as received. Returns (body or None, origin_reusable, tail).
+
+    The body is collected (de-chunked) only while collect is true and it fits in the page
+    cache object limit. account(n) is called for every byte read from the origin. The final
+    piece of a framed body is returned as tail instead of sent, so the caller can store the
+    page before the client sees the response complete and asks for it again.
+    """
+    body = bytearray() if collect else None
+
+    def forward(data, payload=None, last=False):
+        nonlocal body
+        account(len(data))
+        if not last:
+            client.sendall(data)
+        if body is not None:
+            body += data if payload is None else payload
+            if len(body) > HTTP_CACHE_MAX_OBJECT_BYTES:
+                body = None
+
+    transfer_encoding = (header_value(headers, "Transfer-Encoding") or "").lower()
+    content_length = header_value(headers, "Content-Length")
+    if "chunked" in transfer_encoding:
+        while True:
+            size_line = origin_reader.read_until(b"\r\n", HTTP_MAX_HEADER_BYTES)
+            size = int(size_line.split(b";", 1)[0].strip(), 16)
+            if size == 0:
+                trailer = size_line
+                while True:
+                    line = origin_reader.read_until(b"\r\n", HTTP_MAX_HEADER_BYTES)
+                    trailer += line
+                    if line == b"\r\n":
+                        break
+                forward(trailer, b"", last=True)
+                return body, True, trailer
+            chunk = origin_reader.read_exact(size + 2)
+            forward(size_line + chunk, chunk[:-2])
+    if content_length is not None:
+        remaining = int(content_length)
+        while remaining > 0:
+            data = origin_reader.read_some(min(remaining, 65536))
+            if not data:
+                raise EOFError("origin closed mid-body")
+            remaining -= len(data)
+            forward(data, last=not remaining)
+            if not remaining:
+                return body, True, data
+        return body, True, b""
+    # Delimited by close
+    while True:
+        data = origin_reader.read_some()
+        if not data:
+            return body, False, b""
+        forward(data)
+
+
+def response_status(status_line):
+    """Status code of a response status line, or None if malformed."""
+    parts = status_line.split(" ", 2)
+    try:
+        return int(parts[1]) if len(parts) > 1 and parts[0].startswith("HTTP/") else None
+    except ValueError:
+        return None
+
+
+def forward_http_request(client, reader, request, authenticated_user, flow):
+    """Serve one request from the page cache or the origin. Returns True if the client connection may be reused."""
+    keep_alive = wants_keep_alive(request.version, request.headers)
+    if header_value(request.headers, "Transfer-Encoding") is not None:
+        count_error(501)
+        client.sendall(HTTP_NOT_IMPLEMENTED_RESPONSE)
+        return False
+
+    # Request bodies are rare for GET/HEAD; pass small ones straight through
+    try:
+        body_length = int(header_value(request.headers, "Content-Length") or 0)
+    except ValueError:
+        body_length = -1
+    if body_length < 0:
+        count_error(400)
+        client.sendall(HTTP_BAD_REQUEST_RESPONSE)
+        return False
+    if body_length > HTTP_MAX_REQUEST_BODY_BYTES:
+        count_error(413)
+        client.sendall(HTTP_PAYLOAD_TOO_LARGE_RESPONSE)
+        return False
+    # Read it even when the cache answers, so the next request on the connection starts cleanly
+    request_body = reader.read_exact(body_length)
+
+    stored = None
+    if request.method in ("GET", "HEAD"):
+        entry = cache_manager.lookup_page(request.host, request.port, request.path)
+        try:
+            stored = StoredResponse(*entry) if entry is not None else None
+        except ValueError:
+            stored = None  # Unreadable entry: treat as a miss and let the origin response replace it
+        if stored is not None:
+            if stored.is_fresh(request):
+                print(f"[*] Cache hit for {request.host}:{request.port}{request.path}")
+                stored.send(client, request, keep_alive, "HIT")
+                return keep_alive
+            if not stored.etag and not stored.last_modified:
+                stored = None
+
+    outgoing = build_origin_request(request, stored) + request_body
+    connection_usage = usage_ledger.open_connection(authenticated_user, request.host, request.port)
+
+    def account(num_bytes, direction=metric_bytes_downstream):
+        log_data_usage(authenticated_user, num_bytes, connection_usage)
+        direction.inc(num_bytes)
+        wait = flow.reserve(num_bytes)
+        if wait > 0:
+            time.sleep(wait)
+
+    origin = None
+    try:
+        for attempt in range(2):
+            try:
+                origin, reused, connect_latency = open_origin(request.host, request.port)
+            except socket.timeout:
+                count_error(504)
+                client.sendall(GATEWAY_TIMEOUT_RESPONSE)
+                return False
+            except Exception:
+                count_error(502)
+                client.sendall(BAD_GATEWAY_RESPONSE)
+                return False
+            if not reused:
+                destination_stats.record_connect(request.host, request.port, connect_latency)
+            try:
+                origin.sendall(outgoing)
+                account(len(outgoing), metric_bytes_upstream)
+                origin_reader = BufferedReader(origin)
+                head = origin_reader.read_until(b"\r\n\r\n", HTTP_MAX_HEADER_BYTES)
+                break
+            except (OSError, EOFError):
+                origin.close()
+                origin = None
+                # A kept-alive connection may have been closed by the origin meanwhile; retry once on a fresh one
+                if not reused or attempt:
+                    count_error(502)
+                    client.sendall(BAD_GATEWAY_RESPONSE)
+                    return False
+
+        status_line, headers = parse_http_head(head[:-4])
+        status = response_status(status_line)
+        # Skip interim 1xx responses
+        while status is not None and 100 <= status < 200:
+            account(len(head))
+            head = origin_reader.read_until(b"\r\n\r\n", HTTP_MAX_HEADER_BYTES)
+            status_line, headers = parse_http_head(head[:-4])
+            status = response_status(status_line)
+        account(len(head))
+        if status is None or headers is None:
+            count_error(502)
+            client.sendall(BAD_GATEWAY_RESPONSE)
+            return False
+        origin_keep_alive = wants_keep_alive(status_line.split(" ", 1)[0], headers)
+
+        if status == 304 and stored is not None:
+            # The 304 carries the current freshness; an unchanged entry only has its timestamp refreshed
+            data = revalidated_response(stored, headers)
+            cache_manager.cache_page(request.host, request.port, request.path, data)
+            stored = StoredResponse(data, time.time())
+            print(f"[*] Revalidated cached page for {request.host}:{request.port}{request.path}")
+            stored.send(client, request, keep_alive, "REVALIDATED")
+            if origin_keep_alive and not origin_reader.buffer:
+                origin_pool.release(request.host, request.port, origin)
+            else:
+                origin.close()
+            origin = None
+            return keep_alive
+
+        has_body = request.method != "HEAD" and status not in (204, 304)
+        chunked = "chunked" in (header_value(headers, "Transfer-Encoding") or "").lower()
+        framed = not has_body or chunked or header_value(headers, "Content-Length") is not None
+        keep_alive = keep_alive and framed
+        lines = [status_line] + [f"{name}: {value}" for name, value in end_to_end_headers(headers)]
+        if chunked and has_body:
+            lines.append("Transfer-Encoding: chunked")
+        lines.append("X-Cache: MISS")
+        lines.append(f"Connection: {'keep-alive' if keep_alive else 'close'}")
+        client.sendall(("\r\n".join(lines) + "\r\n\r\n").encode('latin-1'))
+
+        body, origin_reusable, tail = b"", True, b""
+        if has_body:
+            body, origin_reusable, tail = relay_response_body(
+                origin_reader, client, headers, is_storable(request, status, headers), account)
+        if body is not None and is_storable(request, status, headers):
+            cache_manager.cache_page(request.host, request.port, request.path,
+                                     build_stored_response(status_line, headers, bytes(body)))
+        if tail:
+            client.sendall(tail)
+
+        if origin_keep_alive and origin_reusable and not origin_reader.buffer:
+            origin_pool.release(request.host, request.port, origin)
+        else:
+            origin.close()
+        origin = None
+        return keep_alive
+    finally:
+        if origin is not None:
+            try:
+                origin.close()
+            except OSError:
+                pass
+        usage_ledger.close_connection(connection_usage)
+        destination_stats.record_close(connection_usage)
+
+
+def serve_http_client(client, addr, reader, request, authenticated_user, session=None):
+    """Serve absolute-URI GET/HEAD requests on one client connection until it closes or idles out."""
+    flow = bandwidth_shaper.open_flow(authenticated_user)
+    try:
+        client.settimeout(HTTP_KEEPALIVE_TIMEOUT)
+        while True:
+            if session is not None:
+                session.touch()
+            if request.method not in ("GET", "HEAD"):
+                count_error(501)
+                client.sendall(HTTP_NOT_IMPLEMENTED_RESPONSE)
+                return
+            if not forward_http_request(client, reader, request, authenticated_user, flow):
+                return
+
+            try:
+                head = reader.read_until(b"\r\n\r\n", HTTP_MAX_HEADER_BYTES)
+            except (OSError, EOFError, ValueError):
+                return
+            request = parse_http_request(head)
+            if request is None:
+                count_error(400)
+                client.sendall(HTTP_BAD_REQUEST_RESPONSE)
+                return
+            if authenticate_proxy_request(request.auth_header) != authenticated_user:
+                count_error(407)
+                client.sendall(PROXY_AUTH_REQUIRED_RESPONSE)
+                return
+            if authenticated_user not in PROXY_USERS:
+                print(f"[!] User {authenticated_user} was deleted. Disconnecting.")
+                log_login(authenticated_user, "0.0.0.0", "DISCONNECT_USER_DELETED_MID_SESSION")
+                return
+            reason = quota_manager.refusal(authenticated_user)
+            if reason:
+                count_error(403)
+                client.sendall(build_quota_response(reason))
+                return
+    except (OSError, EOFError, ValueError) as e:
+        print(f"[!] HTTP forward error for {addr[0]}: {e}")
+    finally:
+        bandwidth_shaper.close_flow(flow)
+
+
+# ============================
+# ASYNCIO ENGINE
+# ============================
+
+class AsyncClientHandle:
+    """Socket-like handle over an asyncio StreamWriter, stored in a Session's handles.
+    
+    The session manager only ever calls sendall()/close() on session handles, so
+    this lets the asyncio engine share the same session bookkeeping.
+    Both are called from executor and monitor threads (asyncio transports are not
+    thread-safe), so they are marshalled onto the loop, in call order.
+    """
+    def __init__(self, writer, loop):
+        self.writer = writer
+        self.loop = loop
+    
+    def sendall(self, data):
+        try:
+            self.loop.call_soon_threadsafe(self.writer.write, data)
+        except RuntimeError:
+            pass  # Loop already closed
+    
+    def close(self):
+        try:
+            self.loop.call_soon_threadsafe(self.writer.close)
+        except RuntimeError:
+            pass  # Loop already closed
+
+
+class AsyncClientStream:
+    """Blocking socket-like view of an asyncio client connection, for use from worker threads."""
+    def __init__(self, reader, writer, loop):
+        self.reader = reader
+        self.writer = writer
+        self.loop = loop
+        self.timeout = None
+    
+    def settimeout(self, timeout):
+        self.timeout = timeout
+    
+    def recv(self, max_bytes):
+        future = asyncio.run_coroutine_threadsafe(self.reader.read(max_bytes), self.loop)
+        try:
+            return future.result(self.timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            raise socket.timeout("timed out")
+    
+    async def _write(self, data):
+        self.writer.write(data)
+        await self.writer.drain()
+    
+    def sendall(self, data):
+        asyncio.run_coroutine_threadsafe(self._write(data), self.loop).result()
+    
+    def close(self):
+        try:
+            self.loop.call_soon_threadsafe(self.writer.close)
+        except RuntimeError:
+            pass  # Loop already closed
+
+
+http_executor = ThreadPoolExecutor(max_workers=HTTP_FORWARD_THREADS, thread_name_prefix="http-forward")
+
+
+async def handle_client_async(reader, writer):
+    """Handle incoming proxy connections on the event loop (same responses as handle_client)."""
+    addr = writer.get_extra_info('peername')
+    loop = asyncio.get_running_loop()
+    client_handle = AsyncClientHandle(writer, loop)
+    authenticated_user = None
+    accepted_at = time.monotonic()
+    server_logger.log(f"[*] Connection from {addr[0]}:{addr[1]}")
+    try:
+        # Read the request head; anything after the headers stays buffered in reader
+        try:
+            request = await reader.readuntil(b"\r\n\r\n")
+        except asyncio.IncompleteReadError:
+            return
+        except asyncio.LimitOverrunError:
+            count_connection("rejected", 431)
+            writer.write(HEADERS_TOO_LARGE_RESPONSE)
+            return
+        
+        http_request = None
+        parsed = parse_connect_request(request)
+        if parsed is None:
+            http_request = parse_http_request(request)
+            if http_request is None:
+                return
+            host, port, auth_header = http_request.host, http_request.port, http_request.auth_header
+        else:
+            host, port, auth_header = parsed
+        
+        authenticated_user = await authenticate_proxy_request_async(auth_header)
+        if authenticated_user is None:
+            count_connection("rejected", 407)
+            writer.write(PROXY_AUTH_REQUIRED_RESPONSE)
+            return
+        
+        device_ip = addr[0]
+        server_logger.log(f"[*] Authenticated user: {authenticated_user} from device {device_ip}")
+        
+        if not is_proxy_access_allowed():
+            current_time = time.strftime("%H:%M")
+            count_connection("rejected", 403)
+            writer.write(build_access_hours_response(current_time))
+            print(f"[!] Access denied for {authenticated_user} - outside allowed hours ({current_time})")
+            return
+        
+        reason = quota_manager.refusal(authenticated_user)
+        if reason:
+            count_connection("rejected", 403)
+            writer.write(build_quota_response(reason))
+            print(f"[!] Access denied for {authenticated_user} - {reason}")
+            return
+        
+        # Session and warm pool calls can block (an RPC to the supervisor in worker mode), so they run off the loop
+        session, msg = await loop.run_in_executor(None, session_manager.acquire, authenticated_user, device_ip,
+                                                  client_handle)
+        server_logger.log(f"[*] {msg}")
+        if session is None:
+            count_connection("rejected", 407)
+            return
+        active_clients.add(addr, authenticated_user)
+        
+        try:
+            if http_request is not None:
+                # Plain HTTP goes through the blocking forwarder (page cache, origin keep-alive) on a worker thread
+                count_connection("accepted")
+                stream = AsyncClientStream(reader, writer, loop)
+                await loop.run_in_executor(http_executor, serve_http_client, stream, addr,
+                                           BufferedReader(stream), http_request, authenticated_user, session)
+                return
+            
+            try:
+                warm_sock = await loop.run_in_executor(None, warm_pool.acquire, host, port)
+                connect_latency = None
+                if warm_sock is not None:
+                    print(f"[*] Using warm connection to {host}:{port}")
+                    remote_reader, remote_writer = await asyncio.open_connection(sock=warm_sock)
+                else:
+                    connect_started = time.monotonic()
+                    remote_reader, remote_writer = await connect_upstream_async(host, port)
+                    connect_latency = time.monotonic() - connect_started
+            except asyncio.TimeoutError:
+                count_connection("failed", 504)
+                writer.write(GATEWAY_TIMEOUT_RESPONSE)
+                return
+            except Exception:
+                count_connection("failed", 502)
+                writer.write(BAD_GATEWAY_RESPONSE)
+                return
+            
+            destination_stats.record_connect(host, port, connect_latency)
+            writer.write(CONNECTION_ESTABLISHED_RESPONSE)
+            await writer.drain()
+            count_connection("accepted")
+            metric_time_to_established.observe(time.monotonic() - accepted_at)
+            
+            await relay_async(reader, writer, remote_reader, remote_writer, host, port, authenticated_user, session)
+        finally:
+            await loop.run_in_executor(None, release_client_session, session, client_handle, addr)
+    
+    except Exception as e:
+        print(f"[Error in handle_client_async] {e}")
+    finally:
+        writer.close()
+
+
+async def race_connect_async(addresses, port, timeout=UPSTREAM_CONNECT_TIMEOUT, delay=HAPPY_EYEBALLS_DELAY):
+    """Event-loop version of race_connect(). Returns (socket, winning_address, failed_addresses)."""
+    loop = asyncio.get_running_loop()
+    pending = interleave_address_families(addresses)
+    attempts = {}  # {task: (family, ip)}
+    failed = []
+    last_error = None
+    deadline = loop.time() + timeout
+    
+    async def attempt(address):
+        sock = socket.socket(address[0], socket.SOCK_STREAM)
+        sock.setblocking(False)
+        try:
+            await loop.sock_connect(sock, (address[1], port))
+        except BaseException:
+            sock.close()
+            raise
+        return sock
+    
+    try:
+        while pending or attempts:
+            if pending:
+                address = pending.pop(0)
+                attempts[asyncio.create_task(attempt(address))] = address
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            done, _ = await asyncio.wait(
+                attempts, timeout=min(delay, remaining) if pending else remaining,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            if not done and not pending:
+                break  # Deadline reached with attempts still outstanding
+            for task in done:
+                address = attempts.pop(task)
+                if task.exception() is None:
+                    return task.result(), address, failed
+                failed.append(address)
+                last_error = task.exception()
+    finally:
+        for task in attempts:
+            task.cancel()
+        # Close sockets from attempts that finished after the winner
+        for result in await asyncio.gather(*attempts, return_exceptions=True):
+            if isinstance(result, socket.socket):
+                result.close()
+    
+    if last_error is None or attempts:
+        raise asyncio.TimeoutError(f"Timed out connecting on port {port}")
+    raise last_error
+
+
+async def connect_upstream_async(host, port, timeout=UPSTREAM_CONNECT_TIMEOUT):
+    """Event-loop version of connect_upstream(); cache misses resolve in the default executor."""
+    loop = asyncio.get_running_loop()
+    addresses = dns_resolver.cached(host) or await loop.run_in_executor(None, dns_resolver.resolve, host)
+    started = time.monotonic()
+    sock, winner, failed = await race_connect_async(addresses, port, timeout)
+    metric_upstream_connect.observe(time.monotonic() - started)
+    dns_resolver.record_connect(host, winner, failed)
+    return await asyncio.open_connection(sock=sock)
+
+
+async def relay_async(client_reader, client_writer, remote_reader, remote_writer, host, port, authenticated_user,
+                      session=None):
+    """Relay data in both directions until either side closes or the user is deleted."""
+    connection_usage = usage_ledger.open_connection(authenticated_user, host, port)
+    flow = bandwidth_shaper.open_flow(authenticated_user)
+    quota = quota_manager.account(authenticated_user) if QUOTA_ACTION == "refuse" else None
+    metric_tunnels_opened.inc()
+    
+    async def pump(reader, writer, direction):
+        while True:
+            data = await reader.read(RELAY_CHUNK_SIZE)
+            if not data:
+                return
+            log_data_usage(authenticated_user, len(data), connection_usage)
+            direction.inc(len(data))
+            if session is not None:
+                session.touch()
+            if quota is not None and quota.exhausted:
+                print(f"[!] User {authenticated_user} is over their data quota. Disconnecting.")
+                log_login(authenticated_user, "0.0.0.0", "DISCONNECT_QUOTA_EXCEEDED")
+                return
+            writer.write(data)
+            await writer.drain()
+            wait = flow.reserve(len(data))
+            if wait > 0:
+                await asyncio.sleep(wait)
+    
+    async def watch_user():
+        while authenticated_user in PROXY_USERS:
+            await asyncio.sleep(1)
+        print(f"[!] User {authenticated_user} was deleted. Disconnecting.")
+        log_login(authenticated_user, "0.0.0.0", "DISCONNECT_USER_DELETED_MID_SESSION")
+    
+    tasks = [
+        asyncio.create_task(pump(client_reader, remote_writer, metric_bytes_upstream)),
+        asyncio.create_task(pump(remote_reader, client_writer, metric_bytes_downstream)),
+        asyncio.create_task(watch_user()),
+    ]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        remote_writer.close()
+        metric_tunnels_closed.inc()
+        usage_ledger.close_connection(connection_usage)
+        destination_stats.record_close(connection_usage)
+        bandwidth_shaper.close_flow(flow)
+
+
+async def serve_async(server_sock):
+    """Run the asyncio engine on an already-bound listening socket until restart is requested."""
+    server = await asyncio.start_server(handle_client_async, sock=server_sock, limit=HTTP_MAX_HEADER_BYTES)
+    async with server:
+        while True:
+            with restart_lock:
+                if restart_requested:
+                    print(f"[*] Proxy server detected restart signal, shutting down...")
+                    break
+            await asyncio.sleep(1)
+        if proxy_handover is not None and proxy_handover.completed:
+            # Relays are tasks on this loop, so let them finish before it stops
+            server.close()
+            while proxy_handover.draining():
+                await asyncio.sleep(1)
+
+
+def start_monitor_server(monitor_sock=None):
+    """Start a monitoring server for remote cache/activity viewing (on monitor_sock if handed over)."""
+    try:
+        if monitor_sock is None:
+            monitor_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            monitor_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            monitor_sock.bind((LISTEN_HOST, MONITOR_PORT))
+            monitor_sock.listen(1)
+        monitor_sock.settimeout(1.0)  # 1 second timeout to check restart flag
+        listening_sockets['monitor'] = monitor_sock
+        server_logger.log(f"[*] Monitor server started on {LISTEN_HOST}:{MONITOR_PORT}")
+    except Exception as e:
+        print(f"[!] Failed to start monitor server: {e}")
+        return
+    
+    while True:
+        try:
+            # Check if restart was requested
+            with restart_lock:
+                if restart_requested:
+                    print(f"[*] Monitor server detected restart signal, shutting down...")
+                    break
+            
+            client_sock, addr = monitor_sock.accept()
+            server_logger.log(f"[*] Monitor connection from {addr[0]}:{addr[1]}")
+            threading.Thread(target=handle_monitor_request, args=(client_sock,), daemon=True).start()
+        except socket.timeout:
+            continue  # Timeout expired, loop will check restart flag
+        except Exception as e:
+            print(f"[!] Monitor error: {e}")
+
+
+def handle_monitor_request(client_sock):
+    """Handle a monitoring request."""
+    global restart_requested, proxy_handover
+    try:
+        # Read full request
+        request = client_sock.recv(1024).decode('utf-8', errors='ignore').strip()
+        parts = request.split()
+        
+        if not parts:
+            response = "No command received.\n"
+            client_sock.sendall(response.encode())
+            return
+        
+        command = parts[0].upper()
+        
+        if command == "GET":
+            # Prometheus/OpenMetrics scrape: GET /metrics HTTP/1.1
+            path = parts[1].split("?", 1)[0] if len(parts) > 1 else ""
+            if path != "/metrics":
+                client_sock.sendall(b"HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+                return
+            body = collect_metrics().encode()
+            client_sock.sendall(b"HTTP/1.1 200 OK\r\n"
+                                b"Content-Type: application/openmetrics-text; version=1.0.0; charset=utf-8\r\n"
+                                + f"Content-Length: {len(body)}\r\n".encode()
+                                + b"Connection: close\r\n\r\n" + body)
+        
+        elif command == "METRICS":
+            client_sock.sendall(collect_metrics().encode())
+        
+        elif command == "STATUS":
+            # Build status response
+            stats = collect_proxy_stats()
+            
+            # Check if current time is within allowed access hours
+            accepting_status = "YES" if is_proxy_access_allowed() else "NO"
+            
+            response = f"""PROXY STATUS
+============
+Accepting Clients: {accepting_status}
+DNS Cache Entries: {stats['dns_count']}
+DNS Cache Hit Ratio: {dns_resolver.hit_ratio():.1%}
+Cached Pages: {stats['page_count']}
+Warm Upstream Connections: {stats['conn_count']}
+Active Clients: {len(stats['clients'])}
+User Sessions: {len(session_manager)}
+Cache File: {CACHE_FILE}
+"""
+            if supervisor_state is not None:
+                response += f"Workers: {stats['workers']}/{PROXY_WORKERS}\n"
+            client_sock.sendall(response.encode())
+        
+        elif command == "CLIENTS":
+            # List active clients
+            clients_info = collect_proxy_stats()['clients']
+            
+            if not clients_info:
+                response = "No active clients.\n"
+            else:
+                response = "ACTIVE CLIENTS\n==============\n"
+                for addr, (user, timestamp) in clients_info:
+                    age = int(time.time() - timestamp)
+                    response += f"{addr[0]}:{addr[1]} - User: {user} (connected {age}s ago)\n"
+            
+            client_sock.sendall(response.encode())
+        
+        elif command == "ADDUSER":
+            if len(parts) < 3:
+                response = "Usage: ADDUSER username password\n"
+                client_sock.sendall(response.encode())
+                return
+            
+            username = parts[1].lower()
+            password = parts[2].lower()
+            
+            # Hashed before taking users_write_lock; the existence check happens under it
+            if not add_user(username, hash_password(password)):  # Save to encrypted CSV
+                response = f"User '{username}' already exists.\n"
+            else:
+                response = f"User '{username}' added successfully.\n"
+                print(f"[*] Added user: {username}")
+            
+            client_sock.sendall(response.encode())
+        
+        elif command == "DELUSER":
+            if len(parts) < 2:
+                response = "Usage: DELUSER username\n"
+                client_sock.sendall(response.encode())
+                return
+            
+            username = parts[1].lower()
+            
+            if not delete_user(username):  # Save to encrypted CSV
+                response = f"User '{username}' does not exist.\n"
+            else:
+                
+                # Disconnect any active sessions for this user
+                stored_ip = session_manager.evict_user(username, "DISCONNECT_USER_DELETED")
+                if stored_ip:
+                    print(f"[*] Forcefully disconnected active session for deleted user: {username} from {stored_ip}")
+                
+                response = f"User '{username}' deleted successfully and disconnected if active.\n"
+                print(f"[*] Deleted user: {username}")
+            
+            client_sock.sendall(response.encode())
+        
+        elif command == "LISTUSERS":
+            response = "VALID PROXY USERS\n=================\n"
+            for user in PROXY_USERS:
+                response += f"{user}\n"
+            
+            client_sock.sendall(response.encode())
+        
+        elif command == "CACHE":
+            # Send full cache data as JSON
+            data = {
+                'dns_cache': dns_resolver.export(),
+                'page_cache_count': len(cache_manager.page_cache) + len(cache_manager.page_index),
+                'page_cache_bytes': cache_manager.cached_bytes,
+                'connection_count': len(warm_pool),
+                'timestamp': time.time()
+            }
+            client_sock.sendall(json.dumps(data, indent=2).encode())
+        
+        elif command in ("LOGINLOG", "LOGS"):
+            # Stream the login or server log: [tail N] [since TIME] [user U] [ip X] [follow]
+            try:
+                query = LogQuery.parse(parts[1:])
+            except ValueError as e:
+                client_sock.sendall(f"{e}\nUsage: {command} [tail N] [since TIME] [user U] [ip X] [follow]\n".encode())
+                return
+            if command == "LOGINLOG":
+                stream_log(client_sock, LOGIN_LOG_FILE, "LOGIN/LOGOUT LOG", query)
+            else:
+                stream_log(client_sock, SERVER_LOG_FILE, "SERVER LOGS", query)
+        
+        elif command == "USAGE":
+            # Show data usage for all users or specific user
+            usage_totals = usage_ledger.snapshot_totals()
+            if len(parts) > 1:
+                # Specific user
+                username = parts[1].lower()
+                if username in usage_totals:
+                    bytes_used = usage_totals[username]
+                    gb_used = bytes_used / (1024 * 1024 * 1024)
+                    response = f"Data Usage for {username}\n========================\n"
+                    response += f"Total: {bytes_used:,} bytes ({gb_used:.3f} GB)\n"
+                else:
+                    response = f"No data usage recorded for user '{username}'.\n"
+            else:
+                # All users
+                response = "DATA USAGE (All Time)\n=====================\n"
+                if usage_totals:
+                    for user, bytes_used in sorted(usage_totals.items(), key=lambda x: x[1], reverse=True):
+                        gb_used = bytes_used / (1024 * 1024 * 1024)
+                        mb_used = (bytes_used % (1024 * 1024 * 1024)) / (1024 * 1024)
+                        response += f"{user}: {bytes_used:,} bytes ({gb_used:.2f} GB)\n"
+                else:
+                    response = "No data usage recorded.\n"
+            client_sock.sendall(response.encode())
+        
+        elif command == "BANDWIDTH":
+            # Show current per-user bandwidth allocations
+            flows = bandwidth_shaper.snapshot()
+            limit = rate_limiter.max_bytes_per_second
+            response = "BANDWIDTH ALLOCATION\n====================\n"
+            response += f"Global limit: {limit * 8 / 1_000_000:.1f} Mbps\n"
+            if not flows:
+                response += "No active tunnels.\n"
+            for user, connections, bytes_per_second in sorted(flows, key=lambda x: x[2], reverse=True):
+                response += f"{user}: {bytes_per_second * 8 / 1_000_000:.2f} Mbps across {connections} connection(s)\n"
+            client_sock.sendall(response.encode())
+        
+        elif command in ("TOPBYTES", "TOPCONNS"):
+            # Heavy-hitter destinations over a sliding window
+            try:
+                top_n = int(parts[1]) if len(parts) > 1 else 10
+                minutes = int(parts[2]) if len(parts) > 2 else 60
+            except ValueError:
+                client_sock.sendall(f"Usage: {command} [N] [MINUTES]\n".encode())
+                return
+            metric = 'bytes' if command == "TOPBYTES" else 'connections'
+            minutes = max(1, min(minutes, DESTINATION_WINDOW_BUCKETS * DESTINATION_BUCKET_SECONDS // 60))
+            rows = destination_stats.top(metric, top_n, minutes)
+            title = f"TOP {top_n} DESTINATIONS BY {metric.upper()} (last {minutes} min)"
+            response = f"{title}\n{'=' * len(title)}\n"
+            if not rows:
+                response += "No destination traffic recorded.\n"
+            for rank, row in enumerate(rows, 1):
+                mb_used = row['bytes'] / (1024 * 1024)
+                latency = f"{row['avg_connect_ms']:.0f} ms" if row['avg_connect_ms'] is not None else "n/a"
+                bound = f" (+/-{row['error']:,})" if row['error'] else ""
+                response += (f"{rank:>2}. {row['host']}:{row['port']} - {mb_used:.2f} MB, "
+                             f"{row['connections']:,} connections, connect {latency}{bound}\n")
+            client_sock.sendall(response.encode())
+        
+        elif command == "LOCKS":
+            # Wait/hold time per lock, to spot contention
+            if len(parts) > 1 and parts[1].upper() == "RESET":
+                reset_lock_stats()
+                if supervisor_state is not None:
+                    supervisor_state.request_lock_reset()
+                response = "Lock counters reset.\n"
+            else:
+                response = format_lock_report(collect_proxy_stats()['locks'])
+            client_sock.sendall(response.encode())
+        
+        elif command == "USAGELOG":
+            # Usage history from the hourly/daily rollups
+            rollups = usage_ledger.rollups
+            mode = parts[1].lower() if len(parts) > 1 else ""
+            try:
+                if mode == "user" and len(parts) > 2:
+                    username = parts[2].lower()
+                    days = int(parts[3]) if len(parts) > 3 else 30
+                    history = rollups.user_history(username, days)
+                    title = f"DATA USAGE FOR {username} (Last {days} Days)"
+                    response = f"{title}\n{'=' * len(title)}\n"
+                    if not history:
+                        response += f"No usage recorded for '{username}' in the last {days} days.\n"
+                    for day, bytes_used in history:
+                        response += f"{day} | {bytes_used:,} bytes ({bytes_used / (1024 * 1024):.2f} MB)\n"
+                    if history:
+                        total = sum(bytes_used for _, bytes_used in history)
+                        response += f"Total: {total:,} bytes ({total / (1024 * 1024 * 1024):.3f} GB)\n"
+                        response += "\nLast 24 Hours\n-------------\n"
+                        for hour, bytes_used in rollups.user_hours(username, 24):
+                            response += f"{hour}:00 | {bytes_used:,} bytes ({bytes_used / (1024 * 1024):.2f} MB)\n"
+                elif mode == "top":
+                    top_n = int(parts[2]) if len(parts) > 2 else 10
+                    days = int(parts[3]) if len(parts) > 3 else 7
+                    rows = rollups.top_users(days, top_n)
+                    title = f"TOP {top_n} USERS BY DATA USAGE (Last {days} Days)"
+                    response = f"{title}\n{'=' * len(title)}\n"
+                    if not rows:
+                        response += "No usage recorded.\n"
+                    for rank, (username, bytes_used) in enumerate(rows, 1):
+                        response += f"{rank:>2}. {username}: {bytes_used:,} bytes ({bytes_used / (1024 * 1024 * 1024):.2f} GB)\n"
+                else:
+                    days = int(parts[1]) if len(parts) > 1 else 30
+                    rows = rollups.daily_totals(days)
+                    title = f"DATA USAGE LOG (Last {days} Days)"
+                    response = f"{title}\n{'=' * len(title)}\n"
+                    if not rows:
+                        response += f"No usage data in the last {days} days.\n"
+                    for day, bytes_used, users in rows:
+                        response += f"{day} | {users} user(s) | {bytes_used:,} bytes ({bytes_used / (1024 * 1024):.2f} MB)\n"
+                if rollups.replaying:
+                    response += "(Still importing proxy_usage.log; totals are incomplete.)\n"
+            except ValueError:
+                response = "Usage: USAGELOG [DAYS] | USAGELOG user U [DAYS] | USAGELOG top [N] [DAYS]\n"
+            client_sock.sendall(response.encode())
+        
+        elif command == "QUOTA":
+            # Inspect and adjust data quotas
+            sub = parts[1].upper() if len(parts) > 1 else ""
+            periods = {"DAILY": "daily", "MONTHLY": "monthly"}
+            
+            def quota_line(label, day_bytes, daily_limit, month_bytes, monthly_limit):
+                return (f"{label}: today {day_bytes / (1024 * 1024):.2f} MB / {format_quota_bytes(daily_limit)}, "
+                        f"this month {month_bytes / (1024 * 1024):.2f} MB / {format_quota_bytes(monthly_limit)}\n")
+            
+            if sub == "SET" and len(parts) >= 5 and parts[2].upper() in ("USER", "GROUP", "DEFAULT"):
+                kind = parts[2].lower()
+                name = parts[3].lower() if kind != "default" else None
+                base = 3 if kind == "default" else 4
+                period = parts[base].upper() if len(parts) > base else ""
+                size = parts[base + 1] if len(parts) > base + 1 else None
+                try:
+                    if period not in periods or size is None:
+                        raise ValueError("expected DAILY or MONTHLY and a size")
+                    limit = parse_quota_size(size)
+                    quota_manager.set_limit(kind, name, periods[period], limit)
+                    target = kind if name is None else f"{kind} '{name}'"
+                    response = f"Set {periods[period]} quota for {target} to {format_quota_bytes(limit)}.\n"
+                except ValueError as e:
+                    response = f"Error: {e}\nUsage: QUOTA SET USER u|GROUP g|DEFAULT DAILY|MONTHLY SIZE (e.g. 500M, 2G, 0 = none)\n"
+            elif sub == "UNSET" and len(parts) > 2:
+                username = parts[2].lower()
+                if quota_manager.clear_user(username):
+                    response = f"Quota for '{username}' now follows the default.\n"
+                else:
+                    response = f"User '{username}' has no quota of their own.\n"
+            elif sub == "GROUP" and len(parts) > 3 and parts[3].upper() in ("ADD", "REMOVE", "DELETE"):
+                group, action = parts[2].lower(), parts[3].upper()
+                members = [username.lower() for username in parts[4:]]
+                if action == "DELETE":
+                    response = f"Deleted group '{group}'.\n" if quota_manager.delete_group(group) else f"No group '{group}'.\n"
+                elif not members:
+                    response = f"Usage: QUOTA GROUP {group} {action} user [user ...]\n"
+                else:
+                    quota_manager.set_members(group, members, add=(action == "ADD"))
+                    response = f"{'Added' if action == 'ADD' else 'Removed'} {', '.join(members)} {'to' if action == 'ADD' else 'from'} group '{group}'.\n"
+            elif sub and sub not in ("SET", "UNSET", "GROUP"):
+                username = parts[1].lower()
+                title = f"DATA QUOTA FOR {username}"
+                response = f"{title}\n{'=' * len(title)}\n"
+                for row in quota_manager.status(username):
+                    response += quota_line(*row)
+                reason = quota_manager.refusal(username)
+                if reason:
+                    response += f"Over quota: {reason}\n"
+            elif sub:
+                response = ("Usage: QUOTA [user] | QUOTA SET USER u|GROUP g|DEFAULT DAILY|MONTHLY SIZE | QUOTA UNSET u | "
+                            "QUOTA GROUP g ADD|REMOVE u [u ...] | QUOTA GROUP g DELETE\n")
+            else:
+                config = quota_manager.config()
+                response = "DATA QUOTAS\n===========\n"
+                response += f"Over-quota action: {QUOTA_ACTION}"
+                response += f" ({QUOTA_THROTTLE_KBPS:g} KB/s)\n" if QUOTA_ACTION == "throttle" else "\n"
+                response += (f"Default per user: daily {format_quota_bytes(config['default'].get('daily', 0))}, "
+                             f"monthly {format_quota_bytes(config['default'].get('monthly', 0))}\n")
+                if config['users']:
+                    response += "\nUsers\n-----\n"
+                    for username in sorted(config['users']):
+                        response += quota_line(username, *quota_manager.status(username)[0][1:])
+                groups = quota_manager.group_status()
+                if groups:
+                    response += "\nGroups\n------\n"
+                    for group, day_bytes, daily_limit, month_bytes, monthly_limit, members in groups:
+                        response += quota_line(f"{group} ({', '.join(members) or 'no members'})",
+                                               day_bytes, daily_limit, month_bytes, monthly_limit)
+                exhausted = quota_manager.exhausted_users()
+                response += f"\nOver quota now: {', '.join(exhausted) if exhausted else 'nobody'}\n"
+            client_sock.sendall(response.encode())
+        
+        elif command == "HELP":
+            response = """PROXY MONITOR COMMANDS
+======================
+STATUS        - Show proxy status
+CLIENTS       - List active connected clients
+ADDUSER u p   - Add new user (username password)
+DELUSER u     - Delete user (username)
+LISTUSERS     - List all valid users
+CACHE         - Show cache data (JSON)
+LOGS [opts]   - Show server log
+LOGINLOG [opts] - Show login/logout history
+                opts: tail N, since TIME (2024-05-01 13:00, 30m, 2h), user U, ip X, follow
+USAGE         - Show total data usage for all users
+USAGE u       - Show total data usage for specific user
+USAGELOG [D]  - Show daily data usage totals (last D days, default 30)
+USAGELOG user u [D] - Show daily and hourly data usage for a user
+USAGELOG top [N] [D] - Top N users by data usage over the last D days (default 10, 7)
+QUOTA [u]     - Show data quotas and usage (all, or one user)
+QUOTA SET USER u|GROUP g|DEFAULT DAILY|MONTHLY SIZE - Set a quota (e.g. 500M, 2G; 0 = none)
+QUOTA UNSET u - Make a user follow the default quota again
+QUOTA GROUP g ADD|REMOVE u [u ...] - Change group membership (QUOTA GROUP g DELETE removes it)
+BANDWIDTH     - Show per-user bandwidth allocation
+TOPBYTES [N] [M] - Top N destinations by bytes over the last M minutes
+TOPCONNS [N] [M] - Top N destinations by connections over the last M minutes
+LOCKS         - Show lock wait/hold times (LOCKS RESET clears them)
+METRICS       - Show metrics in OpenMetrics format (also GET /metrics over HTTP)
+RESTART       - Remotely restart the proxy server
+RESTART HANDOVER [TUNNELS] - Start a new process on the same sockets without refusing clients;
+                this one drains (TUNNELS passes open tunnels over instead, threaded engine)
+HELP          - Show this help message
+"""
+            client_sock.sendall(response.encode())
+        
+        elif command == "RESTART" and len(parts) > 1 and parts[1].upper() == "HANDOVER":
+            # Hand the listening sockets to a freshly started process (e.g. after deploying a new build)
+            if WORKER_ID is not None or supervisor_state is not None:
+                response = "RESTART HANDOVER is not supported with PROXY_WORKERS; use RESTART.\n"
+            elif proxy_handover is not None:
+                response = "A handover is already in progress.\n"
+            else:
+                proxy_handover = ProxyHandover(with_tunnels=len(parts) > 2 and parts[2].upper() == "TUNNELS")
+                response = proxy_handover.start()
+                if not proxy_handover.completed:
+                    proxy_handover = None
+            client_sock.sendall(response.encode())
+            if proxy_handover is not None and proxy_handover.completed:
+                with restart_lock:
+                    restart_requested = True
+        
+        elif command == "RESTART":
+            response = "Proxy server restarting...\n"
+            client_sock.sendall(response.encode())
+            with restart_lock:
+                restart_requested = True
+            print(f"[*] Remote restart requested")
+            time.sleep(0.5)  # Give client time to receive response
+        
+        else:
+            response = f"Unknown command: {command}\nType 'HELP' for available commands.\n"
+            client_sock.sendall(response.encode())
+    
+    except Exception as e:
+        print(f"[!] Monitor request error: {e}")
+    finally:
+        try:
+            client_sock.close()
+        except:
+            pass
+
+
+
+def start_proxy():
+    """Start the HTTPS proxy server."""
+    # Read the key now so a bad key stops startup here rather than in the user loader
+    get_cipher()
+    
+    if WORKER_ID is not None:
+        connect_shared_state()
+        # The supervisor stops workers with SIGTERM; exit normally so usage not yet
+        # forwarded reaches it (the flush runs at exit, while the supervisor waits for us)
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        atexit.unregister(usage_ledger.flush)  # Registered once across RESTARTs
+        atexit.register(usage_ledger.flush)
+    
+    # Started by RESTART HANDOVER: take over the old process's sockets instead of binding
+    handover_conn = monitor_sock = None
+    handover_address = os.environ.pop("PROXY_HANDOVER_ADDRESS", None)
+    if handover_address:
+        handover_conn, server_sock, monitor_sock = receive_handover(
+            handover_address, bytes.fromhex(os.environ.pop("PROXY_HANDOVER_AUTHKEY")))
+    else:
+        server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if WORKER_ID is not None:
+            server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        server_sock.bind((LISTEN_HOST, LISTEN_PORT))
+        server_sock.listen(5)
+    server_sock.settimeout(1.0)  # 1 second timeout to check restart flag
+    listening_sockets['proxy'] = server_sock
+    
+    # Decrypt users and load the page cache in the background; the accept loop starts now
+    start_user_reload_thread()
+    cache_manager.start_loading()
+    
+    server_logger.log(f"[*] HTTPS Proxy Server with Persistent Caching")
+    if WORKER_ID is not None:
+        server_logger.log(f"[*] Worker {WORKER_ID} (pid {os.getpid()})")
+    server_logger.log(f"[*] Connection engine: {PROXY_ENGINE}")
+    server_logger.log(f"[*] Relay mode: {RELAY_MODE}")
+    server_logger.log(f"[*] Listening on {LISTEN_HOST}:{LISTEN_PORT}")
+    server_logger.log(f"[*] Monitor listening on {LISTEN_HOST}:{MONITOR_PORT}")
+    server_logger.log(f"[*] Cache TTL: {CACHE_TTL} seconds")
+    server_logger.log(f"[*] Cache file: {CACHE_FILE}")
+    server_logger.log(f"[*] Users file: {USERS_FILE} (encrypted)")
+    server_logger.log(f"[*] Auto-save interval: {CACHE_SAVE_INTERVAL} seconds")
+    server_logger.log(f"[*] Warm connection pool size: {MAX_CACHED_CONNECTIONS}")
+    server_logger.log(f"[*] Ready to accept connections...")
+    
+    # Start auto-save thread (one writer for the shared cache file in worker mode)
+    if WORKER_ID is None or WORKER_ID == 0:
+        cache_manager.start_auto_save()
+    
+    # Start usage ledger flusher and quota counters
+    usage_ledger.start_flusher()
+    quota_manager.start()
+    
+    # Start bandwidth shaper rebalancer
+    bandwidth_shaper.start()
+    
+    # Start DNS prefetch
+    dns_resolver.start_prefetch()
+    
+    # Start warm upstream connection pool
+    warm_pool.start()
+    
+    # Start destination analytics
+    destination_stats.start()
+    
+    # Start session expiry timers
+    session_manager.start()
+    
+    if WORKER_ID is None:
+        # Start monitor server
+        monitor_thread = threading.Thread(target=start_monitor_server, args=(monitor_sock,), daemon=True)
+        monitor_thread.start()
+    else:
+        # The supervisor runs the monitor; keep it informed instead
+        start_worker_sync_thread()
+    
+    if handover_conn is not None:
+        # The old process stops accepting once we are ready; until then both share the socket
+        handover_conn.send(('ready',))
+    
+    try:
+        if PROXY_ENGINE == "asyncio":
+            asyncio.run(serve_async(server_sock))
+            return
+        
+        while True:
+            # Check if restart was requested
+            with restart_lock:
+                if restart_requested:
+                    print(f"[*] Proxy server detected restart signal, shutting down...")
+                    break
+            
+            try:
+                client_sock, addr = server_sock.accept()
+                server_logger.log(f"[*] Connection from {addr[0]}:{addr[1]}")
+                threading.Thread(target=handle_client, args=(client_sock, addr), daemon=True).start()
+            except socket.timeout:
+                continue  # Timeout expired, loop will check restart flag
+    except KeyboardInterrupt:
+        print("\n[*] Shutting down...")
+        cache_manager.stop_auto_save()
+        cache_manager.save_cache_to_disk()
+        usage_ledger.flush()
+    finally:
+        server_sock.close()
+
+
+def main_loop():
+    """Main loop that handles restarts."""
+    global restart_requested
+    if PROXY_ENGINE not in ("threaded", "asyncio"):
+        print(f"[!] Unknown PROXY_ENGINE '{PROXY_ENGINE}' (expected threaded or asyncio)")
+        sys.exit(1)
+    while True:
+        try:
+            # Reset the restart flag before starting
+            with restart_lock:
+                restart_requested = False
+            if PROXY_WORKERS > 1 and WORKER_ID is None and hasattr(socket, "SO_REUSEPORT"):
+                start_supervisor(PROXY_WORKERS)
+            else:
+                start_proxy()
+            if proxy_handover is not None and proxy_handover.completed:
+                proxy_handover.drain()
+                return
+        except Exception as e:
+            print(f"[!] Proxy crashed: {e}")
+            print(f"[*] Restarting in 2 seconds...")
+            time.sleep(2)
+
+
+if __name__ == "__main__":
+    if PROXY_KEEPER and keeper_sock is None and WORKER_ID is None:
+        run_keeper()
+    else:
+        main_loop()